@@ -0,0 +1,113 @@
+import json
+import utils
+import config
+
+
+SCOPES = ("my", "shared", "public")
+
+
+def bearer_token(header):
+    scheme, _, token = (header or "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else ""
+
+
+def check_batch(data, name):
+    max_batch = config.settings.api_batch_size
+    if not isinstance(data, dict) or not isinstance(data.get(name), list):
+        return [f"Oczekiwano obiektu JSON z listą '{name}'."]
+    if len(data[name]) > max_batch:
+        return [f"Jedno zapytanie może obejmować maksymalnie {max_batch} notatek."]
+    return []
+
+
+# Notes from the API go through the same checks as the new note form.
+def check_notes(records):
+    new_notes, errors = [], []
+    for record in records:
+        fields = note_fields(record)
+        if fields is None:
+            new_notes.append(None)
+            errors.append(["Nieprawidłowe dane notatki."])
+            continue
+
+        title, content, readers, public, expires = fields
+        note_errors = utils.check_note(title, content, readers)
+        note_errors += utils.check_expiry(expires)
+        new_notes.append(None if note_errors else
+                         (title, content, readers, public, int(expires or 0)))
+        errors.append(note_errors)
+    return new_notes, errors
+
+
+def note_fields(record):
+    if not isinstance(record, dict):
+        return None
+
+    title, content = record.get("title", ""), record.get("content", "")
+    readers, public = record.get("readers", ""), record.get("public", False)
+    expires = record.get("expires") or ""
+    if isinstance(readers, list) and all(isinstance(user, str) for user in readers):
+        readers = ", ".join(readers)
+
+    if not (isinstance(title, str) and isinstance(content, str) and isinstance(readers, str)
+            and isinstance(public, bool) and isinstance(expires, (str, int))
+            and not isinstance(expires, bool)):
+        return None
+    return title, content, readers, public, str(expires)
+
+
+def readers_to_check(new_notes):
+    return {index: new_note[2] for index, new_note in enumerate(new_notes)
+            if new_note and not new_note[3]}
+
+
+def add_reader_errors(new_notes, errors, indexes, invalid):
+    for index, reader in zip(indexes, invalid):
+        if reader != True:
+            new_notes[index] = None
+            errors[index].append(f"Nieprawidłowy użytkownik lub grupa: '{reader}'.")
+
+
+def created_results(new_notes, errors, note_ids):
+    note_ids = iter(note_ids)
+    return [{"id": next(note_ids)} if new_note else {"errors": note_errors}
+            for new_note, note_errors in zip(new_notes, errors)]
+
+
+def parse_ids(ids):
+    return list(dict.fromkeys(note_id for note_id in (ids or "").split(",") if note_id))
+
+
+def check_ids(note_ids):
+    max_batch = config.settings.api_batch_size
+    if len(note_ids) > max_batch:
+        return [f"Jedno zapytanie może obejmować maksymalnie {max_batch} notatek."]
+    return []
+
+
+def parse_limit(limit):
+    default = config.settings.notes_page_size
+    if not (limit or "").isdigit() or int(limit) < 1:
+        return default
+    return min(int(limit), config.settings.api_batch_size)
+
+
+def note_json(note):
+    return {"id": note["id"], "author": note["author"], "title": note["title"],
+            "content": note["content"], "public": note["public"],
+            "readers": note.get("readers", []), "datetime": note["datetime"].isoformat(),
+            "edited": isoformat(note.get("edited")), "expires": isoformat(note.get("expires"))}
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+def ndjson(found, next_cursor):
+    for note in found:
+        yield ndjson_line(note_json(note))
+    yield ndjson_line({"next_cursor": next_cursor})
+
+
+def ndjson_line(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
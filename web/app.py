@@ -1,23 +1,40 @@
 from flask import Flask, render_template, request, \
-    flash, redirect, url_for, g, make_response
+    flash, redirect, url_for, g, make_response, stream_template, get_flashed_messages
+from flask import session as flask_session
+from flask import before_render_template, template_rendered
+from time import perf_counter
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 from functools import wraps
-from yaml import safe_load
 from os import getenv
 from dotenv import load_dotenv
-from time import sleep
 
 import utils
 import db
+import api
 import session
 import notes
+import groups
+import cache
+import search
+import limits
+import metrics
+import commands
+import config
 
 
 app = Flask(__name__)
 load_dotenv()
 app.secret_key = getenv("FLASH_SECRET")
+if config.settings.trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.settings.trusted_proxies)
+
+for command in commands.commands:
+    app.cli.add_command(command)
 
 utils.check_config()
-config = safe_load(open("config.yaml"))
+
+app.jinja_env.globals["note_expiry"] = utils.NOTE_EXPIRY
 
 
 def login_required(function):
@@ -31,6 +48,27 @@ def login_required(function):
     return wrapper
 
 
+def api_token_required(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.api_user = db.get_api_user(api.bearer_token(request.headers.get("Authorization")))
+        if not g.api_user:
+            return {"errors": ["Nieprawidłowy token API."]}, 401, {"WWW-Authenticate": "Bearer"}
+
+        return function(*args, **kwargs)
+    return wrapper
+
+
+@app.before_request
+def start_metrics():
+    metrics.start_request()
+
+
+@app.before_request
+def start_expired_sweeper():
+    notes.start_sweeper()
+
+
 @app.before_request
 def before():
     g.session = {}
@@ -39,6 +77,67 @@ def before():
         g.session = session.get(session_id)
 
 
+@app.after_request
+def after(response):
+    renewed_id = g.get("session", {}).get("renewed_id")
+    if renewed_id:
+        response.set_cookie("session_id", renewed_id, httponly=True, secure=True,
+                            max_age=config.settings.session_expire_seconds)
+    return response
+
+
+@app.after_request
+def finish_metrics(response):
+    endpoint, method, path = request.endpoint, request.method, request.full_path
+    if response.is_streamed:
+        # Streamed pages keep querying Redis while the body is sent.
+        response.call_on_close(
+            lambda: report_metrics(endpoint, method, path, response.status_code))
+    else:
+        report_metrics(endpoint, method, path, response.status_code)
+    return response
+
+
+def report_metrics(endpoint, method, path, status):
+    summary = metrics.finish_request(endpoint, status)
+    if summary and summary["duration"] * 1000 >= config.settings.slow_request_ms:
+        app.logger.warning("Slow request %s %s: %s", method, path, metrics.describe(summary))
+
+    metrics.flush(db.redis, config.settings.metrics_flush_seconds)
+
+
+def stream_page(template, **context):
+    # The session cookie goes out with the headers, so flashed messages
+    # have to be taken out of it before the body starts streaming.
+    get_flashed_messages(with_categories=True)
+    return buffer_chunks(stream_template(template, **context))
+
+
+def buffer_chunks(chunks, size=8192):
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    g.render_start = perf_counter()
+
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, context, **extra):
+    start = g.pop("render_start", None)
+    if start is not None:
+        metrics.observe("template_render_seconds", perf_counter() - start,
+                        template=template.name)
+
+
 @app.context_processor
 def inject_dict_for_all_templates():
     return dict(session=g.session)
@@ -50,12 +149,37 @@ def error404(e):
                            message="Nie znaleziono strony o podanym adresie."), 404
 
 
+@app.errorhandler(db.HashingBusy)
+def hashing_busy(e):
+    response = make_response(render_template(
+        "error.html", title="Błąd 503",
+        message="Serwer jest przeciążony, spróbuj ponownie za chwilę."), 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.errorhandler(limits.RateLimited)
+def rate_limited(e):
+    response = make_response(render_template(
+        "error.html", title="Błąd 429",
+        message=f"Zbyt wiele prób, spróbuj ponownie za {e.retry_after} s."), 429)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
 @app.errorhandler(500)
 def erorr500(e):
     return render_template("error.html", title="Błąd 500",
                            message="Nieznany błąd serwera."), 500
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    response = make_response(metrics.render(db.redis))
+    response.mimetype = "text/plain"
+    return response
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -69,39 +193,36 @@ def login():
     username = request.form.get("username")
     password = request.form.get("password")
 
-    errors = []
-
-    if not username or len(username) < 1:
-        errors.append("Nazwa użytkownika nie może być pusta.")
-
-    if not password or len(password) < 1:
-        errors.append("Hasło nie może być puste.")
-    
-    if len(username) > 50 or len(password) > 50 or not username.isalpha():
-        errors.append("Nieprawidłowa nazwa użytkownika lub hasło.")
-    
+    errors = utils.check_login(username, password)
     if len(errors) > 0:
         for error in errors:
             flash(error, "danger")
         return redirect(url_for("login"))
 
+    ip = utils.get_ip(request)
+    limits.check("login", ip=ip, account=username)
 
-    seconds_to_login = db.seconds_to_next_login(username)
+    seconds_to_login, attempt_id, hashed_password = db.start_login_attempt(username, ip)
     if seconds_to_login > 0:
         flash(
             f"Przed kolejną próbą logowania zaczekaj {seconds_to_login} sekund.", "danger")
         return redirect(url_for("login"))
 
-    if len(errors) == 0 and not db.check_credentials(username, password):
+    try:
+        valid = bool(hashed_password) and db.check_secret(password, hashed_password)
+    except Exception:
+        db.cancel_login_attempt(username, attempt_id)
+        raise
+    if not valid:
         errors.append("Nieprawidłowa nazwa użytkownika lub hasło.")
 
     if len(errors) == 0:
-        db.save_login_attempt(username, True, utils.get_ip(request))
+        db.finish_login_attempt(username, attempt_id, True, ip)
 
         session_id = session.save(username)
         response = make_response(redirect(url_for("index")))
         response.set_cookie("session_id", session_id, httponly=True, secure=True,
-                            max_age=config["session_expire_seconds"])
+                            max_age=config.settings.session_expire_seconds)
 
         flash("Zalogowano pomyślnie!", "success")
         return response
@@ -109,8 +230,7 @@ def login():
         for error in errors:
             flash(error, "danger")
 
-        if db.username_taken(username):
-            db.save_login_attempt(username, False, utils.get_ip(request))
+        db.finish_login_attempt(username, attempt_id, False, ip)
         return redirect(url_for("login"))
 
 
@@ -125,18 +245,15 @@ def register(fields={}):
     if request.method == "GET":
         return render_template("forms/register.html", fields=fields)
 
+    limits.check("register", ip=utils.get_ip(request))
+
     username = request.form.get("username")
     email = request.form.get("email")
     password1 = request.form.get("password1")
     password2 = request.form.get("password2")
 
     errors = utils.check_password(password1, password2)
-
-    if not (username and 3 <= len(username) <= 20 and username.isalpha()):
-        errors.append("Nieprawidłowa nazwa użytkownika.")
-
-    if not (email and 3 <= len(email) <= 50):
-        errors.append("Nieprawidłowy adres email.")
+    errors += utils.check_registration(username, email)
 
     if db.username_taken(username):
         errors.append("Nazwa użytkownika jest zajęta.")
@@ -152,7 +269,6 @@ def register(fields={}):
             flash("Nie udało się zarejestrować nowego konta.", "danger")
         return redirect(url_for("index"))
     else:
-        sleep(1)
         for error in errors:
             flash(error, "danger")
         return render_template("forms/register.html", fields={"username": username, "email": email})
@@ -165,6 +281,15 @@ def settings():
     return render_template("settings.html", user=data)
 
 
+@app.route("/api-token", methods=["POST"])
+@login_required
+def api_token():
+    username = g.session.get("username")
+    token = db.create_api_token(username)
+    flash("Wygenerowano nowy token API, poprzedni przestał działać.", "success")
+    return render_template("settings.html", user=db.get_user_data(username), api_token=token)
+
+
 @app.route("/change-password", methods=["GET", "POST"])
 @login_required
 def password_change():
@@ -203,6 +328,8 @@ def password_reset():
         flash("Adres email jest wymagany.", "danger")
         return redirect(url_for("password_reset"))
 
+    limits.check("reset", ip=utils.get_ip(request), account=email)
+
     flash("Jeśli adres był poprawny, wysłano email z linkiem do zmiany hasła.", "success")
 
     if db.email_taken(email):
@@ -221,6 +348,8 @@ def password_reset_token(token):
     password1 = request.form.get("password1")
     password2 = request.form.get("password2")
 
+    limits.check("reset", ip=utils.get_ip(request), account=email)
+
     errors = utils.check_password(password1, password2)
     if len(errors) > 0:
         for error in errors:
@@ -245,33 +374,20 @@ def new_note():
     title = request.form.get("title")
     content = request.form.get("content")
     readers = request.form.get("readers")
+    expires = request.form.get("expires", "")
     public = (request.form.get("public") != None)
 
-    errors = []
-
-    max_length = config["max_note_length"]
-    max_title_length = config["max_note_title_length"]
-    max_lines = config["max_note_lines"]
-    max_readers_length = config["max_note_readers_length"]
-
-    if len(content) > max_length:
-        errors.append(
-            f"Długość notatki nie może przekraczać {max_length} znaków.")
-
-    if len(title) > max_title_length:
-        errors.append(
-            f"Długość tytułu nie może przekraczać {max_title_length} znaków.")
-
-    if content.count("\n") > max_lines:
-        errors.append(f"Notatka nie może mieć więcej niż {max_lines} linii")
+    errors = utils.check_note(title, content, readers)
+    errors += utils.check_expiry(expires)
 
-    if len(readers) > max_readers_length:
-        errors.append("Nie można udostępnić notatki aż tylu użytkownikom.")
+    max_length = config.settings.max_note_length
+    max_title_length = config.settings.max_note_title_length
+    max_readers_length = config.settings.max_note_readers_length
 
     if not public and len(errors) == 0:
-        check_readers = notes.check_readers(readers)
+        check_readers = notes.check_readers(readers, g.session.get("username"))
         if check_readers != True:
-            errors.append(f"Nieprawidłowy użytkownik: '{check_readers}'.")
+            errors.append(f"Nieprawidłowy użytkownik lub grupa: '{check_readers}'.")
 
     if len(errors) > 0:
         for error in errors:
@@ -286,10 +402,11 @@ def new_note():
                 content=content[:max_length*3],
                 readers=readers[:max_readers_length*3])
         else:
-            return render_template("new_note.html", title=title, content=content, readers=readers)
+            return render_template("new_note.html", title=title, content=content, readers=readers,
+                                   expires=expires)
     else:
         notes.create(g.session.get("username"),
-                     title, content, readers, public)
+                     title, content, readers, public, int(expires or 0))
         flash("Notatka została zapisana.", "success")
         return redirect(url_for("new_note"))
 
@@ -297,14 +414,58 @@ def new_note():
 @app.route("/my-notes")
 @login_required
 def my_notes():
-    my_notes = notes.get_my_notes(g.session.get("username"))
-    return render_template("my_notes.html", notes=my_notes)
+    cursor = request.args.get("cursor")
+    my_notes, next_cursor = notes.get_my_notes(g.session.get("username"), cursor, lazy=True)
+    return stream_page("my_notes.html", notes=my_notes, cursor=cursor, next_cursor=next_cursor)
+
+
+@app.route("/edit-note/<note_id>", methods=["GET", "POST"])
+@login_required
+def edit_note(note_id):
+    note = notes.get(note_id)
+    if note.get("author") != g.session.get("username"):
+        return redirect(url_for("my_notes"))
+
+    version = note.get("version", "0")
+    if request.method == "GET":
+        return render_template("edit_note.html", note=note, title=note["title"],
+                               content=note["content"], version=version)
+
+    title = request.form.get("title", "")
+    content = request.form.get("content", "")
+
+    errors = utils.check_note(title, content, "")
+
+    if len(errors) == 0 and (request.form.get("version") != version
+                             or not notes.edit(note, title, content)):
+        errors.append("Notatka została w międzyczasie zmieniona, sprawdź ją i zapisz ponownie.")
+
+    if len(errors) > 0:
+        for error in errors:
+            flash(error, "danger")
+        return render_template(
+            "edit_note.html", note=note, version=version,
+            title=title[:config.settings.max_note_title_length * 3],
+            content=content[:config.settings.max_note_length * 3])
+
+    flash("Notatka została zmieniona.", "success")
+    return redirect(url_for("my_notes"))
+
+
+@app.route("/note-history/<note_id>")
+@login_required
+def note_history(note_id):
+    note = notes.get(note_id)
+    if note.get("author") != g.session.get("username"):
+        return redirect(url_for("my_notes"))
+    return render_template("note_history.html", note=note, history=notes.get_history(note))
 
 
 @app.route("/delete-note/<note_id>")
 @login_required
 def delete_note(note_id):
-    note = notes.get(note_id)
+    found = notes.get_many([note_id])
+    note = found[0] if found else {}
     if note.get("author") == g.session.get("username"):
         notes.delete(note_id)
     return redirect(url_for("my_notes"))
@@ -312,12 +473,122 @@ def delete_note(note_id):
 
 @app.route("/public-notes")
 def public_notes():
-    public = notes.get_public()
-    return render_template("public_notes.html", notes=public)
+    cursor = notes.normalize_cursor(request.args.get("cursor"))
+    version, modified = cache.get_version("public-notes")
+    etag = cache.etag("public-notes", version, cursor, g.session.get("username", ""))
+
+    if "_flashes" not in flask_session and not is_resource_modified(
+            request.environ, etag=etag, last_modified=modified):
+        response = make_response("", 304)
+    else:
+        # Only the first page is cached, so clients cannot fill the cache
+        # with pages for cursors of their choosing.
+        notes_html = None if cursor else cache.get("public-notes", version)
+        if notes_html is None:
+            public, next_cursor = notes.get_public(cursor, lazy=True)
+            notes_html = stream_template("public_notes_list.html", notes=public,
+                                         cursor=cursor, next_cursor=next_cursor)
+            if not cursor:
+                notes_html = cache.set_streamed("public-notes", version, "", notes_html,
+                                                notes.public_cache_seconds())
+        else:
+            notes_html = [notes_html]
+        response = make_response(stream_page("public_notes.html", notes_html=notes_html))
+
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+@app.route("/search")
+def search_notes():
+    query = request.args.get("q", "")
+    results = search.search(g.session.get("username"), query)
+    return render_template("search.html", notes=results, query=query)
 
 
 @app.route("/shared-notes")
 @login_required
 def shared_notes():
-    shared = notes.get_shared(g.session.get("username"))
-    return render_template("shared_notes.html", notes=shared)
+    cursor = request.args.get("cursor")
+    shared, next_cursor = notes.get_shared(g.session.get("username"), cursor, lazy=True)
+    return stream_page("shared_notes.html", notes=shared, cursor=cursor, next_cursor=next_cursor)
+
+
+@app.route("/groups", methods=["GET", "POST"])
+@login_required
+def reader_groups():
+    username = g.session.get("username")
+    if request.method == "GET":
+        return render_template("groups.html", groups=groups.get_groups(username))
+
+    name = request.form.get("name", "").strip()
+    members = notes.parse_readers(request.form.get("members", ""))
+
+    errors = utils.check_group(name, members)
+
+    if len(errors) == 0:
+        check_members = groups.check_members(username, members)
+        if check_members != True:
+            errors.append(f"Nieprawidłowy użytkownik: '{check_members}'.")
+
+    if len(errors) == 0:
+        groups.save(username, name, members)
+        flash("Grupa została zapisana.", "success")
+
+    for error in errors:
+        flash(error, "danger")
+    return redirect(url_for("reader_groups"))
+
+
+@app.route("/delete-group/<name>")
+@login_required
+def delete_group(name):
+    groups.delete(g.session.get("username"), name)
+    return redirect(url_for("reader_groups"))
+
+
+@app.route("/api/notes", methods=["GET", "POST"])
+@api_token_required
+def api_notes():
+    if request.method == "GET":
+        note_ids = api.parse_ids(request.args.get("ids"))
+        errors = api.check_ids(note_ids)
+        if len(errors) > 0:
+            return {"errors": errors}, 400
+        found = notes.get_readable(note_ids, g.api_user)
+        return {"notes": [api.note_json(note) for note in found]}
+
+    data = request.get_json(silent=True)
+    errors = api.check_batch(data, "notes")
+    if len(errors) > 0:
+        return {"errors": errors}, 400
+
+    new_notes, errors = api.check_notes(data["notes"])
+    readers = api.readers_to_check(new_notes)
+    api.add_reader_errors(new_notes, errors, readers,
+                          notes.check_readers_many(g.api_user, readers.values()))
+
+    note_ids = notes.create_many(g.api_user, [new_note for new_note in new_notes if new_note])
+    return {"notes": api.created_results(new_notes, errors, note_ids)}
+
+
+@app.route("/api/notes/<scope>")
+@api_token_required
+def api_list_notes(scope):
+    if scope not in api.SCOPES:
+        return {"errors": ["Nieznany rodzaj notatek."]}, 404
+
+    cursor = request.args.get("cursor")
+    limit = api.parse_limit(request.args.get("limit"))
+    if scope == "my":
+        found, next_cursor = notes.get_my_notes(g.api_user, cursor, True, limit)
+    elif scope == "shared":
+        found, next_cursor = notes.get_shared(g.api_user, cursor, True, limit)
+    else:
+        found, next_cursor = notes.get_public(cursor, True, limit)
+    return app.response_class(buffer_chunks(api.ndjson(found, next_cursor)),
+                              mimetype="application/x-ndjson")
@@ -0,0 +1,613 @@
+from quart import Quart, render_template, request, \
+    flash, redirect, url_for, g, make_response, stream_template, get_flashed_messages
+from quart import session as quart_session
+from quart.wrappers.response import IterableBody
+from hypercorn.middleware import ProxyFixMiddleware
+from functools import wraps
+from os import getenv
+from dotenv import load_dotenv
+import asyncio
+
+import utils
+import db
+import api
+import async_db
+import async_session
+import async_notes
+import async_cache
+import async_search
+import async_groups
+import async_limits
+import async_metrics
+import limits
+import metrics
+import notes
+import cache
+import config
+
+
+app = Quart(__name__)
+load_dotenv()
+app.secret_key = getenv("FLASH_SECRET")
+if config.settings.trusted_proxies:
+    app.asgi_app = ProxyFixMiddleware(app.asgi_app, trusted_hops=config.settings.trusted_proxies)
+
+utils.check_config()
+
+app.jinja_env.globals["note_expiry"] = utils.NOTE_EXPIRY
+
+
+def login_required(function):
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        if not g.get("session").get("username"):
+            await flash("Sesja wygasła, zaloguj się ponownie.", "success")
+            return redirect(url_for("login"))
+
+        return await function(*args, **kwargs)
+    return wrapper
+
+
+def api_token_required(function):
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        token = api.bearer_token(request.headers.get("Authorization"))
+        g.api_user = await async_db.get_api_user(token)
+        if not g.api_user:
+            return {"errors": ["Nieprawidłowy token API."]}, 401, {"WWW-Authenticate": "Bearer"}
+
+        return await function(*args, **kwargs)
+    return wrapper
+
+
+async def flash_all(errors):
+    for error in errors:
+        await flash(error, "danger")
+
+
+def set_session_cookie(response, session_id):
+    response.set_cookie("session_id", session_id, httponly=True, secure=True,
+                        max_age=config.settings.session_expire_seconds)
+
+
+@app.before_request
+async def start_metrics():
+    metrics.start_request()
+
+
+@app.before_request
+async def before():
+    g.session = {}
+    session_id = request.cookies.get("session_id")
+    if session_id:
+        g.session = await async_session.get(session_id)
+
+
+@app.after_request
+async def after(response):
+    renewed_id = g.get("session", {}).get("renewed_id")
+    if renewed_id:
+        set_session_cookie(response, renewed_id)
+    return response
+
+
+@app.after_request
+async def finish_metrics(response):
+    endpoint, method, path = request.endpoint, request.method, request.full_path
+    if isinstance(response.response, IterableBody):
+        # Streamed pages keep querying Redis while the body is sent.
+        response.response = IterableBody(report_after_body(
+            response.response.iter, endpoint, method, path, response.status_code))
+    else:
+        await report_metrics(endpoint, method, path, response.status_code)
+    return response
+
+
+async def report_after_body(chunks, endpoint, method, path, status):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await report_metrics(endpoint, method, path, status)
+
+
+async def report_metrics(endpoint, method, path, status):
+    summary = metrics.finish_request(endpoint, status)
+    if summary and summary["duration"] * 1000 >= config.settings.slow_request_ms:
+        app.logger.warning("Slow request %s %s: %s", method, path, metrics.describe(summary))
+
+    await async_metrics.flush(async_db.redis, config.settings.metrics_flush_seconds)
+
+
+@app.before_serving
+async def start_expired_sweeper():
+    async_notes.start_sweeper()
+
+
+@app.before_serving
+async def reload_config_on_signal():
+    config.reload_on_signal()
+
+
+@app.after_serving
+async def stop_expired_sweeper():
+    await async_notes.stop_sweeper()
+
+
+async def stream_page(template, **context):
+    # The session cookie goes out with the headers, so flashed messages
+    # have to be taken out of it before the body starts streaming.
+    get_flashed_messages(with_categories=True)
+    return buffer_chunks(await stream_template(template, **context))
+
+
+async def buffer_chunks(chunks, size=8192):
+    buffer, length = [], 0
+    async for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+@app.context_processor
+async def inject_dict_for_all_templates():
+    return dict(session=g.get("session", {}))
+
+
+@app.errorhandler(404)
+async def error404(e):
+    return await render_template("error.html", title="Błąd 404",
+                                 message="Nie znaleziono strony o podanym adresie."), 404
+
+
+@app.errorhandler(db.HashingBusy)
+async def hashing_busy(e):
+    response = await make_response(await render_template(
+        "error.html", title="Błąd 503",
+        message="Serwer jest przeciążony, spróbuj ponownie za chwilę."), 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.errorhandler(limits.RateLimited)
+async def rate_limited(e):
+    response = await make_response(await render_template(
+        "error.html", title="Błąd 429",
+        message=f"Zbyt wiele prób, spróbuj ponownie za {e.retry_after} s."), 429)
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(500)
+async def erorr500(e):
+    return await render_template("error.html", title="Błąd 500",
+                                 message="Nieznany błąd serwera."), 500
+
+
+@app.route("/metrics")
+async def metrics_endpoint():
+    response = await make_response(await async_metrics.render(async_db.redis))
+    response.mimetype = "text/plain"
+    return response
+
+
+@app.route("/")
+async def index():
+    return await render_template("index.html")
+
+
+@app.route("/login", methods=["GET", "POST"])
+async def login():
+    if request.method == "GET":
+        return await render_template("forms/login.html")
+
+    form = await request.form
+    username = form.get("username")
+    password = form.get("password")
+
+    errors = utils.check_login(username, password)
+    if len(errors) > 0:
+        await flash_all(errors)
+        return redirect(url_for("login"))
+
+    ip = utils.get_ip(request)
+    await async_limits.check("login", ip=ip, account=username)
+
+    seconds_to_login, attempt_id, hashed_password = \
+        await async_db.start_login_attempt(username, ip)
+    if seconds_to_login > 0:
+        await flash(
+            f"Przed kolejną próbą logowania zaczekaj {seconds_to_login} sekund.", "danger")
+        return redirect(url_for("login"))
+
+    try:
+        valid = bool(hashed_password) and await async_db.check_secret(password, hashed_password)
+    except Exception:
+        await async_db.cancel_login_attempt(username, attempt_id)
+        raise
+    if valid:
+        session_id, _ = await asyncio.gather(
+            async_session.save(username),
+            async_db.finish_login_attempt(username, attempt_id, True, ip))
+        response = redirect(url_for("index"))
+        set_session_cookie(response, session_id)
+
+        await flash("Zalogowano pomyślnie!", "success")
+        return response
+
+    await flash("Nieprawidłowa nazwa użytkownika lub hasło.", "danger")
+    await async_db.finish_login_attempt(username, attempt_id, False, ip)
+    return redirect(url_for("login"))
+
+
+@app.route("/logout")
+async def logout():
+    await async_session.clear(g.session.get("username"))
+    return redirect(url_for("index"))
+
+
+@app.route("/register", methods=["GET", "POST"])
+async def register():
+    if request.method == "GET":
+        return await render_template("forms/register.html", fields={})
+
+    await async_limits.check("register", ip=utils.get_ip(request))
+
+    form = await request.form
+    username = form.get("username")
+    email = form.get("email")
+    password1 = form.get("password1")
+    password2 = form.get("password2")
+
+    errors = utils.check_password(password1, password2)
+    errors += utils.check_registration(username, email)
+
+    username_taken, email_taken = await asyncio.gather(
+        async_db.username_taken(username), async_db.email_taken(email))
+    if username_taken:
+        errors.append("Nazwa użytkownika jest zajęta.")
+
+    if len(errors) == 0 and email_taken:
+        errors.append("Adres email jest zajęty.")
+
+    if len(errors) == 0:
+        if await async_db.create_user(username, email, password1):
+            await flash("Zarejestrowano pomyślnie!", "success")
+        else:
+            await flash("Nie udało się zarejestrować nowego konta.", "danger")
+        return redirect(url_for("index"))
+
+    await flash_all(errors)
+    return await render_template("forms/register.html",
+                                 fields={"username": username, "email": email})
+
+
+@app.route("/settings")
+@login_required
+async def settings():
+    data = await async_db.get_user_data(g.session.get("username"))
+    return await render_template("settings.html", user=data)
+
+
+@app.route("/api-token", methods=["POST"])
+@login_required
+async def api_token():
+    username = g.session.get("username")
+    token = await async_db.create_api_token(username)
+    await flash("Wygenerowano nowy token API, poprzedni przestał działać.", "success")
+    return await render_template("settings.html", user=await async_db.get_user_data(username),
+                                 api_token=token)
+
+
+@app.route("/change-password", methods=["GET", "POST"])
+@login_required
+async def password_change():
+    if request.method == "GET":
+        return await render_template("forms/password_change.html")
+
+    username = g.session.get("username")
+
+    form = await request.form
+    new1 = form.get("password1")
+    new2 = form.get("password2")
+
+    errors = utils.check_password(new1, new2)
+
+    if not await async_db.check_credentials(username, form.get("old-password")):
+        errors.append("Nieprawidłowe stare hasło.")
+
+    if len(errors) == 0:
+        await async_db.change_password(username, new1)
+        await flash("Hasło zostało zmienione.", "success")
+        return redirect(url_for("settings"))
+
+    await flash_all(errors)
+    return redirect(url_for("password_change"))
+
+
+@app.route("/reset-password", methods=["GET", "POST"])
+async def password_reset():
+    if request.method == "GET":
+        return await render_template("forms/password_reset.html")
+
+    email = (await request.form).get("email")
+
+    if not email:
+        await flash("Adres email jest wymagany.", "danger")
+        return redirect(url_for("password_reset"))
+
+    await async_limits.check("reset", ip=utils.get_ip(request), account=email)
+
+    await flash("Jeśli adres był poprawny, wysłano email z linkiem do zmiany hasła.", "success")
+
+    token = await async_db.request_password_reset(email)
+    if token:
+        return await render_template("forms/password_reset.html", token=token, email=email)
+
+    return await render_template("forms/password_reset.html")
+
+
+@app.route("/reset-password/<token>", methods=["GET", "POST"])
+async def password_reset_token(token):
+    if request.method == "GET":
+        return await render_template("forms/password_reset2.html")
+
+    form = await request.form
+    password1 = form.get("password1")
+    password2 = form.get("password2")
+
+    await async_limits.check("reset", ip=utils.get_ip(request), account=form.get("email"))
+
+    errors = utils.check_password(password1, password2)
+    if len(errors) > 0:
+        await flash_all(errors)
+        return redirect(url_for("password_reset_token", token=token))
+
+    if await async_db.reset_password(form.get("email"), token, password1):
+        await flash("Hasło zostało zmienione.", "success")
+        return redirect(url_for("login"))
+
+    await flash("Błędny adres email, lub prośba o zmianę hasła wygasła.", "danger")
+    return redirect(url_for("password_reset_token", token=token))
+
+
+@app.route("/new-note", methods=["GET", "POST"])
+@login_required
+async def new_note():
+    if request.method == "GET":
+        return await render_template("new_note.html")
+
+    form = await request.form
+    title = form.get("title")
+    content = form.get("content")
+    readers = form.get("readers")
+    expires = form.get("expires", "")
+    public = (form.get("public") != None)
+
+    errors = utils.check_note(title, content, readers)
+    errors += utils.check_expiry(expires)
+
+    if not public and len(errors) == 0:
+        check_readers = await async_notes.check_readers(readers, g.session.get("username"))
+        if check_readers != True:
+            errors.append(f"Nieprawidłowy użytkownik lub grupa: '{check_readers}'.")
+
+    if len(errors) > 0:
+        await flash_all(errors)
+        return await render_template(
+            "new_note.html",
+            title=title[:config.settings.max_note_title_length * 3],
+            content=content[:config.settings.max_note_length * 3],
+            readers=readers[:config.settings.max_note_readers_length * 3],
+            expires=expires)
+
+    await async_notes.create(g.session.get("username"), title, content, readers, public,
+                             int(expires or 0))
+    await flash("Notatka została zapisana.", "success")
+    return redirect(url_for("new_note"))
+
+
+@app.route("/my-notes")
+@login_required
+async def my_notes():
+    cursor = request.args.get("cursor")
+    my_notes, next_cursor = await async_notes.get_my_notes(
+        g.session.get("username"), cursor, lazy=True)
+    return await stream_page("my_notes.html", notes=my_notes,
+                             cursor=cursor, next_cursor=next_cursor)
+
+
+@app.route("/edit-note/<note_id>", methods=["GET", "POST"])
+@login_required
+async def edit_note(note_id):
+    note = await async_notes.get(note_id)
+    if note.get("author") != g.session.get("username"):
+        return redirect(url_for("my_notes"))
+
+    version = note.get("version", "0")
+    if request.method == "GET":
+        return await render_template("edit_note.html", note=note, title=note["title"],
+                                     content=note["content"], version=version)
+
+    form = await request.form
+    title = form.get("title", "")
+    content = form.get("content", "")
+
+    errors = utils.check_note(title, content, "")
+
+    if len(errors) == 0 and (form.get("version") != version
+                             or not await async_notes.edit(note, title, content)):
+        errors.append("Notatka została w międzyczasie zmieniona, sprawdź ją i zapisz ponownie.")
+
+    if len(errors) > 0:
+        await flash_all(errors)
+        return await render_template(
+            "edit_note.html", note=note, version=version,
+            title=title[:config.settings.max_note_title_length * 3],
+            content=content[:config.settings.max_note_length * 3])
+
+    await flash("Notatka została zmieniona.", "success")
+    return redirect(url_for("my_notes"))
+
+
+@app.route("/note-history/<note_id>")
+@login_required
+async def note_history(note_id):
+    note = await async_notes.get(note_id)
+    if note.get("author") != g.session.get("username"):
+        return redirect(url_for("my_notes"))
+    return await render_template("note_history.html", note=note,
+                                 history=await async_notes.get_history(note))
+
+
+@app.route("/delete-note/<note_id>")
+@login_required
+async def delete_note(note_id):
+    note = await async_notes.get(note_id)
+    if note.get("author") == g.session.get("username"):
+        await async_notes.delete(note_id)
+    return redirect(url_for("my_notes"))
+
+
+@app.route("/public-notes")
+async def public_notes():
+    cursor = notes.normalize_cursor(request.args.get("cursor"))
+    version, modified = await async_cache.get_version("public-notes")
+    etag = cache.etag("public-notes", version, cursor, g.session.get("username", ""))
+
+    if "_flashes" not in quart_session and not_modified(etag, modified):
+        response = await make_response("", 304)
+    else:
+        # Only the first page is cached, so clients cannot fill the cache
+        # with pages for cursors of their choosing.
+        notes_html = None if cursor else await async_cache.get("public-notes", version)
+        if notes_html is None:
+            public, next_cursor = await async_notes.get_public(cursor, lazy=True)
+            notes_html = await stream_template("public_notes_list.html", notes=public,
+                                               cursor=cursor, next_cursor=next_cursor)
+            if not cursor:
+                notes_html = async_cache.set_streamed("public-notes", version, "", notes_html,
+                                                      await async_notes.public_cache_seconds())
+        else:
+            notes_html = [notes_html]
+        response = await make_response(
+            await stream_page("public_notes.html", notes_html=notes_html))
+
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+def not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return bool(modified and since and modified <= since)
+
+
+@app.route("/search")
+async def search_notes():
+    query = request.args.get("q", "")
+    results = await async_search.search_notes(g.session.get("username"), query)
+    return await render_template("search.html", notes=results, query=query)
+
+
+@app.route("/shared-notes")
+@login_required
+async def shared_notes():
+    cursor = request.args.get("cursor")
+    shared, next_cursor = await async_notes.get_shared(
+        g.session.get("username"), cursor, lazy=True)
+    return await stream_page("shared_notes.html", notes=shared,
+                             cursor=cursor, next_cursor=next_cursor)
+
+
+@app.route("/groups", methods=["GET", "POST"])
+@login_required
+async def reader_groups():
+    username = g.session.get("username")
+    if request.method == "GET":
+        return await render_template("groups.html",
+                                     groups=await async_groups.get_groups(username))
+
+    form = await request.form
+    name = form.get("name", "").strip()
+    members = notes.parse_readers(form.get("members", ""))
+
+    errors = utils.check_group(name, members)
+
+    if len(errors) == 0:
+        check_members = await async_groups.check_members(username, members)
+        if check_members != True:
+            errors.append(f"Nieprawidłowy użytkownik: '{check_members}'.")
+
+    if len(errors) == 0:
+        await async_groups.save(username, name, members)
+        await flash("Grupa została zapisana.", "success")
+
+    await flash_all(errors)
+    return redirect(url_for("reader_groups"))
+
+
+@app.route("/delete-group/<name>")
+@login_required
+async def delete_group(name):
+    await async_groups.delete(g.session.get("username"), name)
+    return redirect(url_for("reader_groups"))
+
+
+@app.route("/api/notes", methods=["GET", "POST"])
+@api_token_required
+async def api_notes():
+    if request.method == "GET":
+        note_ids = api.parse_ids(request.args.get("ids"))
+        errors = api.check_ids(note_ids)
+        if len(errors) > 0:
+            return {"errors": errors}, 400
+        found = await async_notes.get_readable(note_ids, g.api_user)
+        return {"notes": [api.note_json(note) for note in found]}
+
+    data = await request.get_json(silent=True)
+    errors = api.check_batch(data, "notes")
+    if len(errors) > 0:
+        return {"errors": errors}, 400
+
+    new_notes, errors = api.check_notes(data["notes"])
+    readers = api.readers_to_check(new_notes)
+    api.add_reader_errors(new_notes, errors, readers,
+                          await async_notes.check_readers_many(g.api_user, readers.values()))
+
+    note_ids = await async_notes.create_many(
+        g.api_user, [new_note for new_note in new_notes if new_note])
+    return {"notes": api.created_results(new_notes, errors, note_ids)}
+
+
+@app.route("/api/notes/<scope>")
+@api_token_required
+async def api_list_notes(scope):
+    if scope not in api.SCOPES:
+        return {"errors": ["Nieznany rodzaj notatek."]}, 404
+
+    cursor = request.args.get("cursor")
+    limit = api.parse_limit(request.args.get("limit"))
+    if scope == "my":
+        found, next_cursor = await async_notes.get_my_notes(g.api_user, cursor, True, limit)
+    elif scope == "shared":
+        found, next_cursor = await async_notes.get_shared(g.api_user, cursor, True, limit)
+    else:
+        found, next_cursor = await async_notes.get_public(cursor, True, limit)
+    return app.response_class(buffer_chunks(ndjson(found, next_cursor)),
+                              mimetype="application/x-ndjson")
+
+
+async def ndjson(found, next_cursor):
+    async for note in found:
+        yield api.ndjson_line(api.note_json(note))
+    yield api.ndjson_line({"next_cursor": next_cursor})
@@ -0,0 +1,31 @@
+from datetime import datetime
+import pytz
+import async_db
+import config
+
+
+redis = async_db.redis
+
+
+async def get_version(name):
+    version, modified = await redis.hmget(f"{name}:version", "version", "modified")
+    if modified:
+        modified = datetime.fromtimestamp(int(modified), tz=pytz.utc)
+    return int(version or 0), modified
+
+
+async def get(name, version, variant=""):
+    return await redis.get(f"cache:{name}:{version}:{variant}")
+
+
+async def set(name, version, variant, value, seconds=None):
+    await redis.set(f"cache:{name}:{version}:{variant}", value,
+                    ex=seconds or config.settings.page_cache_seconds)
+
+
+async def set_streamed(name, version, variant, chunks, seconds=None):
+    rendered = []
+    async for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    await set(name, version, variant, "".join(rendered), seconds)
@@ -0,0 +1,168 @@
+from async_metrics import InstrumentedAsyncRedis, InstrumentedAsyncRedisCluster
+from dotenv import load_dotenv
+from time import perf_counter
+import asyncio
+import secrets
+import db
+import metrics
+import hashing
+import config
+import keyspace
+
+
+load_dotenv()
+redis = db.connect(InstrumentedAsyncRedis, InstrumentedAsyncRedisCluster)
+
+
+def load_script(name):
+    # In cluster mode db.load_script has already loaded every script on
+    # the primaries, which async pipelines rely on too.
+    return redis.register_script(db.read_script(name))
+
+
+login_delay_script = load_script("login_delay")
+
+
+async def run_hashing(function, *args):
+    start = perf_counter()
+    result = await asyncio.wrap_future(db.submit_hashing(function, *args))
+    metrics.observe("bcrypt_seconds", perf_counter() - start,
+                    operation=function.__name__)
+    return result
+
+
+async def hash_secret(secret):
+    return await run_hashing(hashing.bcrypt_hash, secret.encode(), config.settings.bcrypt_rounds)
+
+
+async def check_secret(secret, hashed):
+    return await run_hashing(hashing.bcrypt_check, secret.encode(), hashed.encode())
+
+
+async def create_user(username, email, password):
+    key = keyspace.user(username, "profile")
+    if any(await asyncio.gather(username_taken(username), email_taken(email))):
+        return False
+
+    hashed_password = await hash_secret(password)
+
+    if not await redis.hsetnx("emails", email, username):
+        return False
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.hset(key, mapping={"email": email, "password": hashed_password})
+    pipe.sadd(keyspace.shard_for("users", username), username)
+    await pipe.execute()
+    return True
+
+
+async def get_user_data(username):
+    taken, data, attempts = await asyncio.gather(
+        username_taken(username),
+        redis.hgetall(keyspace.user(username, "profile")),
+        get_login_attempts(username))
+    if not taken:
+        return {}
+
+    data["username"] = username
+    data.pop("password", None)
+    data["api_token"] = bool(data.get("api_token"))
+    data["login_attempts"] = db.localize_login_attempts(attempts)
+    return data
+
+
+async def check_credentials(username, password):
+    taken, hashed_password = await asyncio.gather(
+        username_taken(username),
+        redis.hget(keyspace.user(username, "profile"), "password"))
+    if not (taken and hashed_password):
+        return False
+
+    return await check_secret(password, hashed_password)
+
+
+async def username_taken(username):
+    return bool(await redis.sismember(keyspace.shard_for("users", username), username))
+
+
+async def usernames_taken(usernames):
+    pipe = redis.pipeline(transaction=False)
+    groups = db.queue_usernames_taken(pipe, usernames)
+    return db.collect_usernames_taken(usernames, groups, await pipe.execute() if groups else [])
+
+
+async def email_taken(email):
+    return bool(await redis.hexists("emails", email))
+
+
+async def create_api_token(username):
+    token = secrets.token_urlsafe(config.settings.api_token_bytes)
+    old_digest = await redis.hget(keyspace.user(username, "profile"), "api_token")
+
+    pipe = redis.pipeline(transaction=False)
+    db.queue_api_token(pipe, username, db.token_digest(token), old_digest)
+    await pipe.execute()
+    return token
+
+
+async def get_api_user(token):
+    return await redis.hget("api-tokens", db.token_digest(token)) if token else None
+
+
+async def get_login_attempts(username, since=None, until=None, count=None):
+    entries = await redis.xrevrange(keyspace.user(username, "logins"),
+                                    *db.login_range(since, until), count=count)
+    return [db.parse_login_attempt(entry) for entry in entries]
+
+
+async def start_login_attempt(username, ip):
+    return db.login_attempt_result(await login_delay_script(
+        keys=db.login_delay_keys(username), args=db.login_delay_args(ip)))
+
+
+async def finish_login_attempt(username, attempt_id, success, ip):
+    pipe = redis.pipeline(transaction=False)
+    db.queue_login_result(pipe, username, attempt_id, success, ip)
+    await pipe.execute()
+
+
+async def cancel_login_attempt(username, attempt_id):
+    if attempt_id:
+        await redis.xdel(keyspace.user(username, "logins"), attempt_id)
+
+
+async def change_password(username, password):
+    if not await username_taken(username):
+        return False
+
+    hashed_password = await hash_secret(password)
+    await redis.hset(keyspace.user(username, "profile"), "password", hashed_password)
+    return True
+
+
+async def request_password_reset(email):
+    username = await redis.hget("emails", email)
+    if not username:
+        return False
+
+    token = secrets.token_urlsafe(config.settings.password_reset_token_bytes)
+    hashed_token = await hash_secret(token)
+
+    key = f"password-reset:{email}"
+    pipe = redis.pipeline(transaction=False)
+    pipe.hset(key, mapping={"username": username, "token": hashed_token})
+    pipe.expire(key, 300)
+    await pipe.execute()
+    return token
+
+
+async def reset_password(email, token, password):
+    reset = await redis.hgetall(f"password-reset:{email}")
+    if not reset:
+        return False
+
+    if await check_secret(token, reset.get("token")):
+        await change_password(reset.get("username"), password)
+        await redis.delete(f"password-reset:{email}")
+        return True
+    return False
@@ -0,0 +1,59 @@
+import async_db
+import groups
+import keyspace
+
+
+redis = async_db.redis
+
+unlink_script = async_db.load_script("unlink_group")
+
+
+async def get_groups(owner):
+    names = sorted(await redis.smembers(keyspace.user(owner, "groups")))
+    pipe = redis.pipeline(transaction=False)
+    for name in names:
+        pipe.smembers(groups.members_key(owner, name))
+    return groups.build_groups(names, await pipe.execute() if names else [])
+
+
+async def check_members(owner, members):
+    taken = await async_db.usernames_taken(members) if members else []
+    return groups.first_invalid_member(owner, members, taken)
+
+
+async def save(owner, name, members):
+    current = await redis.smembers(groups.members_key(owner, name))
+    pipe = redis.pipeline(transaction=False)
+    groups.queue_save(pipe, owner, name, current, members)
+    await pipe.execute()
+
+
+async def delete(owner, name, batch_size=500):
+    if not await redis.srem(keyspace.user(owner, "groups"), name):
+        return False
+
+    group_id = keyspace.group_id(owner, name)
+    members = await redis.smembers(groups.members_key(owner, name))
+    pipe = redis.pipeline(transaction=False)
+    groups.queue_delete_members(pipe, owner, name, members)
+    await pipe.execute()
+
+    while True:
+        popped = await redis.zpopmin(keyspace.group(group_id, "notes"), batch_size)
+        if not popped:
+            return True
+        await unlink_notes(group_id, [note_id for note_id, _ in popped])
+
+
+async def unlink_notes(group_id, note_ids):
+    pipe = redis.pipeline(transaction=False)
+    for note_id in note_ids:
+        pipe.get(keyspace.note(note_id, "tokens"))
+    index_keys = groups.group_index_keys(group_id, await pipe.execute())
+
+    for note_id in note_ids:
+        await unlink_script(keys=[keyspace.note(note_id, "content")], args=[group_id],
+                            client=pipe)
+    for key in index_keys:
+        pipe.unlink(key)
+    await pipe.execute()
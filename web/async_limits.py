@@ -0,0 +1,19 @@
+import async_db
+import limits
+
+
+redis = async_db.redis
+
+limit_script = async_db.load_script("rate_limit")
+
+
+async def check(action, **subjects):
+    checks = limits.limit_checks(action, subjects)
+    if len(checks) > 1:
+        pipe = redis.pipeline(transaction=False)
+        for keys, args in checks:
+            await limit_script(keys=keys, args=args, client=pipe)
+        waits = await pipe.execute()
+    else:
+        waits = [await limit_script(keys=keys, args=args) for keys, args in checks]
+    limits.raise_limited(waits)
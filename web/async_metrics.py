@@ -0,0 +1,73 @@
+from redis.asyncio import Redis, RedisCluster
+from redis.asyncio.client import Pipeline
+from redis.asyncio.cluster import ClusterPipeline
+from time import perf_counter
+import metrics
+
+
+class InstrumentedAsyncRedis(Redis):
+    async def execute_command(self, *args, **options):
+        start = perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.record_round_trip([args[0]], perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedAsyncPipeline(Pipeline):
+    async def execute(self, raise_on_error=True):
+        commands = [args[0] for args, _ in self.command_stack]
+        start = perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            if commands:
+                metrics.record_round_trip(commands, perf_counter() - start)
+
+
+class InstrumentedAsyncRedisCluster(RedisCluster):
+    async def execute_command(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return await super().execute_command(*args, **kwargs)
+        finally:
+            metrics.record_round_trip([args[0]], perf_counter() - start)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return InstrumentedAsyncClusterPipeline(self, transaction)
+
+
+class InstrumentedAsyncClusterPipeline(ClusterPipeline):
+    def __init__(self, client, transaction=None):
+        super().__init__(client, transaction)
+        self.staged = []
+
+    def execute_command(self, *args, **kwargs):
+        self.staged.append(args[0])
+        return super().execute_command(*args, **kwargs)
+
+    async def execute(self, raise_on_error=True, allow_redirections=True):
+        commands, self.staged = self.staged, []
+        start = perf_counter()
+        try:
+            return await super().execute(raise_on_error, allow_redirections)
+        finally:
+            if commands:
+                metrics.record_round_trip(commands, perf_counter() - start)
+
+
+async def flush(client, interval=0):
+    values = metrics.take_pending(interval)
+    if values:
+        pipe = client.pipeline(transaction=False)
+        metrics.queue_flush(pipe, values)
+        await pipe.execute()
+
+
+async def render(client):
+    await flush(client)
+    return metrics.render_values(await client.hgetall("metrics"))
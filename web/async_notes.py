@@ -0,0 +1,348 @@
+from datetime import datetime
+from redis.exceptions import RedisError
+import asyncio
+import secrets
+import pytz
+import async_db
+import notes
+import utils
+import config
+import keyspace
+
+
+redis = async_db.redis
+
+page_script = async_db.load_script("page")
+create_script = async_db.load_script("create_note")
+delete_script = async_db.load_script("delete_note")
+create_content_script = async_db.load_script("create_note_content")
+delete_content_script = async_db.load_script("delete_note_content")
+encode_script = async_db.load_script("encode_note")
+store_blob_script = async_db.load_script("store_blob")
+release_blob_script = async_db.load_script("release_blob")
+edit_script = async_db.load_script("edit_note")
+edit_content_script = async_db.load_script("edit_note_content")
+
+sweeper = None
+
+
+async def create(author, title, content, readers, public, expires=None):
+    return (await create_many(author, [(title, content, readers, public, expires)]))[0]
+
+
+async def create_many(author, new_notes):
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    pipe = body_pipeline()
+    prepared = [await prepare(pipe, timestamp, *new_note) for new_note in new_notes]
+    if keyspace.cluster:
+        names = [(readers, groups) for *_, readers, groups in prepared]
+        taken, owned = await lookup_reader_names(author, names)
+        prepared = [(*note,
+                     notes.linked_readers(author, readers, [taken[user] for user in readers]),
+                     notes.linked_groups(author, groups, [owned[name] for name in groups]))
+                    for *note, readers, groups in prepared]
+
+    note_ids = [None] * len(prepared)
+    pending = list(range(len(prepared)))
+    while pending:
+        for index in pending:
+            note_ids[index] = secrets.token_urlsafe(32)
+            await queue_create(pipe, note_ids[index], author, prepared[index])
+        created = (await pipe.execute())[-len(pending):]
+        pending = [index for index, ok in zip(pending, created) if not ok]
+
+    if keyspace.cluster and prepared:
+        for note_id, note in zip(note_ids, prepared):
+            _, _, _, timestamp, public, expires, tokens, readers, groups = note
+            notes.queue_links(pipe, note_id, author, timestamp, public, expires, tokens,
+                              readers, groups)
+        await pipe.execute()
+    return note_ids
+
+
+async def prepare(pipe, timestamp, title, content, readers, public, expires=None):
+    expires = timestamp + expires if expires else ""
+    readers, groups = ([], []) if public else notes.split_readers(notes.parse_readers(readers))
+    tokens = utils.tokenize(f"{title} {content}")
+    content, encoding = await store_body(content, pipe)
+    return title, content, encoding, timestamp, public, expires, tokens, readers, groups
+
+
+async def queue_create(pipe, note_id, author, note):
+    if keyspace.cluster:
+        await create_content_script(keys=notes.note_keys(note_id),
+                                    args=notes.content_args(author, *note), client=pipe)
+    else:
+        await create_script(keys=notes.create_keys(note_id, author),
+                            args=notes.create_args(note_id, author, *note), client=pipe)
+
+
+async def delete(note_id):
+    if not note_id:
+        return False
+
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    if keyspace.cluster:
+        removed = await delete_content_script(keys=notes.all_note_keys(note_id))
+        if not removed:
+            return False
+
+        pipe = redis.pipeline(transaction=False)
+        await queue_release(pipe, note_id, removed, timestamp)
+        await pipe.execute()
+        return True
+
+    return bool(await delete_script(
+        keys=notes.delete_keys(note_id), args=[note_id, timestamp]))
+
+
+async def queue_release(pipe, note_id, removed, timestamp):
+    notes.queue_unlinks(pipe, note_id, removed, timestamp)
+    if removed[4]:
+        await release_blob_script(keys=[keyspace.blob(removed[4])], client=pipe)
+
+
+async def edit(note, title, content):
+    if title == note["title"] and content == note["content"]:
+        return True
+
+    note_id = note["id"]
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    tokens = utils.tokenize(f"{title} {content}")
+    entry = notes.history_entry(note, title, content)
+    pipe = body_pipeline()
+    stored, encoding = await store_body(content, pipe)
+    args = notes.edit_args(note, title, stored, encoding, timestamp, entry, tokens)
+
+    if keyspace.cluster:
+        if encoding == notes.BLOB:
+            await pipe.execute()
+        edited = await edit_content_script(keys=notes.all_note_keys(note_id), args=args)
+        if edited:
+            pipe = redis.pipeline(transaction=False)
+            notes.queue_reindex(pipe, note_id, edited, tokens, timestamp)
+            if edited[4]:
+                await release_blob_script(keys=[keyspace.blob(edited[4])], client=pipe)
+            await pipe.execute()
+    else:
+        await edit_script(keys=[*notes.all_note_keys(note_id), "public-notes:version"],
+                          args=[note_id, *args], client=pipe)
+        edited = (await pipe.execute())[-1]
+
+    if not edited and encoding == notes.BLOB:
+        await release_blob_script(keys=[keyspace.blob(stored)])
+    return bool(edited)
+
+
+async def get_history(note, limit=None):
+    limit = limit or config.settings.note_history_depth
+    if limit < 1:
+        return []
+    entries = await redis.lrange(keyspace.note(note["id"], "history"), 0, limit - 1)
+    return notes.build_history(note, entries)
+
+
+async def delete_many(note_ids):
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    pipe = redis.pipeline(transaction=False)
+    if keyspace.cluster:
+        for note_id in note_ids:
+            await delete_content_script(keys=notes.all_note_keys(note_id), client=pipe)
+        removed = await pipe.execute() if note_ids else []
+        for note_id, note_removed in zip(note_ids, removed):
+            if note_removed:
+                await queue_release(pipe, note_id, note_removed, timestamp)
+        if any(removed):
+            await pipe.execute()
+        return [bool(note_removed) for note_removed in removed]
+
+    for note_id in note_ids:
+        await delete_script(keys=notes.delete_keys(note_id), args=[note_id, timestamp],
+                            client=pipe)
+    return [bool(deleted) for deleted in (await pipe.execute() if note_ids else [])]
+
+
+async def sweep_expired(limit=None):
+    limit = limit or config.settings.expired_sweep_batch
+    pipe = redis.pipeline(transaction=False)
+    notes.queue_expired(pipe, limit)
+    note_ids = [note_id for ids in await pipe.execute() for note_id in ids][:limit]
+    if not note_ids:
+        return 0
+
+    for note_id, deleted in zip(note_ids, await delete_many(note_ids)):
+        if not deleted:
+            pipe.zrem(keyspace.shard_for("expiring-notes", note_id), note_id)
+    await pipe.execute()
+    return len(note_ids)
+
+
+async def public_cache_seconds():
+    now = int(datetime.now(pytz.utc).timestamp())
+    pipe = redis.pipeline(transaction=False)
+    notes.queue_next_expiry(pipe, now)
+    return notes.cache_seconds(await pipe.execute(), now)
+
+
+async def sweep_all(batch_size=None):
+    batch_size = batch_size or config.settings.expired_sweep_batch
+    count = 0
+    while True:
+        swept = await sweep_expired(batch_size)
+        count += swept
+        if swept < batch_size:
+            return count
+
+
+def start_sweeper():
+    global sweeper
+    if sweeper is None and config.settings.expired_sweep_seconds:
+        sweeper = asyncio.create_task(run_sweeper())
+
+
+async def stop_sweeper():
+    global sweeper
+    if sweeper is not None:
+        sweeper.cancel()
+        sweeper = None
+
+
+async def run_sweeper():
+    global sweeper
+    while config.settings.expired_sweep_seconds:
+        await asyncio.sleep(config.settings.expired_sweep_seconds)
+        try:
+            await sweep_all()
+        except RedisError as e:
+            print(f"Expired notes sweep failed: {e}", flush=True)
+    sweeper = None
+
+
+async def get(note_id):
+    found = await get_many([note_id])
+    return found[0] if found else {}
+
+
+async def get_many(note_ids):
+    if not note_ids:
+        return []
+
+    pipe = redis.pipeline(transaction=False)
+    notes.queue_reads(pipe, note_ids)
+    results = await pipe.execute()
+    await resolve_blobs(results[0::2])
+
+    rewrites = notes.reencodings(note_ids, results)
+    if rewrites:
+        pipe = redis.pipeline(transaction=False)
+        for keys, args in rewrites:
+            await encode_script(keys=keys, args=args, client=pipe)
+        await pipe.execute()
+    return notes.build_many(note_ids, results)
+
+
+def body_pipeline():
+    return redis.pipeline(transaction=not keyspace.cluster)
+
+
+async def store_body(content, client=None):
+    stored, encoding = notes.encode_content(content)
+    digest = notes.body_digest(content)
+    if not digest:
+        return stored, encoding
+
+    await store_blob_script(keys=[keyspace.blob(digest)], args=[stored, encoding],
+                            client=client)
+    return digest, notes.BLOB
+
+
+async def resolve_blobs(stored):
+    found = notes.blob_notes(stored)
+    if found:
+        pipe = redis.pipeline(transaction=False)
+        notes.queue_blob_reads(pipe, found)
+        notes.fill_blobs(found, await pipe.execute())
+
+
+async def iter_many(note_ids, batch_size=None):
+    batch_size = batch_size or config.settings.notes_stream_batch_size
+    for start in range(0, len(note_ids), batch_size):
+        for note in await get_many(note_ids[start:start + batch_size]):
+            yield note
+
+
+async def check_readers(readers, author):
+    return (await check_readers_many(author, [readers]))[0]
+
+
+async def check_readers_many(author, readers_list):
+    names = [notes.split_readers(notes.parse_readers(readers)) for readers in readers_list]
+    taken, owned = await lookup_reader_names(author, names)
+    return [notes.first_invalid_reader(users, groups, [taken[user] for user in users],
+                                       [owned[name] for name in groups])
+            for users, groups in names]
+
+
+async def lookup_reader_names(author, names):
+    users, groups = notes.unique_reader_names(names)
+    taken, owned = await check_reader_names(author, users, groups)
+    return dict(zip(users, taken)), dict(zip(groups, owned))
+
+
+async def check_reader_names(author, users, groups):
+    pipe = redis.pipeline(transaction=False)
+    shards = notes.queue_reader_names(pipe, author, users, groups)
+    results = await pipe.execute() if users or groups else []
+    return notes.collect_reader_names(users, groups, shards, results)
+
+
+async def get_page_ids(key, cursor=None, limit=None):
+    limit = limit or config.settings.notes_page_size
+    page = await page_script(keys=notes.page_keys(key), args=notes.page_args(cursor, limit))
+    return notes.parse_page(page, limit)
+
+
+async def get_merged_page_ids(keys, cursor=None, limit=None):
+    limit = limit or config.settings.notes_page_size
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        await page_script(keys=notes.page_keys(key), args=notes.page_args(cursor, limit),
+                          client=pipe)
+    return notes.merge_pages(await pipe.execute(), limit)
+
+
+async def get_page(key, cursor=None, limit=None, lazy=False):
+    ids, next_cursor = await get_page_ids(key, cursor, limit)
+    return await load(ids, lazy), next_cursor
+
+
+async def load(note_ids, lazy=False):
+    return iter_many(note_ids) if lazy else await get_many(note_ids)
+
+
+async def get_my_notes(username, cursor=None, lazy=False, limit=None):
+    return await get_page(keyspace.user(username, "notes"), cursor, limit, lazy)
+
+
+async def get_public(cursor=None, lazy=False, limit=None):
+    keys = keyspace.shards("public-notes")
+    ids, next_cursor = await get_merged_page_ids(keys, cursor, limit)
+    return await load(ids, lazy), next_cursor
+
+
+async def get_shared(username, cursor=None, lazy=False, limit=None):
+    keys = notes.shared_keys(username, await get_memberships(username))
+    ids, next_cursor = await get_merged_page_ids(keys, cursor, limit)
+    return await load(ids, lazy), next_cursor
+
+
+async def get_readable(note_ids, username):
+    found = await get_many(note_ids)
+    memberships = ()
+    if not all(notes.can_read(note, username, memberships) for note in found):
+        memberships = await get_memberships(username)
+    return [note for note in found if notes.can_read(note, username, memberships)]
+
+
+async def get_memberships(username):
+    return await redis.smembers(keyspace.user(username, "memberships"))
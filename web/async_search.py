@@ -0,0 +1,21 @@
+import async_db
+import async_notes
+import search
+import config
+
+
+redis = async_db.redis
+
+search_script = async_db.load_script("search")
+
+
+async def search_notes(username, query):
+    tokens = search.query_tokens(query)
+    if not tokens:
+        return []
+
+    groups = await async_notes.get_memberships(username) if username else []
+    pipe = redis.pipeline(transaction=False)
+    for keys in search.search_keys(username, tokens, groups):
+        await search_script(keys=keys, args=[config.settings.search_results_limit], client=pipe)
+    return await async_notes.get_many(search.merge(await pipe.execute()))
@@ -0,0 +1,67 @@
+import secrets
+import async_db
+import session
+import config
+import keyspace
+
+
+redis = async_db.redis
+
+
+async def get(id_):
+    if session.signed_mode():
+        username, issued = session.verify_fresh(id_)
+        if not username:
+            return {}
+        revoked = await redis.zscore("revoked-sessions", username)
+        return session.signed_session(username, issued, revoked)
+
+    data = await redis.hgetall(f"session:{id_}")
+    username = data.get("username")
+    if username:
+        await set_expiration(username, config.settings.session_expire_seconds, id_)
+    return data
+
+
+async def save(username, key="", value=""):
+    if session.signed_mode():
+        return session.sign(username, session.now_ms())
+
+    user_session_key = keyspace.user(username, "session")
+
+    id_ = await redis.hget(user_session_key, "id")
+    if not id_:
+        id_ = secrets.token_urlsafe(config.settings.session_token_bytes)
+        while await redis.exists(f"session:{id_}"):
+            id_ = secrets.token_urlsafe(config.settings.session_token_bytes)
+
+        pipe = redis.pipeline(transaction=False)
+        pipe.hset(user_session_key, "id", id_)
+        pipe.hset(f"session:{id_}", "username", username)
+        await pipe.execute()
+
+    await set_expiration(username, config.settings.session_expire_seconds, id_)
+
+    if key and key != username:
+        await redis.hset(f"session:{id_}", key, value)
+
+    return id_
+
+
+async def set_expiration(username, seconds, id_=None):
+    session_key = keyspace.user(username, "session")
+    id_ = id_ or await redis.hget(session_key, "id")
+    if id_:
+        pipe = redis.pipeline(transaction=False)
+        pipe.expire(f"session:{id_}", seconds)
+        pipe.expire(session_key, seconds)
+        await pipe.execute()
+
+
+async def clear(username):
+    if session.signed_mode():
+        pipe = redis.pipeline(transaction=False)
+        session.queue_revocation(pipe, username)
+        await pipe.execute()
+    else:
+        await set_expiration(username, 0)
@@ -0,0 +1,310 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from threading import Lock, Thread
+from urllib.parse import urlencode
+from os import environ
+import argparse
+import json
+import logging
+import string
+import sys
+import time
+
+import bcrypt
+import redis as redis_lib
+from redis.client import Pipeline
+
+
+ENDPOINTS = ["login", "new_note", "my_notes", "public_notes", "shared_notes"]
+PASSWORD = "Benchmark-Password-123!"
+
+
+class CommandCounter:
+    def __init__(self):
+        self.lock = Lock()
+        self.commands = 0
+        self.round_trips = 0
+
+    def add(self, commands):
+        with self.lock:
+            self.commands += commands
+            self.round_trips += 1
+
+    def snapshot(self):
+        with self.lock:
+            return self.commands, self.round_trips
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Seed a Redis database and benchmark NoteAtKey endpoints.")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15",
+                        help="Redis database to use (it is flushed before seeding)")
+    parser.add_argument("--fake", action="store_true",
+                        help="use an in-process fakeredis server instead of --redis-url")
+    parser.add_argument("--mode", choices=["wsgi", "http"], default="wsgi",
+                        help="drive the app in-process or through a local HTTP server")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--notes-per-user", type=int, default=20)
+    parser.add_argument("--readers-per-note", type=int, default=5)
+    parser.add_argument("--public-ratio", type=float, default=0.2)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4,
+                        help="cost of the seeded password hashes")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--save-baseline", help="write the report as a new baseline")
+    parser.add_argument("--compare", help="baseline to compare the report against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown before a comparison fails")
+    return parser.parse_args()
+
+
+def connect(args):
+    # db.py creates its client at import time, so the backend has to be
+    # chosen before the app modules are imported.
+    if args.fake:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("--fake requires fakeredis with Lua support: pip install 'fakeredis[lua]'")
+        redis_lib.Redis = fakeredis.FakeRedis
+        environ.pop("REDIS_URL", None)
+    else:
+        environ["REDIS_URL"] = args.redis_url
+    environ.setdefault("FLASH_SECRET", "benchmark")
+
+    global app, db, keyspace, notes, session
+    import app
+    import db
+    import keyspace
+    import notes
+    import session
+    return db.redis
+
+
+def instrument(client, counter):
+    execute_command = client.execute_command
+    pipeline_execute = Pipeline.execute
+
+    def counted_command(*args, **kwargs):
+        counter.add(1)
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(self, *args, **kwargs):
+        if self.command_stack:
+            counter.add(len(self.command_stack))
+        return pipeline_execute(self, *args, **kwargs)
+
+    client.execute_command = counted_command
+    Pipeline.execute = counted_pipeline
+
+
+def username(i):
+    name = ""
+    i += 26
+    while i:
+        i, rest = divmod(i, 26)
+        name = string.ascii_lowercase[rest] + name
+    return "bench" + name
+
+
+def seed(client, args):
+    client.flushdb()
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=args.bcrypt_rounds))
+    users = [username(i) for i in range(args.users)]
+
+    pipe = client.pipeline(transaction=False)
+    for user in users:
+        # Same layout as db.create_user, without paying for bcrypt per user.
+        pipe.hset(keyspace.user(user, "profile"), mapping={
+            "email": f"{user}@example.com", "password": hashed})
+        pipe.hset("emails", f"{user}@example.com", user)
+        pipe.sadd(keyspace.shard_for("users", user), user)
+    pipe.execute()
+
+    public_every = round(1 / args.public_ratio) if args.public_ratio > 0 else 0
+    for i, user in enumerate(users):
+        for j in range(args.notes_per_user):
+            public = public_every and j % public_every == 0
+            readers = ", ".join(users[(i + k + 1) % len(users)]
+                                for k in range(args.readers_per_note))
+            notes.create(user, f"Notatka {j}", f"Treść notatki {j} użytkownika {user}.\n" * 5,
+                         readers, bool(public))
+    return users
+
+
+def request_for(endpoint, user, sessions, i):
+    if endpoint == "login":
+        return "POST", "/login", {"username": user, "password": PASSWORD}, None
+    if endpoint == "new_note":
+        return "POST", "/new-note", {
+            "title": f"Benchmark {i}", "content": "Treść notatki.\n" * 10,
+            "readers": "", "public": "on"}, sessions[user]
+    path = {"my_notes": "/my-notes", "public_notes": "/public-notes",
+            "shared_notes": "/shared-notes"}[endpoint]
+    return "GET", path, None, sessions[user]
+
+
+def client_ip(i):
+    # Each seeded user sends from its own address, as it would behind a proxy.
+    return f"10.0.{i // 256 % 256}.{i % 256}"
+
+
+def wsgi_sender():
+    client = app.app.test_client()
+
+    def send(method, path, form, session_id, ip):
+        client.delete_cookie("session_id")
+        if session_id:
+            client.set_cookie("session_id", session_id)
+        response = client.open(path, method=method, data=form,
+                               environ_base={"REMOTE_ADDR": ip})
+        # Streamed pages only render while the body is read.
+        response.get_data()
+        response.close()
+        return response.status_code
+    return send
+
+
+def http_sender(port):
+    connection = HTTPConnection("127.0.0.1", port)
+
+    def send(method, path, form, session_id, ip):
+        body = urlencode(form) if form else None
+        headers = {"X-Forwarded-For": ip}
+        if session_id:
+            headers["Cookie"] = f"session_id={session_id}"
+        if body:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    return send
+
+
+def start_server():
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    # The benchmark stands in for a proxy that sets each user's address.
+    server = make_server("127.0.0.1", 0, ProxyFix(app.app, x_for=1), threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_endpoint(endpoint, args, users, sessions, counter, make_sender):
+    latencies = []
+    errors = 0
+    lock = Lock()
+
+    def worker(worker_id):
+        nonlocal errors
+        send = make_sender()
+        for i in range(worker_id, args.requests, args.concurrency):
+            method, path, form, session_id = request_for(
+                endpoint, users[i % len(users)], sessions, i)
+            start = time.perf_counter()
+            status = send(method, path, form, session_id, client_ip(i % len(users)))
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                errors += status >= 400 or (method == "GET" and status != 200)
+
+    commands, round_trips = counter.snapshot()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(worker, range(args.concurrency)))
+    duration = time.perf_counter() - start
+    commands_after, round_trips_after = counter.snapshot()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "commands_per_request": round((commands_after - commands) / len(latencies), 2),
+        "round_trips_per_request": round((round_trips_after - round_trips) / len(latencies), 2)
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def print_report(report):
+    columns = ["requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms",
+               "commands_per_request", "round_trips_per_request"]
+    print(f"{'endpoint':<14}" + "".join(f"{column:>24}" for column in columns))
+    for endpoint, result in report["endpoints"].items():
+        print(f"{endpoint:<14}" + "".join(f"{result[column]:>24}" for column in columns))
+
+
+def compare(report, baseline, tolerance):
+    failures = []
+    for endpoint, result in report["endpoints"].items():
+        base = baseline["endpoints"].get(endpoint)
+        if not base:
+            continue
+        for metric in ["p95_ms", "commands_per_request", "round_trips_per_request"]:
+            limit = base[metric] * (1 + tolerance)
+            if result[metric] > limit and result[metric] - base[metric] > 0.01:
+                failures.append(
+                    f"{endpoint}: {metric} {result[metric]} > {base[metric]} (+{tolerance:.0%})")
+    return failures
+
+
+def main():
+    args = parse_args()
+    client = connect(args)
+    counter = CommandCounter()
+
+    print("Seeding...", flush=True)
+    users = seed(client, args)
+    sessions = {user: session.save(user) for user in users}
+    instrument(client, counter)
+
+    server = None
+    if args.mode == "http":
+        server = start_server()
+        make_sender = lambda: http_sender(server.server_port)
+    else:
+        make_sender = wsgi_sender
+
+    report = {
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("json", "save_baseline", "compare")},
+        "endpoints": {}
+    }
+    for endpoint in args.endpoints.split(","):
+        report["endpoints"][endpoint] = run_endpoint(
+            endpoint, args, users, sessions, counter, make_sender)
+
+    if server:
+        server.shutdown()
+
+    print_report(report)
+    for path in filter(None, [args.json, args.save_baseline]):
+        with open(path, "w") as file:
+            json.dump(report, file, indent=4)
+
+    if args.compare:
+        with open(args.compare) as file:
+            failures = compare(report, json.load(file), args.tolerance)
+        for failure in failures:
+            print("REGRESSION " + failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+from threading import Lock
+import hashlib
+import math
+import mmap
+import os
+import struct
+import config
+
+
+MAGIC = b"NAKBLOOM"
+HEADER = struct.Struct("<8sBQI")
+PLAIN, SHA1 = 0, 1
+
+filters = {}
+filters_lock = Lock()
+
+
+class BloomFilter:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                raise ValueError(f"{path} is empty.")
+            # The mapping is shared through the page cache by every process
+            # that opens the same file, so workers hold no private copy.
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        size = len(self.map)
+        magic, self.mode, self.bits, self.hashes = \
+            HEADER.unpack_from(self.map) if size >= HEADER.size else (b"", PLAIN, 0, 0)
+        error = header_error(magic, self.mode, self.bits, self.hashes, size)
+        if error:
+            self.map.close()
+            raise ValueError(f"{path} {error}.")
+
+    def __contains__(self, password):
+        bitmap = self.map
+        for index in indexes(key(password, self.mode), self.bits, self.hashes):
+            if not bitmap[HEADER.size + (index >> 3)] & (1 << (index & 7)):
+                return False
+        return True
+
+
+def header_error(magic, mode, bits, hashes, size):
+    # A zero bit count would divide by zero on every lookup and zero hashes
+    # would report every password as breached, so both are caught on load.
+    if magic != MAGIC:
+        return "is not a password filter"
+    if mode not in (PLAIN, SHA1):
+        return f"has an unknown key mode {mode}"
+    if bits == 0 or bits % 8:
+        return f"has an invalid size of {bits} bits"
+    if hashes == 0:
+        return "has no hash functions"
+    if size != HEADER.size + bits // 8:
+        return f"is {size} bytes long, expected {HEADER.size + bits // 8} for {bits} bits"
+    return None
+
+
+def key(password, mode):
+    secret = password.encode()
+    return hashlib.sha1(secret).digest() if mode == SHA1 else secret
+
+
+def indexes(value, bits, hashes):
+    digest = hashlib.blake2b(value, digest_size=16).digest()
+    first, second = struct.unpack("<QQ", digest)
+    second |= 1
+    return ((first + i * second) % bits for i in range(hashes))
+
+
+def get_filter():
+    path = config.settings.breached_passwords_filter
+    if not path:
+        return None
+
+    with filters_lock:
+        if path not in filters:
+            try:
+                filters[path] = BloomFilter(path)
+            except (OSError, ValueError) as e:
+                print(f"Breached password filter disabled: {e}", flush=True)
+                filters[path] = None
+        return filters[path]
+
+
+def is_breached(password):
+    bloom = get_filter()
+    return bloom is not None and password in bloom
+
+
+def parse_corpus_line(line, mode):
+    line = line.rstrip(b"\r\n")
+    if not line:
+        return None
+    if mode == SHA1:
+        return bytes.fromhex(line[:40].decode())
+    return line
+
+
+def build(corpus_path, output_path, error_rate=0.001, mode=PLAIN):
+    with open(corpus_path, "rb") as corpus:
+        count = sum(1 for line in corpus if line.rstrip(b"\r\n"))
+
+    bits = max(8, math.ceil(-count * math.log(error_rate) / math.log(2) ** 2))
+    bits += -bits % 8
+    hashes = max(1, round(bits / max(count, 1) * math.log(2)))
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, mode, bits, hashes))
+        file.truncate(HEADER.size + bits // 8)
+
+    with open(tmp_path, "r+b") as file, open(corpus_path, "rb") as corpus:
+        bitmap = mmap.mmap(file.fileno(), 0)
+        for line in corpus:
+            value = parse_corpus_line(line, mode)
+            if value is None:
+                continue
+            for index in indexes(value, bits, hashes):
+                bitmap[HEADER.size + (index >> 3)] |= 1 << (index & 7)
+        bitmap.flush()
+        bitmap.close()
+
+    # Workers that already mapped the old file keep using it until restart.
+    os.replace(tmp_path, output_path)
+    return {"entries": count, "bytes": HEADER.size + bits // 8, "hashes": hashes}
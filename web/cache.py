@@ -0,0 +1,37 @@
+from datetime import datetime
+import hashlib
+import pytz
+import db
+import config
+
+
+redis = db.redis
+
+
+def get_version(name):
+    version, modified = redis.hmget(f"{name}:version", "version", "modified")
+    if modified:
+        modified = datetime.fromtimestamp(int(modified), tz=pytz.utc)
+    return int(version or 0), modified
+
+
+def etag(name, version, *variant):
+    key = ":".join([name, str(version), *variant])
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def get(name, version, variant=""):
+    return redis.get(f"cache:{name}:{version}:{variant}")
+
+
+def set(name, version, variant, value, seconds=None):
+    redis.set(f"cache:{name}:{version}:{variant}", value,
+              ex=seconds or config.settings.page_cache_seconds)
+
+
+def set_streamed(name, version, variant, chunks, seconds=None):
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    set(name, version, variant, "".join(rendered), seconds)
@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta
+import click
+import json
+import pytz
+import breached
+import db
+import notes
+import search
+import security
+import transfer
+
+
+@click.command("index-emails")
+def index_emails_command():
+    count = db.index_emails()
+    click.echo(f"Indexed {count} email addresses.")
+
+
+@click.command("migrate-timelines")
+def migrate_timelines_command():
+    count = notes.migrate_timelines()
+    click.echo(f"Migrated {count} note timelines to sorted sets.")
+
+
+@click.command("rebuild-search")
+def rebuild_search_command():
+    count = search.rebuild()
+    click.echo(f"Indexed {count} notes for search.")
+
+
+@click.command("migrate-keys")
+def migrate_keys_command():
+    count = db.migrate_key_layout()
+    click.echo(f"Moved {count} keys to the configured key layout.")
+
+
+@click.command("migrate-login-attempts")
+def migrate_login_attempts_command():
+    count = db.migrate_login_attempts()
+    click.echo(f"Moved the login attempts of {count} users to streams.")
+
+
+@click.command("failed-logins")
+@click.option("--minutes", default=60, show_default=True)
+def failed_logins_command(minutes):
+    since = datetime.now(pytz.utc) - timedelta(minutes=minutes)
+    for attempt in security.get_failed_logins(since):
+        echo_failed_login(attempt)
+
+
+@click.command("watch-failed-logins")
+@click.option("--group", default="security", show_default=True)
+@click.option("--consumer", default="consumer-1", show_default=True)
+def watch_failed_logins_command(group, consumer):
+    for attempt in security.tail_failed_logins(group, consumer):
+        echo_failed_login(attempt)
+
+
+def echo_failed_login(attempt):
+    attempt["datetime"] = attempt["datetime"].isoformat()
+    click.echo(json.dumps(attempt))
+
+
+@click.command("build-password-filter")
+@click.argument("corpus")
+@click.argument("output")
+@click.option("--error-rate", default=0.001, show_default=True)
+@click.option("--sha1", is_flag=True, help="Corpus lines are SHA-1 hashes (hash[:count]).")
+def build_password_filter_command(corpus, output, error_rate, sha1):
+    result = breached.build(corpus, output, error_rate, breached.SHA1 if sha1 else breached.PLAIN)
+    click.echo(f"Stored {result['entries']} passwords in {result['bytes']} bytes "
+               f"({result['hashes']} hashes per password).")
+
+
+@click.command("sweep-expired")
+@click.option("--batch-size", default=500, show_default=True)
+def sweep_expired_command(batch_size):
+    count = notes.sweep_all(batch_size)
+    click.echo(f"Removed {count} expired notes.")
+
+
+@click.command("encode-notes")
+def encode_notes_command():
+    count = notes.encode_notes()
+    click.echo(f"Rewrote {count} notes to the configured storage encoding.")
+
+
+@click.command("compression-report")
+def compression_report_command():
+    report = notes.compression_report()
+    if not report["bodies"]:
+        click.echo("No notes found.")
+        return
+
+    per_1k = 1000 / report["bodies"]
+    saved = report["raw_bytes"] - report["stored_bytes"]
+    possible = report["raw_bytes"] - report["compressible_bytes"]
+    click.echo(f"Stored bodies: {report['bodies']} ({report['compressed']} compressed, "
+               f"{report['shared']} shared)")
+    click.echo(f"Content: {report['raw_bytes']} B raw, {report['stored_bytes']} B stored")
+    click.echo(f"Saved per 1k bodies: {saved * per_1k / 1024:.1f} KiB")
+    click.echo(f"Saved per 1k bodies with every body compressed: "
+               f"{possible * per_1k / 1024:.1f} KiB")
+
+
+@click.command("dedup-report")
+def dedup_report_command():
+    report = notes.dedup_report()
+    if not report["blobs"]:
+        click.echo("No shared note bodies found.")
+        return
+
+    saved = report["referenced_bytes"] - report["stored_bytes"]
+    click.echo(f"Blobs: {report['blobs']} referenced by {report['references']} notes "
+               f"(dedup ratio {report['references'] / report['blobs']:.2f})")
+    click.echo(f"Content: {report['referenced_bytes']} B referenced, "
+               f"{report['stored_bytes']} B stored")
+    click.echo(f"Saved: {saved / 1024:.1f} KiB")
+
+
+@click.command("export")
+@click.argument("path")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--resume", is_flag=True, help="Continue an interrupted export.")
+def export_command(path, batch_size, resume):
+    counts = transfer.export(path, batch_size, resume)
+    click.echo(f"Exported {counts['users']} users and {counts['notes']} notes to {path}.")
+
+
+@click.command("import")
+@click.argument("path")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--resume", is_flag=True, help="Continue an interrupted import.")
+def import_command(path, batch_size, resume):
+    counts = transfer.import_(path, batch_size, resume)
+    click.echo(f"Imported {counts['users']} users and {counts['notes']} notes from {path}.")
+
+
+commands = [
+    index_emails_command,
+    migrate_timelines_command,
+    rebuild_search_command,
+    migrate_keys_command,
+    build_password_filter_command,
+    migrate_login_attempts_command,
+    failed_logins_command,
+    watch_failed_logins_command,
+    sweep_expired_command,
+    encode_notes_command,
+    compression_report_command,
+    dedup_report_command,
+    export_command,
+    import_command
+]
@@ -0,0 +1,113 @@
+from typing import NamedTuple
+import signal
+import sys
+import yaml
+
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class Settings(NamedTuple):
+    login_attempts_history_length: int
+    login_attempts_check_minutes: int
+    next_login_seconds_per_attempt: int
+    password_reset_token_bytes: int
+    api_token_bytes: int
+    min_password_bits: int
+    breached_passwords_filter: str
+    bcrypt_rounds: int
+    bcrypt_workers: int
+    bcrypt_queue_length: int
+    failed_logins_stream_length: int
+
+    register_ip_limit: int
+    register_limit_seconds: int
+    login_ip_limit: int
+    login_account_limit: int
+    login_limit_seconds: int
+    reset_ip_limit: int
+    reset_account_limit: int
+    reset_limit_seconds: int
+    trusted_proxies: int
+
+    session_mode: str
+    session_token_bytes: int
+    session_expire_seconds: int
+
+    max_note_lines: int
+    max_note_length: int
+    max_note_title_length: int
+    max_note_readers_length: int
+    max_group_members: int
+    notes_page_size: int
+    notes_stream_batch_size: int
+    page_cache_seconds: int
+    note_compression: bool
+    note_compression_min_bytes: int
+    note_dedup: bool
+    note_dedup_min_bytes: int
+    expired_sweep_seconds: float
+    expired_sweep_batch: int
+    note_history_depth: int
+    api_batch_size: int
+
+    search_results_limit: int
+    search_max_terms: int
+
+    metrics_flush_seconds: float
+    slow_request_ms: float
+
+    redis_cluster: bool
+    redis_max_connections: int
+    key_shards: int
+
+
+class ConfigError(Exception):
+    pass
+
+
+def load(path="config.yaml"):
+    with open(path) as file:
+        data = yaml.load(file, Loader=Loader) or {}
+
+    values = {}
+    for key, type_ in Settings.__annotations__.items():
+        value = data.get(key)
+        if value is None:
+            raise ConfigError(f"No argument in {path}: {key}.")
+        if type_ is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if not isinstance(value, type_) or (type_ is not bool and isinstance(value, bool)):
+            raise ConfigError(f"Invalid argument in {path}: {key} must be {type_.__name__}.")
+        values[key] = value
+
+    if values["session_mode"] not in ("redis", "signed"):
+        raise ConfigError(f"Invalid argument in {path}: session_mode must be redis or signed.")
+    if values["trusted_proxies"] < 0:
+        raise ConfigError(f"Invalid argument in {path}: trusted_proxies must not be negative.")
+    if values["key_shards"] < 1:
+        raise ConfigError(f"Invalid argument in {path}: key_shards must be at least 1.")
+    return Settings(**values)
+
+
+def reload(signum=None, frame=None):
+    global settings
+    try:
+        settings = load()
+    except (ConfigError, OSError, yaml.YAMLError) as e:
+        print(f"Config reload failed, keeping previous settings: {e}", flush=True)
+
+
+def reload_on_signal(signum=getattr(signal, "SIGHUP", None)):
+    # Handlers can only be installed from the main thread.
+    try:
+        signal.signal(signum, reload)
+    except (TypeError, ValueError):
+        pass
+
+
+try:
+    settings = load()
+except ConfigError as e:
+    print(e, flush=True)
+    sys.exit(4)
@@ -1,33 +1,143 @@
-from redis import Redis
-from os import getenv
+from metrics import InstrumentedRedis, InstrumentedRedisCluster
+from os import getenv, cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, RLock
+from time import perf_counter
 from dotenv import load_dotenv
-from datetime import datetime, timedelta, timezone
-from yaml import safe_load
-import bcrypt
+from datetime import datetime, timezone
+import multiprocessing
+import hashlib
 import secrets
 import pytz
+import metrics
+import hashing
 import utils
+import config
+import keyspace
+
+
+def connect(client_class, cluster_class):
+    options = {"decode_responses": True}
+    if config.settings.redis_max_connections:
+        options["max_connections"] = config.settings.redis_max_connections
+
+    url = getenv("REDIS_URL")
+    if keyspace.cluster:
+        return cluster_class.from_url(url, **options) if url else \
+            cluster_class(host="redis", **options)
+    return client_class.from_url(url, **options) if url else client_class(host="redis", **options)
 
 
 load_dotenv()
-cloud_url = getenv("REDIS_URL")
-redis = Redis.from_url(cloud_url, decode_responses=True) if cloud_url else Redis(
-    host="redis", decode_responses=True)
+redis = connect(InstrumentedRedis, InstrumentedRedisCluster)
+
+
+hash_executor = None
+hash_slots = None
+hash_lock = RLock()
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def read_script(name):
+    with open(f"lua/{name}.lua") as file:
+        return file.read()
+
+
+def load_script(name):
+    script = read_script(name)
+    if keyspace.cluster:
+        # Scripts queued in cluster pipelines are not loaded on demand.
+        redis.script_load(script)
+    return redis.register_script(script)
+
+
+def set_hash_executor(executor, max_pending=None):
+    global hash_executor, hash_slots
+    with hash_lock:
+        hash_executor = executor
+        hash_slots = BoundedSemaphore(max_pending) if max_pending else None
+
+
+def get_hash_executor():
+    with hash_lock:
+        if hash_executor is None:
+            workers = hash_workers()
+            # The pool is started from a request thread, and forking a
+            # multithreaded process can leave locks held in the children.
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["hashing"])
+            set_hash_executor(ProcessPoolExecutor(max_workers=workers, mp_context=context),
+                              workers + config.settings.bcrypt_queue_length)
+        return hash_executor
+
+
+def hash_workers():
+    if config.settings.bcrypt_workers:
+        return config.settings.bcrypt_workers
+    # Every web worker has its own pool, so they share the cores.
+    web_workers = int(getenv("WEB_CONCURRENCY") or 1)
+    return max((cpu_count() or 1) // max(web_workers, 1), 1)
+
+
+def submit_hashing(function, *args):
+    executor = get_hash_executor()
+    slots = hash_slots
+
+    if slots and not slots.acquire(blocking=False):
+        raise HashingBusy()
+
+    try:
+        future = executor.submit(function, *args)
+    except BrokenProcessPool:
+        if slots:
+            slots.release()
+        with hash_lock:
+            if hash_executor is executor:
+                set_hash_executor(None)
+        executor.shutdown(wait=False)
+        raise HashingBusy()
 
-config = safe_load(open("config.yaml"))
+    if slots:
+        future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def run_hashing(function, *args):
+    start = perf_counter()
+    result = submit_hashing(function, *args).result()
+    metrics.observe("bcrypt_seconds", perf_counter() - start,
+                    operation=function.__name__)
+    return result
+
+
+def hash_secret(secret):
+    return run_hashing(hashing.bcrypt_hash, secret.encode(), config.settings.bcrypt_rounds)
+
+
+def check_secret(secret, hashed):
+    return run_hashing(hashing.bcrypt_check, secret.encode(), hashed.encode())
+
+
+login_delay_script = load_script("login_delay")
 
 
 def create_user(username, email, password):
-    key = f"user:{username}:profile"
+    key = keyspace.user(username, "profile")
     if username_taken(username) or email_taken(email):
         return False
 
-    hashed_password = bcrypt.hashpw(
-        password.encode(), bcrypt.gensalt(rounds=config["bcrypt_rounds"]))
+    hashed_password = hash_secret(password)
+
+    if not redis.hsetnx("emails", email, username):
+        return False
 
     redis.hset(key, "email", email)
     redis.hset(key, "password", hashed_password)
-    redis.sadd("users", username)
+    redis.sadd(keyspace.shard_for("users", username), username)
     return True
 
 
@@ -35,9 +145,10 @@ def get_user_data(username):
     if not username_taken(username):
         return {}
 
-    data = redis.hgetall(f"user:{username}:profile")
+    data = redis.hgetall(keyspace.user(username, "profile"))
     data["username"] = username
     data.pop("password", None)
+    data["api_token"] = bool(data.get("api_token"))
     data["login_attempts"] = get_login_attempts_localized(username)
     return data
 
@@ -46,46 +157,253 @@ def check_credentials(username, password):
     if not username_taken(username):
         return False
 
-    hashed_password = redis.hget(f"user:{username}:profile", "password")
-    return bcrypt.checkpw(password.encode(), hashed_password.encode())
+    hashed_password = redis.hget(keyspace.user(username, "profile"), "password")
+    return check_secret(password, hashed_password)
 
 
 def username_taken(username):
-    return redis.sismember("users", username)
+    return redis.sismember(keyspace.shard_for("users", username), username)
+
+
+def usernames_taken(usernames):
+    pipe = redis.pipeline(transaction=False)
+    groups = queue_usernames_taken(pipe, usernames)
+    return collect_usernames_taken(usernames, groups, pipe.execute() if groups else [])
+
+
+def queue_usernames_taken(pipe, usernames):
+    groups = keyspace.group_by_shard("users", usernames)
+    for key, members in groups.items():
+        pipe.smismember(key, members)
+    return groups
+
+
+def collect_usernames_taken(usernames, groups, results):
+    taken = {}
+    for members, result in zip(groups.values(), results):
+        taken.update(zip(members, result))
+    return [bool(taken.get(username)) for username in usernames]
 
 
 def email_taken(email):
-    for user in redis.smembers("users"):
-        key = f"user:{user}:profile"
-        if email == redis.hget(key, "email"):
-            return True
-    return False
+    return redis.hexists("emails", email)
 
 
-def save_login_attempt(username, success, ip):
-    key = f"user:{username}:login-attempts"
-    timestamp = int(datetime.now(pytz.utc).timestamp())
+def create_api_token(username):
+    token = secrets.token_urlsafe(config.settings.api_token_bytes)
+    key = keyspace.user(username, "profile")
+    old_digest = redis.hget(key, "api_token")
 
-    redis.lpush(key, f"{timestamp};{int(success)};{ip}")
-    redis.ltrim(key, 0, config["login_attempts_history_length"] - 1)
+    pipe = redis.pipeline(transaction=False)
+    queue_api_token(pipe, username, token_digest(token), old_digest)
+    pipe.execute()
+    return token
 
 
-def get_login_attempts(username):
-    key = f"user:{username}:login-attempts"
-    attempts = []
+def queue_api_token(pipe, username, digest, old_digest=None):
+    if old_digest:
+        pipe.hdel("api-tokens", old_digest)
+    pipe.hset("api-tokens", digest, username)
+    pipe.hset(keyspace.user(username, "profile"), "api_token", digest)
 
-    for attempt in redis.lrange(key, 0, -1):
-        split = attempt.split(";")
-        attempts.append({
-            "datetime": datetime.fromtimestamp(float(split[0]), tz=pytz.utc),
-            "success": bool(int(split[1])),
-            "ip": split[2]
-        })
-    return attempts
+
+def get_api_user(token):
+    return redis.hget("api-tokens", token_digest(token)) if token else None
+
+
+def token_digest(token):
+    # API tokens are random, so a fast hash is enough and keeps every API
+    # call off the bcrypt pool.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def index_emails(batch_size=500):
+    count = 0
+    batch = []
+    for username in scan_usernames(batch_size):
+        batch.append(username)
+        if len(batch) >= batch_size:
+            count += index_emails_batch(batch)
+            batch = []
+    if batch:
+        count += index_emails_batch(batch)
+    return count
+
+
+def scan_usernames(batch_size=500):
+    for key in keyspace.shards("users"):
+        yield from redis.sscan_iter(key, count=batch_size)
+
+
+def index_emails_batch(usernames):
+    pipe = redis.pipeline(transaction=False)
+    for username in usernames:
+        pipe.hget(keyspace.user(username, "profile"), "email")
+    emails = pipe.execute()
+
+    for username, email in zip(usernames, emails):
+        if email:
+            pipe.hset("emails", email, username)
+    pipe.execute()
+    return sum(1 for email in emails if email)
+
+
+def migrate_key_layout(batch_size=500):
+    moved = 0
+    for pattern in ["user:*", "note:*", "group:*", "blob:*", "search:public:*",
+                    "users", "public-notes", "expiring-notes"]:
+        batch = []
+        for key in redis.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                moved += migrate_key_batch(batch, batch_size)
+                batch = []
+        if batch:
+            moved += migrate_key_batch(batch, batch_size)
+    return moved
+
+
+def migrate_key_batch(keys, batch_size):
+    migrated = 0
+    moves = {}
+    for key in keys:
+        target = layout_target(key)
+        if callable(target):
+            reshard_key(key, target, batch_size)
+            migrated += 1
+        elif target != key:
+            moves[key] = target
+
+    if not moves:
+        return migrated
+
+    pipe = redis.pipeline(transaction=False)
+    for key in moves:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+
+    for (key, target), data, ttl in zip(moves.items(), results[0::2], results[1::2]):
+        if data is not None:
+            pipe.restore(target, max(ttl, 0), data, replace=True)
+            pipe.unlink(key)
+            migrated += 1
+    pipe.execute()
+    return migrated
+
+
+def layout_target(key):
+    name, _, rest = key.partition(":")
+    owner, _, suffix = rest.partition(":")
+    if name in ("users", "public-notes", "expiring-notes") and not rest \
+            and keyspace.shard_count > 1:
+        return lambda member: keyspace.shard_for(name, member)
+    if name == "search" and owner == "public" and not suffix.startswith("{") \
+            and ":" not in suffix and keyspace.shard_count > 1:
+        return lambda member: keyspace.search_prefix(index=keyspace.shard_of(member)) + suffix
+    if name == "user" and suffix and not owner.startswith("{"):
+        return keyspace.user(owner, suffix)
+    if name == "note" and suffix and not owner.startswith("{"):
+        return keyspace.note(owner, suffix)
+    if name == "blob" and rest and not rest.startswith("{"):
+        return keyspace.blob(rest)
+    if name == "group" and suffix and not owner.startswith("{"):
+        return keyspace.group(owner, suffix)
+    return key
+
+
+def reshard_key(key, target, batch_size):
+    if redis.type(key) == "set":
+        members = ((member, None) for member in redis.sscan_iter(key, count=batch_size))
+    else:
+        members = redis.zscan_iter(key, count=batch_size)
+
+    pipe = redis.pipeline(transaction=False)
+    for member, score in members:
+        shard = target(member)
+        if score is None:
+            pipe.sadd(shard, member)
+        else:
+            pipe.zadd(shard, {member: score})
+        if len(pipe) >= batch_size:
+            pipe.execute()
+    pipe.execute()
+    redis.unlink(key)
+
+
+def queue_login_attempt(pipe, username, success, ip):
+    pipe.xadd(keyspace.user(username, "logins"), {"success": int(success), "ip": ip or ""},
+              maxlen=config.settings.login_attempts_history_length, approximate=False)
+    if not success:
+        queue_failed_login(pipe, username, ip)
+
+
+def queue_failed_login(pipe, username, ip):
+    pipe.xadd(keyspace.FAILED_LOGINS, {"username": username, "ip": ip or ""},
+              maxlen=config.settings.failed_logins_stream_length)
+
+
+def get_login_attempts(username, since=None, until=None, count=None):
+    entries = redis.xrevrange(keyspace.user(username, "logins"),
+                              *login_range(since, until), count=count)
+    return [parse_login_attempt(entry) for entry in entries]
+
+
+def login_range(since=None, until=None):
+    return stream_id(until, "+"), stream_id(since, "-")
+
+
+def stream_id(moment, default):
+    return str(int(moment.timestamp() * 1000)) if moment else default
+
+
+def parse_login_attempt(entry):
+    entry_id, fields = entry
+    return {
+        "datetime": datetime.fromtimestamp(int(entry_id.split("-")[0]) // 1000, tz=pytz.utc),
+        "success": fields.get("success") == "1",
+        "ip": fields.get("ip")
+    }
+
+
+def migrate_login_attempts(batch_size=500):
+    migrated = 0
+    for key in redis.scan_iter(match="user:*:login-attempts", count=batch_size):
+        username = keyspace.untag(key.split(":")[1])
+        stream_key = keyspace.user(username, "logins")
+        entries = dict(legacy_login_entries(redis.lrange(key, 0, -1)))
+        entries.update(redis.xrange(stream_key))
+
+        pipe = redis.pipeline()
+        pipe.delete(stream_key)
+        for entry_id, fields in sorted(entries.items(), key=lambda entry: stream_order(entry[0])):
+            pipe.xadd(stream_key, fields, id=entry_id,
+                      maxlen=config.settings.login_attempts_history_length, approximate=False)
+        pipe.delete(key)
+        pipe.execute()
+        migrated += 1
+    return migrated
+
+
+def legacy_login_entries(attempts):
+    # Lists stored "timestamp;success;ip" strings, newest first.
+    entries = []
+    for i, attempt in enumerate(reversed(attempts)):
+        timestamp, success, ip = attempt.split(";", 2)
+        entries.append((f"{int(timestamp) * 1000}-{i}", {"success": success, "ip": ip}))
+    return entries
+
+
+def stream_order(entry_id):
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
 
 
 def get_login_attempts_localized(username):
-    attempts = get_login_attempts(username)
+    return localize_login_attempts(get_login_attempts(username))
+
+
+def localize_login_attempts(attempts):
     for attempt in attempts:
         localized = utils.to_local_time(attempt.get("datetime"))
         attempt["date"] = localized.date()
@@ -94,60 +412,69 @@ def get_login_attempts_localized(username):
     return attempts
 
 
-def count_failed_login_attempts(username):
-    attempts = get_login_attempts(username)
-    count = 0
-    check_delta = timedelta(minutes=config["login_attempts_check_minutes"])
+def start_login_attempt(username, ip):
+    return login_attempt_result(login_delay_script(
+        keys=login_delay_keys(username), args=login_delay_args(ip)))
+
+
+def login_delay_keys(username):
+    return [keyspace.user(username, "logins"), keyspace.user(username, "profile")]
+
+
+def login_delay_args(ip):
+    return [int(datetime.now(pytz.utc).timestamp()),
+            config.settings.login_attempts_check_minutes * 60,
+            config.settings.next_login_seconds_per_attempt, ip or "",
+            config.settings.login_attempts_history_length]
+
+
+def login_attempt_result(result):
+    # The attempt id and the password hash are only there for existing
+    # users who may try now.
+    delay, attempt_id, hashed_password = [*result, None, None][:3]
+    return delay, attempt_id, hashed_password
 
-    for attempt in attempts:
-        delta = datetime.now(pytz.utc) - attempt.get("datetime")
-        if not attempt.get("success") and delta < check_delta:
-            count += 1
-        else:
-            break
-    return count
 
+def finish_login_attempt(username, attempt_id, success, ip):
+    pipe = redis.pipeline(transaction=False)
+    queue_login_result(pipe, username, attempt_id, success, ip)
+    pipe.execute()
 
-def seconds_to_next_login(username):
-    key = f"user:{username}:login-attempts"
-    if redis.llen(key) == 0:
-        return 0
 
-    count = count_failed_login_attempts(username)
+# The attempt was recorded as failed before the password was checked. Unknown
+# usernames have no attempt of their own, but still go to the global feed.
+def queue_login_result(pipe, username, attempt_id, success, ip):
+    if success:
+        pipe.xdel(keyspace.user(username, "logins"), attempt_id)
+        queue_login_attempt(pipe, username, True, ip)
+    else:
+        queue_failed_login(pipe, username, ip)
 
-    last = redis.lindex(key, 0).split(";")
-    last = datetime.fromtimestamp(int(last[0]), tz=pytz.utc)
 
-    elapsed = (datetime.now(pytz.utc) - last).seconds
-    return max((count-2) * config["next_login_seconds_per_attempt"] - elapsed, 0)
+# A check that never got to compare the password does not count against the user.
+def cancel_login_attempt(username, attempt_id):
+    if attempt_id:
+        redis.xdel(keyspace.user(username, "logins"), attempt_id)
 
 
 def change_password(username, password):
     if not username_taken(username):
         return False
 
-    key = f"user:{username}:profile"
-    hashed_password = bcrypt.hashpw(
-        password.encode(), bcrypt.gensalt(rounds=config["bcrypt_rounds"]))
+    key = keyspace.user(username, "profile")
+    hashed_password = hash_secret(password)
 
     redis.hset(key, "password", hashed_password)
     return True
 
 
 def request_password_reset(email):
-    username = ""
-    for user in redis.smembers("users"):
-        key = f"user:{user}:profile"
-        if email == redis.hget(key, "email"):
-            username = user
-            break
-    
-    if username == "":
+    username = redis.hget("emails", email)
+    if not username:
         return False
 
-    token = secrets.token_urlsafe(config["password_reset_token_bytes"])
-    hashed_token = bcrypt.hashpw(
-        token.encode(), bcrypt.gensalt(rounds=config["bcrypt_rounds"]))
+    token = secrets.token_urlsafe(config.settings.password_reset_token_bytes)
+    hashed_token = hash_secret(token)
 
     key = f"password-reset:{email}"
     redis.hset(key, "username", username)
@@ -165,7 +492,7 @@ def reset_password(email, token, password):
     username = reset.get("username")
     hashed_token = reset.get("token")
 
-    if bcrypt.checkpw(token.encode(), hashed_token.encode()):
+    if check_secret(token, hashed_token):
         change_password(username, password)
         redis.delete(f"password-reset:{email}")
         return True
@@ -0,0 +1,105 @@
+import db
+import keyspace
+
+
+redis = db.redis
+
+unlink_script = db.load_script("unlink_group")
+
+
+def get_groups(owner):
+    names = sorted(redis.smembers(keyspace.user(owner, "groups")))
+    pipe = redis.pipeline(transaction=False)
+    for name in names:
+        pipe.smembers(members_key(owner, name))
+    return build_groups(names, pipe.execute() if names else [])
+
+
+def build_groups(names, members):
+    return [{"name": name, "members": sorted(group_members)}
+            for name, group_members in zip(names, members)]
+
+
+def members_key(owner, name):
+    return keyspace.group(keyspace.group_id(owner, name), "members")
+
+
+def check_members(owner, members):
+    taken = db.usernames_taken(members) if members else []
+    return first_invalid_member(owner, members, taken)
+
+
+def first_invalid_member(owner, members, taken):
+    for user, user_taken in zip(members, taken):
+        if not (user.isalpha() and user_taken) or user == owner:
+            return user
+    return True
+
+
+def save(owner, name, members):
+    current = redis.smembers(members_key(owner, name))
+    pipe = redis.pipeline(transaction=False)
+    queue_save(pipe, owner, name, current, members)
+    pipe.execute()
+
+
+# Membership is stored on both sides: the group lists its members and every
+# member lists its groups, which is what /shared-notes and search read.
+def queue_save(pipe, owner, name, current, members):
+    group_id = keyspace.group_id(owner, name)
+    key = members_key(owner, name)
+    members = set(members) - {owner}
+    added, removed = members - current, current - members
+
+    pipe.sadd(keyspace.user(owner, "groups"), name)
+    if added:
+        pipe.sadd(key, *added)
+    if removed:
+        pipe.srem(key, *removed)
+    for user in added:
+        pipe.sadd(keyspace.user(user, "memberships"), group_id)
+    for user in removed:
+        pipe.srem(keyspace.user(user, "memberships"), group_id)
+
+
+def delete(owner, name, batch_size=500):
+    if not redis.srem(keyspace.user(owner, "groups"), name):
+        return False
+
+    group_id = keyspace.group_id(owner, name)
+    members = redis.smembers(members_key(owner, name))
+    pipe = redis.pipeline(transaction=False)
+    queue_delete_members(pipe, owner, name, members)
+    pipe.execute()
+
+    while True:
+        popped = redis.zpopmin(keyspace.group(group_id, "notes"), batch_size)
+        if not popped:
+            return True
+        unlink_notes(group_id, [note_id for note_id, _ in popped])
+
+
+def queue_delete_members(pipe, owner, name, members):
+    group_id = keyspace.group_id(owner, name)
+    for user in members:
+        pipe.srem(keyspace.user(user, "memberships"), group_id)
+    pipe.delete(members_key(owner, name))
+
+
+def unlink_notes(group_id, note_ids):
+    pipe = redis.pipeline(transaction=False)
+    for note_id in note_ids:
+        pipe.get(keyspace.note(note_id, "tokens"))
+    index_keys = group_index_keys(group_id, pipe.execute())
+
+    for note_id in note_ids:
+        unlink_script(keys=[keyspace.note(note_id, "content")], args=[group_id], client=pipe)
+    for key in index_keys:
+        pipe.unlink(key)
+    pipe.execute()
+
+
+def group_index_keys(group_id, tokens):
+    # Only notes linked to the group are in its indexes, so whole keys go.
+    prefix = keyspace.group(group_id, "search:")
+    return {prefix + token for note_tokens in tokens for token in (note_tokens or "").split()}
@@ -0,0 +1,5 @@
+# Read by gunicorn from the working directory. Workers reset their signal
+# handlers after forking, so the reload handler is installed in each worker.
+def post_worker_init(worker):
+    import config
+    config.reload_on_signal()
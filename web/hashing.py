@@ -0,0 +1,10 @@
+import bcrypt
+
+
+# Kept apart from db so the bcrypt processes do not import the Redis client.
+def bcrypt_hash(secret, rounds):
+    return bcrypt.hashpw(secret, bcrypt.gensalt(rounds=rounds))
+
+
+def bcrypt_check(secret, hashed):
+    return bcrypt.checkpw(secret, hashed)
@@ -0,0 +1,79 @@
+import zlib
+import config
+
+
+# Both are fixed for the lifetime of a worker: the key layout has to match
+# the data already stored, so changing them needs a restart and a migration.
+cluster = config.settings.redis_cluster
+shard_count = config.settings.key_shards if cluster else 1
+
+FAILED_LOGINS = "security:failed-logins"
+
+
+def tag(value):
+    return f"{{{value}}}" if cluster else value
+
+
+def untag(value):
+    return value[1:-1] if value.startswith("{") and value.endswith("}") else value
+
+
+def user(username, name):
+    return f"user:{tag(username)}:{name}"
+
+
+def note(note_id, name):
+    return f"note:{tag(note_id)}:{name}"
+
+
+def blob(digest):
+    return f"blob:{tag(digest)}"
+
+
+def group(group_id, name):
+    return f"group:{tag(group_id)}:{name}"
+
+
+def group_id(owner, name):
+    return f"{owner}.{name}"
+
+
+def note_id(key):
+    return untag(key.split(":")[1])
+
+
+def shard_of(member):
+    return zlib.crc32(member.encode()) % shard_count
+
+
+def shard(key, index):
+    return key if shard_count == 1 else f"{key}:{{{index}}}"
+
+
+def shard_for(key, member):
+    return shard(key, shard_of(member))
+
+
+def shards(key):
+    return [shard(key, index) for index in range(shard_count)]
+
+
+def search_prefix(username=None, index=0):
+    if username:
+        return user(username, "search:")
+    return shard("search:public", index) + ":"
+
+
+def search_prefixes(username=None, groups=()):
+    prefixes = [search_prefix(index=index) for index in range(shard_count)]
+    if username:
+        prefixes.append(search_prefix(username))
+    prefixes += [group(group_id, "search:") for group_id in groups]
+    return prefixes
+
+
+def group_by_shard(key, members):
+    groups = {}
+    for member in members:
+        groups.setdefault(shard_for(key, member), []).append(member)
+    return groups
@@ -0,0 +1,65 @@
+from time import time
+import math
+import db
+import config
+import keyspace
+
+
+redis = db.redis
+
+limit_script = db.load_script("rate_limit")
+
+SUBJECTS = ("ip", "account")
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+# All limits of an action are checked in one round trip.
+def check(action, **subjects):
+    checks = limit_checks(action, subjects)
+    if len(checks) > 1:
+        pipe = redis.pipeline(transaction=False)
+        for keys, args in checks:
+            limit_script(keys=keys, args=args, client=pipe)
+        waits = pipe.execute()
+    else:
+        # Pipelines check that their scripts are loaded first, which would
+        # cost a round trip of its own.
+        waits = [limit_script(keys=keys, args=args) for keys, args in checks]
+    raise_limited(waits)
+
+
+def limit_checks(action, subjects):
+    period = getattr(config.settings, f"{action}_limit_seconds") * 1000
+    limits = []
+    for subject in SUBJECTS:
+        limit = getattr(config.settings, f"{action}_{subject}_limit", 0)
+        if limit and subjects.get(subject):
+            limits.append((limit_key(action, subject, subjects[subject]), limit))
+
+    # Keys of one check can live on different cluster nodes, so there each
+    # limit goes out as its own script call in the pipeline.
+    groups = [[entry] for entry in limits] if keyspace.cluster or not limits else [limits]
+    now = int(time() * 1000)
+    return [check_args(group, now, period) for group in groups]
+
+
+def check_args(group, now, period):
+    args = [now]
+    for _, limit in group:
+        args += [limit, period]
+    return [key for key, _ in group], args
+
+
+def limit_key(action, subject, value):
+    return f"rate-limit:{action}:{subject}:{value}"
+
+
+def raise_limited(waits):
+    wait = max(waits, default=0)
+    if wait > 0:
+        raise RateLimited(math.ceil(wait / 1000))
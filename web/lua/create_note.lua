@@ -0,0 +1,78 @@
+-- KEYS: note content, note readers, author notes, public notes, users,
+--       public notes version, note tokens, author groups, expiring notes
+-- ARGV: note id, author, title, content, content encoding, timestamp, public,
+--       expiry timestamp, token count, tokens..., group count, groups...,
+--       readers...
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+
+local note_id, author, timestamp, public = ARGV[1], ARGV[2], ARGV[6], ARGV[7]
+local expires = ARGV[8]
+local token_count = tonumber(ARGV[9])
+local tokens = {unpack(ARGV, 10, 9 + token_count)}
+local group_count = tonumber(ARGV[10 + token_count])
+local groups = {unpack(ARGV, 11 + token_count, 10 + token_count + group_count)}
+local readers = {unpack(ARGV, 11 + token_count + group_count)}
+local linked_groups = {}
+
+local function index(prefix)
+    for _, token in ipairs(tokens) do
+        redis.call("ZADD", prefix .. token, timestamp, note_id)
+    end
+end
+
+if public == "1" then
+    redis.call("ZADD", KEYS[4], timestamp, note_id)
+    redis.call("HINCRBY", KEYS[6], "version", 1)
+    redis.call("HSET", KEYS[6], "modified", timestamp)
+    index("search:public:")
+else
+    if #readers > 0 then
+        local taken = redis.call("SMISMEMBER", KEYS[5], unpack(readers))
+        for i, user in ipairs(readers) do
+            if taken[i] == 1 and user ~= author then
+                redis.call("ZADD", "user:" .. user .. ":shared", timestamp, note_id)
+                redis.call("SADD", KEYS[2], user)
+                index("user:" .. user .. ":search:")
+            end
+        end
+    end
+
+    -- A group is linked once, however many members it has.
+    if #groups > 0 then
+        local owned = redis.call("SMISMEMBER", KEYS[8], unpack(groups))
+        for i, name in ipairs(groups) do
+            if owned[i] == 1 then
+                local group = author .. "." .. name
+                redis.call("ZADD", "group:" .. group .. ":notes", timestamp, note_id)
+                index("group:" .. group .. ":search:")
+                table.insert(linked_groups, group)
+            end
+        end
+    end
+end
+
+redis.call("ZADD", KEYS[3], timestamp, note_id)
+index("user:" .. author .. ":search:")
+if token_count > 0 then
+    redis.call("SET", KEYS[7], table.concat(tokens, " "))
+end
+
+redis.call("HSET", KEYS[1],
+    "author", author,
+    "title", ARGV[3],
+    "content", ARGV[4],
+    "datetime", timestamp,
+    "public", public)
+if ARGV[5] ~= "" then
+    redis.call("HSET", KEYS[1], "encoding", ARGV[5])
+end
+if #linked_groups > 0 then
+    redis.call("HSET", KEYS[1], "groups", table.concat(linked_groups, " "))
+end
+if expires ~= "" then
+    redis.call("HSET", KEYS[1], "expires", expires)
+    redis.call("ZADD", KEYS[9], expires, note_id)
+end
+return 1
@@ -0,0 +1,29 @@
+-- KEYS: note content, note readers, note tokens
+-- ARGV: author, title, content, content encoding, timestamp, public,
+--       expiry timestamp, tokens, groups, readers...
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+
+redis.call("HSET", KEYS[1],
+    "author", ARGV[1],
+    "title", ARGV[2],
+    "content", ARGV[3],
+    "datetime", ARGV[5],
+    "public", ARGV[6])
+if ARGV[4] ~= "" then
+    redis.call("HSET", KEYS[1], "encoding", ARGV[4])
+end
+if ARGV[7] ~= "" then
+    redis.call("HSET", KEYS[1], "expires", ARGV[7])
+end
+if ARGV[8] ~= "" then
+    redis.call("SET", KEYS[3], ARGV[8])
+end
+if ARGV[9] ~= "" then
+    redis.call("HSET", KEYS[1], "groups", ARGV[9])
+end
+if #ARGV > 9 then
+    redis.call("SADD", KEYS[2], unpack(ARGV, 10))
+end
+return 1
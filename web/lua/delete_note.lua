@@ -0,0 +1,48 @@
+-- KEYS: note content, note readers, public notes, public notes version,
+--       note tokens, expiring notes, note history
+-- ARGV: note id, timestamp
+local note = redis.call("HMGET", KEYS[1], "author", "groups", "content", "encoding")
+local author = note[1]
+if not author then
+    return 0
+end
+
+local note_id = ARGV[1]
+local tokens = {}
+for token in string.gmatch(redis.call("GET", KEYS[5]) or "", "%S+") do
+    table.insert(tokens, token)
+end
+
+local function unindex(prefix)
+    for _, token in ipairs(tokens) do
+        redis.call("ZREM", prefix .. token, note_id)
+    end
+end
+
+for _, user in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+    redis.call("ZREM", "user:" .. user .. ":shared", note_id)
+    unindex("user:" .. user .. ":search:")
+end
+
+for group in string.gmatch(note[2] or "", "%S+") do
+    redis.call("ZREM", "group:" .. group .. ":notes", note_id)
+    unindex("group:" .. group .. ":search:")
+end
+
+if note[4] == "blob" then
+    local blob = "blob:" .. note[3]
+    if redis.call("HINCRBY", blob, "refs", -1) <= 0 then
+        redis.call("DEL", blob)
+    end
+end
+
+redis.call("DEL", KEYS[1], KEYS[2], KEYS[5], KEYS[7])
+redis.call("ZREM", KEYS[6], note_id)
+redis.call("ZREM", "user:" .. author .. ":notes", note_id)
+unindex("user:" .. author .. ":search:")
+if redis.call("ZREM", KEYS[3], note_id) == 1 then
+    redis.call("HINCRBY", KEYS[4], "version", 1)
+    redis.call("HSET", KEYS[4], "modified", ARGV[2])
+    unindex("search:public:")
+end
+return 1
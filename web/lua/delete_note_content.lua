@@ -0,0 +1,16 @@
+-- KEYS: note content, note readers, note tokens, note history
+-- Returns the author, public flag, tokens, groups, body blob and readers of
+-- the deleted note.
+local note = redis.call("HMGET", KEYS[1], "author", "public", "groups", "content", "encoding")
+if not note[1] then
+    return false
+end
+
+local blob = note[5] == "blob" and note[4] or ""
+local removed = {note[1], note[2], redis.call("GET", KEYS[3]) or "", note[3] or "", blob}
+for _, user in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+    table.insert(removed, user)
+end
+
+redis.call("DEL", KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+return removed
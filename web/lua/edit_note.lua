@@ -0,0 +1,75 @@
+-- KEYS: note content, note readers, note tokens, note history,
+--       public notes version
+-- ARGV: note id, version, title, content, content encoding, timestamp,
+--       history entry, history depth, tokens...
+local note = redis.call("HMGET", KEYS[1], "author", "public", "groups", "content", "encoding",
+    "version", "datetime")
+local author = note[1]
+if not author or (note[6] or "0") ~= ARGV[2] then
+    return 0
+end
+
+local note_id, timestamp, score = ARGV[1], ARGV[6], note[7]
+local tokens = {unpack(ARGV, 9)}
+local old, new = {}, {}
+for token in string.gmatch(redis.call("GET", KEYS[3]) or "", "%S+") do
+    old[token] = true
+end
+for _, token in ipairs(tokens) do
+    new[token] = true
+end
+
+local function reindex(prefix)
+    for token in pairs(old) do
+        if not new[token] then
+            redis.call("ZREM", prefix .. token, note_id)
+        end
+    end
+    for token in pairs(new) do
+        if not old[token] then
+            redis.call("ZADD", prefix .. token, score, note_id)
+        end
+    end
+end
+
+reindex("user:" .. author .. ":search:")
+for _, user in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+    reindex("user:" .. user .. ":search:")
+end
+for group in string.gmatch(note[3] or "", "%S+") do
+    reindex("group:" .. group .. ":search:")
+end
+if note[2] == "1" then
+    reindex("search:public:")
+    redis.call("HINCRBY", KEYS[5], "version", 1)
+    redis.call("HSET", KEYS[5], "modified", timestamp)
+end
+
+if note[5] == "blob" then
+    local blob = "blob:" .. note[4]
+    if redis.call("HINCRBY", blob, "refs", -1) <= 0 then
+        redis.call("DEL", blob)
+    end
+end
+
+redis.call("HSET", KEYS[1], "title", ARGV[3], "content", ARGV[4], "edited", timestamp)
+redis.call("HINCRBY", KEYS[1], "version", 1)
+if ARGV[5] ~= "" then
+    redis.call("HSET", KEYS[1], "encoding", ARGV[5])
+else
+    redis.call("HDEL", KEYS[1], "encoding")
+end
+if #tokens > 0 then
+    redis.call("SET", KEYS[3], table.concat(tokens, " "))
+else
+    redis.call("DEL", KEYS[3])
+end
+
+local depth = tonumber(ARGV[8])
+if depth > 0 then
+    redis.call("LPUSH", KEYS[4], ARGV[7])
+    redis.call("LTRIM", KEYS[4], 0, depth - 1)
+else
+    redis.call("DEL", KEYS[4])
+end
+return 1
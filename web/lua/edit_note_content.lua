@@ -0,0 +1,38 @@
+-- KEYS: note content, note readers, note tokens, note history
+-- ARGV: version, title, content, content encoding, timestamp, history entry,
+--       history depth, tokens...
+-- Returns the author, public flag, previous tokens, groups, previous body blob,
+-- timestamp and readers of the edited note.
+local note = redis.call("HMGET", KEYS[1], "author", "public", "groups", "content", "encoding",
+    "version", "datetime")
+if not note[1] or (note[6] or "0") ~= ARGV[1] then
+    return false
+end
+
+local blob = note[5] == "blob" and note[4] or ""
+local edited = {note[1], note[2], redis.call("GET", KEYS[3]) or "", note[3] or "", blob, note[7]}
+for _, user in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+    table.insert(edited, user)
+end
+
+redis.call("HSET", KEYS[1], "title", ARGV[2], "content", ARGV[3], "edited", ARGV[5])
+redis.call("HINCRBY", KEYS[1], "version", 1)
+if ARGV[4] ~= "" then
+    redis.call("HSET", KEYS[1], "encoding", ARGV[4])
+else
+    redis.call("HDEL", KEYS[1], "encoding")
+end
+if #ARGV > 7 then
+    redis.call("SET", KEYS[3], table.concat({unpack(ARGV, 8)}, " "))
+else
+    redis.call("DEL", KEYS[3])
+end
+
+local depth = tonumber(ARGV[7])
+if depth > 0 then
+    redis.call("LPUSH", KEYS[4], ARGV[6])
+    redis.call("LTRIM", KEYS[4], 0, depth - 1)
+else
+    redis.call("DEL", KEYS[4])
+end
+return edited
@@ -0,0 +1,13 @@
+-- KEYS: note content or blob
+-- ARGV: expected stored content, new content, new encoding
+if redis.call("HGET", KEYS[1], "content") ~= ARGV[1] then
+    return 0
+end
+
+if ARGV[3] == "" then
+    redis.call("HDEL", KEYS[1], "encoding")
+    redis.call("HSET", KEYS[1], "content", ARGV[2])
+else
+    redis.call("HSET", KEYS[1], "content", ARGV[2], "encoding", ARGV[3])
+end
+return 1
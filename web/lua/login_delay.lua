@@ -0,0 +1,37 @@
+-- KEYS: login attempts stream, profile
+-- ARGV: now, check window in seconds, delay per failed attempt in seconds,
+-- IP address, attempts kept
+-- When no delay applies the attempt is recorded as failed straight away,
+-- so concurrent guesses see it before the password has been checked.
+-- Returns {delay}, {0} for unknown users or {0, attempt id, password hash}.
+local now, window = tonumber(ARGV[1]), tonumber(ARGV[2])
+local attempts = redis.call("XREVRANGE", KEYS[1], "+", (now - window) * 1000)
+
+local count = 0
+for _, attempt in ipairs(attempts) do
+    local fields, success = attempt[2], nil
+    for i = 1, #fields, 2 do
+        if fields[i] == "success" then
+            success = fields[i + 1]
+        end
+    end
+    if success ~= "0" then
+        break
+    end
+    count = count + 1
+end
+
+if #attempts > 0 then
+    local last = math.floor(tonumber(string.match(attempts[1][1], "^(%d+)")) / 1000)
+    local delay = math.max((count - 2) * tonumber(ARGV[3]) - (now - last), 0)
+    if delay > 0 then
+        return {delay}
+    end
+end
+
+local password = redis.call("HGET", KEYS[2], "password")
+if not password then
+    return {0}
+end
+local id = redis.call("XADD", KEYS[1], "MAXLEN", ARGV[5], "*", "success", 0, "ip", ARGV[4])
+return {0, id, password}
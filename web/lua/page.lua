@@ -0,0 +1,46 @@
+-- KEYS: timeline, expiring notes index (single node only)
+-- ARGV: cursor score, cursor note id, limit, now
+-- Notes past their expiry time are skipped until the sweeper removes them.
+local key, limit = KEYS[1], tonumber(ARGV[3])
+local page = {}
+-- The sweeper keeps the expired range empty most of the time.
+local expired = KEYS[2] and redis.call("ZCOUNT", KEYS[2], "-inf", ARGV[4]) > 0
+
+local function add(id, score)
+    if #page >= limit * 2 then
+        return
+    end
+    if expired then
+        local expires = redis.call("ZSCORE", KEYS[2], id)
+        if expires and tonumber(expires) <= tonumber(ARGV[4]) then
+            return
+        end
+    end
+    table.insert(page, id)
+    table.insert(page, score)
+end
+
+local max = "+inf"
+if ARGV[1] ~= "" then
+    max = "(" .. ARGV[1]
+    for _, id in ipairs(redis.call("ZREVRANGEBYSCORE", key, ARGV[1], ARGV[1])) do
+        if id < ARGV[2] then
+            add(id, ARGV[1])
+        end
+    end
+end
+
+local offset = 0
+while #page < limit * 2 do
+    local count = limit - #page / 2
+    local rest = redis.call("ZREVRANGEBYSCORE", key, max, "-inf",
+        "WITHSCORES", "LIMIT", offset, count)
+    for i = 1, #rest, 2 do
+        add(rest[i], rest[i + 1])
+    end
+    if #rest < count * 2 then
+        break
+    end
+    offset = offset + count
+end
+return page
@@ -0,0 +1,22 @@
+-- KEYS: limits...
+-- ARGV: now in milliseconds, then a limit and a period in milliseconds per key
+-- Generic cell rate algorithm: a burst of up to limit requests, then one
+-- every period / limit. The request only counts when every limit allows it.
+-- Returns 0 when it is allowed, otherwise the milliseconds to wait.
+local now = tonumber(ARGV[1])
+local wait, arrivals = 0, {}
+for i, key in ipairs(KEYS) do
+    local limit, period = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local arrival = math.max(tonumber(redis.call("GET", key)) or now, now) +
+        math.ceil(period / limit)
+    wait = math.max(wait, arrival - now - period)
+    arrivals[i] = arrival
+end
+if wait > 0 then
+    return wait
+end
+
+for i, key in ipairs(KEYS) do
+    redis.call("SET", key, arrivals[i], "PX", arrivals[i] - now)
+end
+return 0
@@ -0,0 +1,6 @@
+-- KEYS: blob
+if redis.call("HINCRBY", KEYS[1], "refs", -1) <= 0 then
+    redis.call("DEL", KEYS[1])
+    return 1
+end
+return 0
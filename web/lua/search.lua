@@ -0,0 +1,12 @@
+-- KEYS: temporary key, token indexes...
+-- ARGV: limit
+local limit = tonumber(ARGV[1]) - 1
+if #KEYS == 2 then
+    -- A single token is read straight from its index, without copying it.
+    return redis.call("ZREVRANGE", KEYS[2], 0, limit, "WITHSCORES")
+end
+
+redis.call("ZINTERSTORE", KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+local result = redis.call("ZREVRANGE", KEYS[1], 0, limit, "WITHSCORES")
+redis.call("DEL", KEYS[1])
+return result
@@ -0,0 +1,6 @@
+-- KEYS: blob
+-- ARGV: stored content, content encoding
+if redis.call("HINCRBY", KEYS[1], "refs", 1) == 1 then
+    redis.call("HSET", KEYS[1], "content", ARGV[1], "encoding", ARGV[2])
+end
+return 1
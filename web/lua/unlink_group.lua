@@ -0,0 +1,20 @@
+-- KEYS: note content
+-- ARGV: group id
+local groups = redis.call("HGET", KEYS[1], "groups")
+if not groups then
+    return 0
+end
+
+local kept = {}
+for group in string.gmatch(groups, "%S+") do
+    if group ~= ARGV[1] then
+        table.insert(kept, group)
+    end
+end
+
+if #kept > 0 then
+    redis.call("HSET", KEYS[1], "groups", table.concat(kept, " "))
+else
+    redis.call("HDEL", KEYS[1], "groups")
+end
+return 1
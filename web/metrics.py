@@ -0,0 +1,197 @@
+from redis import Redis
+from redis.client import Pipeline
+from redis.cluster import RedisCluster, ClusterPipeline
+from collections import Counter
+from contextvars import ContextVar
+from threading import Lock
+from types import SimpleNamespace
+from time import perf_counter, monotonic
+
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+TYPES = {
+    "requests_total": "counter",
+    "request_seconds": "histogram",
+    "redis_commands_total": "counter",
+    "redis_round_trips_total": "counter",
+    "redis_round_trip_seconds": "histogram",
+    "bcrypt_seconds": "histogram",
+    "template_render_seconds": "histogram"
+}
+
+pending = Counter()
+pending_lock = Lock()
+last_flush = monotonic()
+# A context variable rather than a thread local, so that requests sharing an
+# event loop thread in the ASGI app keep separate counts.
+current = ContextVar("metrics_request", default=None)
+
+
+class InstrumentedRedis(Redis):
+    def execute_command(self, *args, **options):
+        start = perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            record_round_trip([args[0]], perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        commands = [args[0] for args, _ in self.command_stack]
+        start = perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            if commands:
+                record_round_trip(commands, perf_counter() - start)
+
+
+class InstrumentedRedisCluster(RedisCluster):
+    def execute_command(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return super().execute_command(*args, **kwargs)
+        finally:
+            record_round_trip([args[0]], perf_counter() - start)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        # ClusterPipeline takes the cluster's internal state as constructor
+        # arguments, which differ between redis-py versions.
+        pipe = super().pipeline(transaction, shard_hint)
+        pipe.__class__ = InstrumentedClusterPipeline
+        pipe.staged = []
+        return pipe
+
+
+class InstrumentedClusterPipeline(ClusterPipeline):
+    def execute_command(self, *args, **kwargs):
+        self.staged.append(args[0])
+        return super().execute_command(*args, **kwargs)
+
+    def execute(self, raise_on_error=True):
+        commands, self.staged = self.staged, []
+        start = perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            if commands:
+                record_round_trip(commands, perf_counter() - start)
+
+
+def field(name, **labels):
+    return "|".join([name, *(f"{key}={value}" for key, value in sorted(labels.items()))])
+
+
+def inc(name, value=1, **labels):
+    with pending_lock:
+        pending[field(name, **labels)] += value
+
+
+def observe(name, value, **labels):
+    with pending_lock:
+        for bucket in BUCKETS:
+            if value <= bucket:
+                pending[field(f"{name}_bucket", le=bucket, **labels)] += 1
+        pending[field(f"{name}_bucket", le="+Inf", **labels)] += 1
+        pending[field(f"{name}_sum", **labels)] += value
+        pending[field(f"{name}_count", **labels)] += 1
+
+
+def start_request():
+    current.set(SimpleNamespace(commands=Counter(), round_trips=[], start=perf_counter()))
+
+
+def record_round_trip(commands, seconds):
+    request = current.get()
+    if request is None:
+        return
+    request.commands.update(str(command).upper() for command in commands)
+    request.round_trips.append(seconds)
+
+
+def finish_request(endpoint, status):
+    request = current.get()
+    if request is None:
+        return None
+
+    duration = perf_counter() - request.start
+    endpoint = endpoint or "unknown"
+    summary = {
+        "duration": duration,
+        "round_trips": len(request.round_trips),
+        "redis_seconds": sum(request.round_trips),
+        "commands": request.commands
+    }
+
+    inc("requests_total", endpoint=endpoint, status=status)
+    observe("request_seconds", duration, endpoint=endpoint)
+    inc("redis_round_trips_total", summary["round_trips"], endpoint=endpoint)
+    for seconds in request.round_trips:
+        observe("redis_round_trip_seconds", seconds, endpoint=endpoint)
+    for command, count in summary["commands"].items():
+        inc("redis_commands_total", count, endpoint=endpoint, command=command)
+
+    current.set(None)
+    return summary
+
+
+def flush(client, interval=0):
+    values = take_pending(interval)
+    if values:
+        pipe = client.pipeline(transaction=False)
+        queue_flush(pipe, values)
+        pipe.execute()
+
+
+def take_pending(interval=0):
+    global last_flush
+    with pending_lock:
+        if not pending or monotonic() - last_flush < interval:
+            return None
+        values = dict(pending)
+        pending.clear()
+        last_flush = monotonic()
+    return values
+
+
+def queue_flush(pipe, values):
+    for key, value in values.items():
+        pipe.hincrbyfloat("metrics", key, value)
+
+
+def render(client):
+    flush(client)
+    return render_values(client.hgetall("metrics"))
+
+
+def render_values(values):
+    families = {}
+    for key, value in values.items():
+        name, *labels = key.split("|")
+        base = name
+        for suffix in ["_bucket", "_sum", "_count"]:
+            if name.endswith(suffix) and TYPES.get(name[:-len(suffix)]) == "histogram":
+                base = name[:-len(suffix)]
+        labels = ",".join('{}="{}"'.format(*label.split("=", 1)) for label in labels)
+        labels = f"{{{labels}}}" if labels else ""
+        families.setdefault(base, []).append(f"noteatkey_{name}{labels} {value}")
+
+    lines = []
+    for base in sorted(families):
+        lines.append(f"# TYPE noteatkey_{base} {TYPES.get(base, 'untyped')}")
+        lines += sorted(families[base])
+    return "\n".join(lines) + "\n"
+
+
+def describe(summary):
+    commands = ", ".join(f"{command}x{count}"
+                         for command, count in summary["commands"].most_common())
+    return (f"{summary['duration'] * 1000:.1f} ms, "
+            f"{summary['round_trips']} Redis round trips "
+            f"({summary['redis_seconds'] * 1000:.1f} ms): {commands or 'none'}")
@@ -1,97 +1,909 @@
-from yaml import safe_load
 from datetime import datetime
+from threading import Lock, Thread
+from time import sleep
+from redis.exceptions import RedisError
 import secrets
+import difflib
+import hashlib
+import base64
+import json
+import zlib
 import db
 import pytz
 import utils
+import config
+import keyspace
 
 
 redis = db.redis
-config = safe_load(open("config.yaml"))
 
+page_script = db.load_script("page")
+create_script = db.load_script("create_note")
+delete_script = db.load_script("delete_note")
+create_content_script = db.load_script("create_note_content")
+delete_content_script = db.load_script("delete_note_content")
+encode_script = db.load_script("encode_note")
+store_blob_script = db.load_script("store_blob")
+release_blob_script = db.load_script("release_blob")
+edit_script = db.load_script("edit_note")
+edit_content_script = db.load_script("edit_note_content")
 
-def create(author, title, content, readers, public):
-    note_id = secrets.token_urlsafe(32)
-    while redis.exists(f"note:{note_id}"):
-        note_id = secrets.token_urlsafe(32)
+ENCODING = "zlib"
+BLOB = "blob"
 
-    if public:
-        redis.sadd("public-notes", note_id)
+sweeper = None
+sweeper_lock = Lock()
+
+
+def create(author, title, content, readers, public, expires=None):
+    return create_many(author, [(title, content, readers, public, expires)])[0]
+
+
+def create_many(author, new_notes):
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    pipe = body_pipeline()
+    prepared = [prepare(pipe, timestamp, *new_note) for new_note in new_notes]
+    if keyspace.cluster:
+        names = [(readers, groups) for *_, readers, groups in prepared]
+        taken, owned = lookup_reader_names(author, names)
+        prepared = [(*note, linked_readers(author, readers, [taken[user] for user in readers]),
+                     linked_groups(author, groups, [owned[name] for name in groups]))
+                    for *note, readers, groups in prepared]
+
+    # Bodies are stored in the same round trip as the notes, and only the
+    # notes whose random id was already taken are tried again.
+    note_ids = [None] * len(prepared)
+    pending = list(range(len(prepared)))
+    while pending:
+        for index in pending:
+            note_ids[index] = secrets.token_urlsafe(32)
+            queue_create(pipe, note_ids[index], author, prepared[index])
+        created = pipe.execute()[-len(pending):]
+        pending = [index for index, ok in zip(pending, created) if not ok]
+
+    if keyspace.cluster and prepared:
+        for note_id, note in zip(note_ids, prepared):
+            _, _, _, timestamp, public, expires, tokens, readers, groups = note
+            queue_links(pipe, note_id, author, timestamp, public, expires, tokens, readers,
+                        groups)
+        pipe.execute()
+    return note_ids
+
+
+def prepare(pipe, timestamp, title, content, readers, public, expires=None):
+    expires = timestamp + expires if expires else ""
+    readers, groups = ([], []) if public else split_readers(parse_readers(readers))
+    tokens = utils.tokenize(f"{title} {content}")
+    content, encoding = store_body(content, pipe)
+    return title, content, encoding, timestamp, public, expires, tokens, readers, groups
+
+
+def queue_create(pipe, note_id, author, note):
+    if keyspace.cluster:
+        create_content_script(keys=note_keys(note_id), args=content_args(author, *note),
+                              client=pipe)
     else:
-        for user in readers.split(","):
-            user = user.strip()
-            if db.username_taken(user) and user != author:
-                redis.sadd(f"user:{user}:shared", note_id)
-                redis.sadd(f"note:{note_id}:readers", user)
-
-    redis.sadd(f"user:{author}:notes", note_id)
-    redis.hmset(f"note:{note_id}:content", {
-        "author": author,
-        "title": title,
-        "content": content,
-        "datetime": int(datetime.now(pytz.utc).timestamp()),
-        "public": int(public)
-    })
-    return note_id
+        create_script(keys=create_keys(note_id, author), args=create_args(note_id, author, *note),
+                      client=pipe)
+
+
+def create_keys(note_id, author):
+    content, readers, tokens = note_keys(note_id)
+    return [content, readers, keyspace.user(author, "notes"),
+            keyspace.shard_for("public-notes", note_id), keyspace.shard("users", 0),
+            "public-notes:version", tokens, keyspace.user(author, "groups"),
+            keyspace.shard_for("expiring-notes", note_id)]
+
+
+def create_args(note_id, author, title, content, encoding, timestamp, public, expires,
+                tokens, readers, groups):
+    return [note_id, author, title, content, encoding, timestamp, int(public), expires,
+            len(tokens), *tokens, len(groups), *groups, *readers]
+
+
+def content_args(author, title, content, encoding, timestamp, public, expires, tokens,
+                 readers, groups):
+    return [author, title, content, encoding, timestamp, int(public), expires,
+            " ".join(tokens), " ".join(groups), *readers]
+
+
+def note_keys(note_id):
+    return [keyspace.note(note_id, "content"), keyspace.note(note_id, "readers"),
+            keyspace.note(note_id, "tokens")]
+
+
+def all_note_keys(note_id):
+    return [*note_keys(note_id), keyspace.note(note_id, "history")]
+
+
+def linked_readers(author, readers, taken):
+    return [user for user, user_taken in zip(readers, taken) if user_taken and user != author]
+
+
+def linked_groups(author, groups, owned):
+    return [keyspace.group_id(author, name) for name, is_owned in zip(groups, owned) if is_owned]
+
+
+def index_prefixes(note_id, author, public, readers, groups=()):
+    prefixes = [keyspace.search_prefix(author)]
+    if public:
+        prefixes.append(keyspace.search_prefix(index=keyspace.shard_of(note_id)))
+    prefixes += [keyspace.search_prefix(user) for user in readers]
+    prefixes += [keyspace.group(group_id, "search:") for group_id in groups]
+    return prefixes
+
+
+# Cluster mode cannot update keys from different slots in one script, so the
+# note's own keys are written atomically first and linked into timelines and
+# indexes afterwards. Readers skip ids whose note does not exist (yet).
+def queue_links(pipe, note_id, author, timestamp, public, expires, tokens, readers, groups):
+    pipe.zadd(keyspace.user(author, "notes"), {note_id: timestamp})
+    if expires:
+        pipe.zadd(keyspace.shard_for("expiring-notes", note_id), {note_id: expires})
+    if public:
+        pipe.zadd(keyspace.shard_for("public-notes", note_id), {note_id: timestamp})
+        queue_public_version(pipe, timestamp)
+    for user in readers:
+        pipe.zadd(keyspace.user(user, "shared"), {note_id: timestamp})
+    for group_id in groups:
+        pipe.zadd(keyspace.group(group_id, "notes"), {note_id: timestamp})
+    for prefix in index_prefixes(note_id, author, public, readers, groups):
+        for token in tokens:
+            pipe.zadd(prefix + token, {note_id: timestamp})
+
+
+def queue_unlinks(pipe, note_id, removed, timestamp):
+    author, public, tokens, groups, _, *readers = removed
+    public, groups = (public == "1"), groups.split()
+
+    pipe.zrem(keyspace.user(author, "notes"), note_id)
+    pipe.zrem(keyspace.shard_for("expiring-notes", note_id), note_id)
+    if public:
+        pipe.zrem(keyspace.shard_for("public-notes", note_id), note_id)
+        queue_public_version(pipe, timestamp)
+    for user in readers:
+        pipe.zrem(keyspace.user(user, "shared"), note_id)
+    for group_id in groups:
+        pipe.zrem(keyspace.group(group_id, "notes"), note_id)
+    for prefix in index_prefixes(note_id, author, public, readers, groups):
+        for token in tokens.split():
+            pipe.zrem(prefix + token, note_id)
+
+
+def queue_public_version(pipe, timestamp):
+    pipe.hincrby("public-notes:version", "version", 1)
+    pipe.hset("public-notes:version", "modified", timestamp)
 
 
 def delete(note_id):
-    if not note_id or not redis.exists(f"note:{note_id}:content"):
+    if not note_id:
         return False
 
-    readers = redis.smembers(f"note:{note_id}:readers")
-    for user in readers:
-        redis.srem(f"user:{user}:shared", note_id)
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    if keyspace.cluster:
+        removed = delete_content_script(keys=all_note_keys(note_id))
+        if not removed:
+            return False
 
-    author = redis.hget(f"note:{note_id}:content", "author")
+        pipe = redis.pipeline(transaction=False)
+        queue_release(pipe, note_id, removed, timestamp)
+        pipe.execute()
+        return True
 
-    redis.delete(f"note:{note_id}:readers")
-    redis.delete(f"note:{note_id}:content")
+    return bool(delete_script(keys=delete_keys(note_id), args=[note_id, timestamp]))
 
-    redis.srem(f"user:{author}:notes", note_id)
-    redis.srem("public-notes", note_id)
-    return True
+
+def queue_release(pipe, note_id, removed, timestamp):
+    queue_unlinks(pipe, note_id, removed, timestamp)
+    if removed[4]:
+        release_blob_script(keys=[keyspace.blob(removed[4])], client=pipe)
+
+
+def delete_keys(note_id):
+    content, readers, tokens, history = all_note_keys(note_id)
+    return [content, readers, keyspace.shard_for("public-notes", note_id),
+            "public-notes:version", tokens, keyspace.shard_for("expiring-notes", note_id),
+            history]
+
+
+def edit(note, title, content):
+    # Saving an unchanged note would only bump its version and add an empty
+    # history entry.
+    if title == note["title"] and content == note["content"]:
+        return True
+
+    note_id = note["id"]
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    tokens = utils.tokenize(f"{title} {content}")
+    entry = history_entry(note, title, content)
+    pipe = body_pipeline()
+    stored, encoding = store_body(content, pipe)
+    args = edit_args(note, title, stored, encoding, timestamp, entry, tokens)
+
+    if keyspace.cluster:
+        if encoding == BLOB:
+            pipe.execute()
+        edited = edit_content_script(keys=all_note_keys(note_id), args=args)
+        if edited:
+            pipe = redis.pipeline(transaction=False)
+            queue_reindex(pipe, note_id, edited, tokens, timestamp)
+            if edited[4]:
+                release_blob_script(keys=[keyspace.blob(edited[4])], client=pipe)
+            pipe.execute()
+    else:
+        edit_script(keys=[*all_note_keys(note_id), "public-notes:version"],
+                    args=[note_id, *args], client=pipe)
+        edited = pipe.execute()[-1]
+
+    # The note changed since it was read, so the body stored for it is given back.
+    if not edited and encoding == BLOB:
+        release_blob_script(keys=[keyspace.blob(stored)])
+    return bool(edited)
+
+
+def edit_args(note, title, content, encoding, timestamp, entry, tokens):
+    return [note.get("version", "0"), title, content, encoding, timestamp, entry,
+            config.settings.note_history_depth, *tokens]
+
+
+def queue_reindex(pipe, note_id, edited, tokens, timestamp):
+    author, public, old_tokens, groups, _, score, *readers = edited
+    public, groups, old_tokens = (public == "1"), groups.split(), old_tokens.split()
+    removed = [token for token in old_tokens if token not in tokens]
+    added = [token for token in tokens if token not in old_tokens]
+
+    for prefix in index_prefixes(note_id, author, public, readers, groups):
+        for token in removed:
+            pipe.zrem(prefix + token, note_id)
+        for token in added:
+            pipe.zadd(prefix + token, {note_id: score})
+    if public:
+        queue_public_version(pipe, timestamp)
+
+
+# Each history entry is a reverse delta that rebuilds the previous version from
+# the next one, so a note costs one full copy plus the size of its edits.
+def history_entry(note, title, content):
+    saved = note.get("edited") or note["datetime"]
+    entry = {"datetime": int(saved.timestamp()), "delta": diff(content, note["content"])}
+    if title != note["title"]:
+        entry["title"] = note["title"]
+    return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+def diff(new, old):
+    new_lines, old_lines = new.splitlines(True), old.splitlines(True)
+    new_starts, old_starts = line_starts(new_lines), line_starts(old_lines)
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+
+    delta = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        start, end = new_starts[i1], new_starts[i2]
+        old_start, old_end = old_starts[j1], old_starts[j2]
+        if tag == "equal":
+            add_copy(delta, start, end - start)
+            continue
+
+        # Changed lines keep whatever they share at both ends with the old ones.
+        limit = min(end - start, old_end - old_start)
+        prefix = 0
+        while prefix < limit and new[start + prefix] == old[old_start + prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and new[end - suffix - 1] == old[old_end - suffix - 1]:
+            suffix += 1
+
+        add_copy(delta, start, prefix)
+        add_text(delta, old[old_start + prefix:old_end - suffix])
+        add_copy(delta, end - suffix, suffix)
+    return delta
+
+
+def line_starts(lines):
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+    return starts
+
+
+def add_copy(delta, start, length):
+    if not length:
+        return
+    if delta and isinstance(delta[-1], list) and sum(delta[-1]) == start:
+        delta[-1][1] += length
+    else:
+        delta.append([start, length])
+
+
+def add_text(delta, text):
+    if not text:
+        return
+    if delta and isinstance(delta[-1], str):
+        delta[-1] += text
+    else:
+        delta.append(text)
+
+
+def patch(content, delta):
+    return "".join(content[op[0]:op[0] + op[1]] if isinstance(op, list) else op
+                   for op in delta)
+
+
+def get_history(note, limit=None):
+    limit = limit or config.settings.note_history_depth
+    if limit < 1:
+        return []
+    entries = redis.lrange(keyspace.note(note["id"], "history"), 0, limit - 1)
+    return build_history(note, entries)
+
+
+def build_history(note, entries):
+    history = []
+    title, content = note["title"], note["content"]
+    for raw in entries:
+        entry = json.loads(raw)
+        title = entry.get("title", title)
+        content = patch(content, entry["delta"])
+        history.append({"title": title, "content": content,
+                        "datetime": local_time(entry["datetime"])})
+    return history
+
+
+def delete_many(note_ids):
+    timestamp = int(datetime.now(pytz.utc).timestamp())
+    pipe = redis.pipeline(transaction=False)
+    if keyspace.cluster:
+        for note_id in note_ids:
+            delete_content_script(keys=all_note_keys(note_id), client=pipe)
+        removed = pipe.execute() if note_ids else []
+        for note_id, note_removed in zip(note_ids, removed):
+            if note_removed:
+                queue_release(pipe, note_id, note_removed, timestamp)
+        if any(removed):
+            pipe.execute()
+        return [bool(note_removed) for note_removed in removed]
+
+    for note_id in note_ids:
+        delete_script(keys=delete_keys(note_id), args=[note_id, timestamp], client=pipe)
+    return [bool(deleted) for deleted in (pipe.execute() if note_ids else [])]
+
+
+# Expired notes are removed from every index by the sweeper, a bounded batch
+# at a time; until then reads skip them.
+def sweep_expired(limit=None):
+    limit = limit or config.settings.expired_sweep_batch
+    pipe = redis.pipeline(transaction=False)
+    queue_expired(pipe, limit)
+    note_ids = [note_id for ids in pipe.execute() for note_id in ids][:limit]
+    if not note_ids:
+        return 0
+
+    # Ids left behind by notes that are already gone only need the index entry removed.
+    for note_id, deleted in zip(note_ids, delete_many(note_ids)):
+        if not deleted:
+            pipe.zrem(keyspace.shard_for("expiring-notes", note_id), note_id)
+    pipe.execute()
+    return len(note_ids)
+
+
+def sweep_all(batch_size=None):
+    batch_size = batch_size or config.settings.expired_sweep_batch
+    count = 0
+    while True:
+        swept = sweep_expired(batch_size)
+        count += swept
+        if swept < batch_size:
+            return count
+
+
+# Every worker sweeps from its own thread, started by its first request so
+# that it also runs in workers forked from a preloaded app.
+def start_sweeper():
+    global sweeper
+    if sweeper is not None or not config.settings.expired_sweep_seconds:
+        return
+    with sweeper_lock:
+        if sweeper is None:
+            sweeper = Thread(target=run_sweeper, name="expired-notes-sweeper", daemon=True)
+            sweeper.start()
+
+
+def run_sweeper():
+    global sweeper
+    while config.settings.expired_sweep_seconds:
+        sleep(config.settings.expired_sweep_seconds)
+        try:
+            sweep_all()
+        except RedisError as e:
+            print(f"Expired notes sweep failed: {e}", flush=True)
+    with sweeper_lock:
+        sweeper = None
+
+
+def queue_expired(pipe, limit):
+    now = int(datetime.now(pytz.utc).timestamp())
+    for key in keyspace.shards("expiring-notes"):
+        pipe.zrangebyscore(key, "-inf", now, start=0, num=limit)
+
+
+# A cached page must not outlive the first note on it to expire. Private
+# notes are not told apart here, they only make the page expire early.
+def public_cache_seconds():
+    now = int(datetime.now(pytz.utc).timestamp())
+    pipe = redis.pipeline(transaction=False)
+    queue_next_expiry(pipe, now)
+    return cache_seconds(pipe.execute(), now)
+
+
+def queue_next_expiry(pipe, now):
+    for key in keyspace.shards("expiring-notes"):
+        pipe.zrangebyscore(key, f"({now}", "+inf", start=0, num=1, withscores=True)
+
+
+def cache_seconds(next_expiries, now):
+    expires = [int(score) for found in next_expiries for _, score in found]
+    return min([config.settings.page_cache_seconds, *(score - now for score in expires)])
 
 
 def get(note_id):
-    note = redis.hgetall(f"note:{note_id}:content")
+    found = get_many([note_id])
+    return found[0] if found else {}
+
+
+def get_many(note_ids):
+    pipe = redis.pipeline(transaction=False)
+    queue_reads(pipe, note_ids)
+    results = pipe.execute() if note_ids else []
+    resolve_blobs(results[0::2])
+
+    rewrites = reencodings(note_ids, results)
+    if rewrites:
+        pipe = redis.pipeline(transaction=False)
+        for keys, args in rewrites:
+            encode_script(keys=keys, args=args, client=pipe)
+        pipe.execute()
+    return build_many(note_ids, results)
+
+
+def iter_many(note_ids, batch_size=None):
+    # Lets a streamed page hold one batch of notes at a time.
+    batch_size = batch_size or config.settings.notes_stream_batch_size
+    for start in range(0, len(note_ids), batch_size):
+        yield from get_many(note_ids[start:start + batch_size])
+
+
+def queue_reads(pipe, note_ids):
+    for note_id in note_ids:
+        pipe.hgetall(keyspace.note(note_id, "content"))
+        pipe.smembers(keyspace.note(note_id, "readers"))
+
+
+def build_many(note_ids, results):
+    now = datetime.now(pytz.utc).timestamp()
+    found = []
+    for i, note_id in enumerate(note_ids):
+        note, readers = results[2 * i], results[2 * i + 1]
+        if note and not expired(note, now):
+            found.append(build(note_id, note, readers))
+    return found
+
+
+def expired(note, now):
+    return bool(note.get("expires")) and float(note["expires"]) <= now
+
+
+def build(note_id, note, readers):
+    note["content"] = decode_content(note)
+    note.pop("encoding", None)
+    note.pop("blob", None)
+    groups = note.pop("groups", "").split()
     note["public"] = (note.get("public") == "1")
     note["id"] = note_id
 
-    utc = datetime.fromtimestamp(float(note["datetime"]), tz=pytz.utc)
-    local = utils.to_local_time(utc)
+    local = local_time(note["datetime"])
     note["date"] = local.date()
     note["time"] = local.time()
     note["datetime"] = local
 
-    if not note.get("public") and redis.exists(f"note:{note_id}:readers"):
-        note["readers"] = redis.smembers(f"note:{note_id}:readers")
+    for name in ("expires", "edited"):
+        if note.get(name):
+            note[name] = local_time(note[name])
+
+    shared = sorted(readers) + ["@" + group_name(group_id) for group_id in groups]
+    if not note.get("public") and shared:
+        note["readers"] = shared
     return note
 
 
-def check_readers(readers):
-    for user in readers.split(","):
-        user = user.strip()
-        if len(user) > 0 and not (user.isalpha() and db.username_taken(user)):
+def local_time(timestamp):
+    return utils.to_local_time(datetime.fromtimestamp(float(timestamp), tz=pytz.utc))
+
+
+def group_name(group_id):
+    return group_id.partition(".")[2]
+
+
+def encode_content(content, compress=None):
+    if compress is None:
+        compress = config.settings.note_compression
+    raw = content.encode()
+    if not compress or len(raw) < config.settings.note_compression_min_bytes:
+        return content, ""
+
+    encoded = base64.b85encode(zlib.compress(raw, 9)).decode()
+    if len(encoded) >= len(raw):
+        return content, ""
+    return encoded, ENCODING
+
+
+def decode_content(note):
+    if note.get("encoding") == ENCODING:
+        return zlib.decompress(base64.b85decode(note["content"])).decode()
+    return note.get("content")
+
+
+# Bodies at least note_dedup_min_bytes long are stored once per distinct
+# content in a reference-counted blob, and the note keeps only its digest.
+def store_body(content, client=None):
+    stored, encoding = encode_content(content)
+    digest = body_digest(content)
+    if not digest:
+        return stored, encoding
+
+    store_blob_script(keys=[keyspace.blob(digest)], args=[stored, encoding], client=client)
+    return digest, BLOB
+
+
+# Outside a cluster the blob reference and the note write share one MULTI, so
+# a crash cannot leave a reference without its note. Blobs live in their own
+# slot in a cluster, where the reference is taken first: a leaked count only
+# keeps a body alive, while a note written first could lose its body.
+def body_pipeline():
+    return redis.pipeline(transaction=not keyspace.cluster)
+
+
+def body_digest(content):
+    raw = content.encode()
+    if not config.settings.note_dedup or len(raw) < config.settings.note_dedup_min_bytes:
+        return None
+    return hashlib.sha256(raw).hexdigest()
+
+
+def resolve_blobs(stored):
+    found = blob_notes(stored)
+    if found:
+        pipe = redis.pipeline(transaction=False)
+        queue_blob_reads(pipe, found)
+        fill_blobs(found, pipe.execute())
+
+
+def blob_notes(stored):
+    return [note for note in stored if note and note.get("encoding") == BLOB]
+
+
+def queue_blob_reads(pipe, found):
+    for note in found:
+        pipe.hmget(keyspace.blob(note["content"]), "content", "encoding")
+
+
+def fill_blobs(found, bodies):
+    for note, (content, encoding) in zip(found, bodies):
+        note["blob"] = note["content"]
+        note["content"], note["encoding"] = content or "", encoding or ""
+
+
+def reencoding(note):
+    if not note or note.get("encoding") == BLOB:
+        return None
+    if (note.get("encoding") == ENCODING) == config.settings.note_compression:
+        return None
+
+    content, encoding = encode_content(decode_content(note))
+    if encoding == note.get("encoding", ""):
+        return None
+    return [note["content"], content, encoding]
+
+
+def reencodings(note_ids, results):
+    rewrites = {}
+    for i, note_id in enumerate(note_ids):
+        note = results[2 * i]
+        args = reencoding(note)
+        if args:
+            rewrites[body_key(note_id, note)] = args
+    return [([key], args) for key, args in rewrites.items()]
+
+
+def body_key(note_id, note):
+    # A shared body is rewritten once in its blob, for every note using it.
+    return keyspace.blob(note["blob"]) if "blob" in note else keyspace.note(note_id, "content")
+
+
+def parse_readers(readers):
+    users = [user.strip() for user in readers.split(",")]
+    return list(dict.fromkeys(user for user in users if user))
+
+
+def split_readers(names):
+    users = [name for name in names if not name.startswith("@")]
+    groups = [name[1:] for name in names if name.startswith("@")]
+    return users, groups
+
+
+def check_readers(readers, author):
+    return check_readers_many(author, [readers])[0]
+
+
+def check_readers_many(author, readers_list):
+    names = [split_readers(parse_readers(readers)) for readers in readers_list]
+    taken, owned = lookup_reader_names(author, names)
+    return [first_invalid_reader(users, groups, [taken[user] for user in users],
+                                 [owned[name] for name in groups]) for users, groups in names]
+
+
+def lookup_reader_names(author, names):
+    users, groups = unique_reader_names(names)
+    taken, owned = check_reader_names(author, users, groups)
+    return dict(zip(users, taken)), dict(zip(groups, owned))
+
+
+def unique_reader_names(names):
+    users = list(dict.fromkeys(user for note_users, _ in names for user in note_users))
+    groups = list(dict.fromkeys(name for _, note_groups in names for name in note_groups))
+    return users, groups
+
+
+def check_reader_names(author, users, groups):
+    pipe = redis.pipeline(transaction=False)
+    shards = queue_reader_names(pipe, author, users, groups)
+    results = pipe.execute() if users or groups else []
+    return collect_reader_names(users, groups, shards, results)
+
+
+def queue_reader_names(pipe, author, users, groups):
+    shards = db.queue_usernames_taken(pipe, users)
+    if groups:
+        pipe.smismember(keyspace.user(author, "groups"), groups)
+    return shards
+
+
+def collect_reader_names(users, groups, shards, results):
+    taken = db.collect_usernames_taken(users, shards, results[:len(shards)])
+    owned = [bool(is_owned) for is_owned in results[len(shards)]] if groups else []
+    return taken, owned
+
+
+def first_invalid_reader(users, groups, taken, owned):
+    for user, user_taken in zip(users, taken):
+        if not (user.isalpha() and user_taken):
             return user
+    for name, is_owned in zip(groups, owned):
+        if not is_owned:
+            return "@" + name
     return True
 
 
-def get_sorted_notes(key):
-    notes = []
-    for note_id in redis.smembers(key):
-        notes.append(get(note_id))
-    notes = sorted(notes, key=lambda k: k["datetime"], reverse=True)
-    return notes
+def parse_cursor(cursor):
+    score, _, note_id = (cursor or "").partition(":")
+    if not (score.isdigit() and note_id):
+        return "", ""
+    return score, note_id
+
+
+def normalize_cursor(cursor):
+    score, note_id = parse_cursor(cursor)
+    return f"{score}:{note_id}" if score else ""
+
+
+def get_page_ids(key, cursor=None, limit=None):
+    limit = limit or config.settings.notes_page_size
+    page = page_script(keys=page_keys(key), args=page_args(cursor, limit))
+    return parse_page(page, limit)
+
+
+def page_keys(key):
+    # In cluster mode the expiry index lives in other slots, so expired ids
+    # are only dropped once loaded, until the sweeper removes them.
+    return [key] if keyspace.cluster else [key, "expiring-notes"]
+
+
+def page_args(cursor, limit):
+    score, note_id = parse_cursor(cursor)
+    return [score, note_id, limit + 1, int(datetime.now(pytz.utc).timestamp())]
+
+
+def parse_page(page, limit):
+    ids = page[0::2]
+    scores = page[1::2]
+
+    next_cursor = None
+    if len(ids) > limit:
+        next_cursor = f"{int(float(scores[limit - 1]))}:{ids[limit - 1]}"
+    return ids[:limit], next_cursor
+
+
+def get_merged_page_ids(keys, cursor=None, limit=None):
+    limit = limit or config.settings.notes_page_size
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        page_script(keys=page_keys(key), args=page_args(cursor, limit), client=pipe)
+    return merge_pages(pipe.execute(), limit)
+
+
+def merge_pages(pages, limit):
+    # A note shared directly and through a group shows up in both timelines.
+    entries = dict(entry for page in pages for entry in zip(page[0::2], page[1::2]))
+    entries = sorted(entries.items(), key=lambda entry: (float(entry[1]), entry[0]),
+                     reverse=True)
+    return parse_page([value for entry in entries[:limit + 1] for value in entry], limit)
+
+
+def get_page(key, cursor=None, limit=None, lazy=False):
+    ids, next_cursor = get_page_ids(key, cursor, limit)
+    return load(ids, lazy), next_cursor
+
+
+def load(note_ids, lazy=False):
+    return iter_many(note_ids) if lazy else get_many(note_ids)
+
+
+def get_my_notes(username, cursor=None, lazy=False, limit=None):
+    return get_page(keyspace.user(username, "notes"), cursor, limit, lazy)
+
+
+def get_public(cursor=None, lazy=False, limit=None):
+    keys = keyspace.shards("public-notes")
+    ids, next_cursor = get_merged_page_ids(keys, cursor, limit)
+    return load(ids, lazy), next_cursor
+
+
+def get_shared(username, cursor=None, lazy=False, limit=None):
+    keys = shared_keys(username, get_memberships(username))
+    ids, next_cursor = get_merged_page_ids(keys, cursor, limit)
+    return load(ids, lazy), next_cursor
+
+
+def get_readable(note_ids, username):
+    found = get_many(note_ids)
+    memberships = ()
+    if not all(can_read(note, username, memberships) for note in found):
+        memberships = get_memberships(username)
+    return [note for note in found if can_read(note, username, memberships)]
+
+
+def can_read(note, username, memberships):
+    if note["public"] or note["author"] == username:
+        return True
+    readers = note.get("readers", [])
+    return username in readers or any(
+        keyspace.group_id(note["author"], name[1:]) in memberships
+        for name in readers if name.startswith("@"))
+
+
+def get_memberships(username):
+    return redis.smembers(keyspace.user(username, "memberships"))
+
+
+def shared_keys(username, groups):
+    return [keyspace.user(username, "shared"),
+            *(keyspace.group(group_id, "notes") for group_id in sorted(groups))]
+
+
+def migrate_timelines(batch_size=500):
+    keys = keyspace.shards("public-notes")
+    keys += redis.scan_iter(match="user:*:notes", count=batch_size)
+    keys += redis.scan_iter(match="user:*:shared", count=batch_size)
+
+    migrated = 0
+    for key in keys:
+        if redis.type(key) != "set":
+            continue
+
+        tmp_key = f"{key}:migrating"
+        redis.delete(tmp_key)
+
+        batch = []
+        for note_id in redis.sscan_iter(key, count=batch_size):
+            batch.append(note_id)
+            if len(batch) >= batch_size:
+                migrate_timeline_batch(tmp_key, batch)
+                batch = []
+        if batch:
+            migrate_timeline_batch(tmp_key, batch)
+
+        if redis.exists(tmp_key):
+            redis.rename(tmp_key, key)
+        else:
+            redis.delete(key)
+        migrated += 1
+    return migrated
+
+
+def migrate_timeline_batch(key, note_ids):
+    pipe = redis.pipeline(transaction=False)
+    for note_id in note_ids:
+        pipe.hget(keyspace.note(note_id, "content"), "datetime")
+    timestamps = pipe.execute()
+
+    scores = {note_id: int(float(timestamp))
+              for note_id, timestamp in zip(note_ids, timestamps) if timestamp}
+    if scores:
+        redis.zadd(key, scores)
+
+
+def encode_notes(batch_size=500):
+    rewritten = 0
+    for keys, stored in scan_bodies(batch_size):
+        pipe = redis.pipeline(transaction=False)
+        for key, note in zip(keys, stored):
+            args = reencoding(note)
+            if args:
+                encode_script(keys=[key], args=args, client=pipe)
+        rewritten += sum(pipe.execute())
+    return rewritten
+
+
+def compression_report(batch_size=500):
+    report = {"bodies": 0, "compressed": 0, "shared": 0, "raw_bytes": 0,
+              "stored_bytes": 0, "compressible_bytes": 0}
+    for keys, stored in scan_bodies(batch_size):
+        for key, note in zip(keys, stored):
+            if not note or note["encoding"] == BLOB:
+                continue
+            content = decode_content(note)
+            report["bodies"] += 1
+            report["compressed"] += note.get("encoding") == ENCODING
+            report["shared"] += key.startswith("blob:")
+            report["raw_bytes"] += len(content.encode())
+            report["stored_bytes"] += len(note["content"].encode())
+            report["compressible_bytes"] += len(encode_content(content, True)[0].encode())
+    return report
+
+
+# Notes that only point at a blob are skipped by the callers and the blob is
+# scanned instead, so a shared body is counted and rewritten only once.
+def scan_bodies(batch_size):
+    for pattern in ["note:*:content", "blob:*"]:
+        batch = []
+        for key in redis.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield batch, read_bodies(batch)
+                batch = []
+        if batch:
+            yield batch, read_bodies(batch)
 
 
-def get_my_notes(username):
-    return get_sorted_notes(f"user:{username}:notes")
+def read_bodies(keys):
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, "content", "encoding")
+    return [{"content": content, "encoding": encoding or ""} if content is not None else None
+            for content, encoding in pipe.execute()]
 
 
-def get_public():
-    return get_sorted_notes("public-notes")
+def dedup_report(batch_size=500):
+    report = {"blobs": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0}
+    batch = []
+    for key in redis.scan_iter(match="blob:*", count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            count_blobs(report, batch)
+            batch = []
+    if batch:
+        count_blobs(report, batch)
+    return report
 
 
-def get_shared(username):
-    return get_sorted_notes(f"user:{username}:shared")
+def count_blobs(report, keys):
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, "refs", "content")
+    for refs, content in pipe.execute():
+        if content is None:
+            continue
+        size = len(content.encode())
+        report["blobs"] += 1
+        report["references"] += int(refs or 0)
+        report["stored_bytes"] += size
+        report["referenced_bytes"] += size * int(refs or 0)
@@ -0,0 +1,101 @@
+import secrets
+import db
+import notes
+import utils
+import config
+import keyspace
+
+
+redis = db.redis
+
+search_script = db.load_script("search")
+
+INDEX_PATTERNS = ["search:public:*", "user:*:search:*", "group:*:search:*", "note:*:tokens"]
+
+
+def search(username, query):
+    tokens = query_tokens(query)
+    if not tokens:
+        return []
+
+    groups = notes.get_memberships(username) if username else []
+    pipe = redis.pipeline(transaction=False)
+    for keys in search_keys(username, tokens, groups):
+        search_script(keys=keys, args=[config.settings.search_results_limit], client=pipe)
+    return notes.get_many(merge(pipe.execute()))
+
+
+def query_tokens(query):
+    return utils.tokenize(query)[:config.settings.search_max_terms]
+
+
+def search_keys(username, tokens, groups=()):
+    # The temporary key shares the hash tag of the indexes it intersects.
+    return [[f"{prefix}tmp:{secrets.token_hex(8)}", *(prefix + token for token in tokens)]
+            for prefix in keyspace.search_prefixes(username, sorted(groups))]
+
+
+def merge(results):
+    scores = {}
+    for result in results:
+        for note_id, score in zip(result[0::2], result[1::2]):
+            scores[note_id] = float(score)
+
+    note_ids = sorted(scores, key=lambda k: (scores[k], k), reverse=True)
+    return note_ids[:config.settings.search_results_limit]
+
+
+def rebuild(batch_size=500):
+    for pattern in INDEX_PATTERNS:
+        batch = []
+        for key in redis.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                redis.unlink(*batch)
+                batch = []
+        if batch:
+            redis.unlink(*batch)
+
+    count = 0
+    batch = []
+    for key in redis.scan_iter(match="note:*:content", count=batch_size):
+        batch.append(keyspace.note_id(key))
+        if len(batch) >= batch_size:
+            count += index_batch(batch)
+            batch = []
+    if batch:
+        count += index_batch(batch)
+    return count
+
+
+def index_batch(note_ids):
+    pipe = redis.pipeline(transaction=False)
+    for note_id in note_ids:
+        pipe.hgetall(keyspace.note(note_id, "content"))
+        pipe.smembers(keyspace.note(note_id, "readers"))
+    results = pipe.execute()
+    notes.resolve_blobs(results[0::2])
+
+    count = 0
+    for i, note_id in enumerate(note_ids):
+        note, readers = results[2 * i], results[2 * i + 1]
+        if not note:
+            continue
+
+        tokens = utils.tokenize(f"{note.get('title')} {notes.decode_content(note)}")
+        if not tokens:
+            continue
+
+        prefixes = notes.index_prefixes(
+            note_id, note.get("author"), note.get("public") == "1", readers,
+            note.get("groups", "").split())
+
+        score = int(float(note.get("datetime")))
+        for prefix in prefixes:
+            for token in tokens:
+                pipe.zadd(prefix + token, {note_id: score})
+        pipe.set(keyspace.note(note_id, "tokens"), " ".join(tokens))
+        count += 1
+
+    pipe.execute()
+    return count
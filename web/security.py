@@ -0,0 +1,52 @@
+from datetime import datetime
+from redis.exceptions import ResponseError
+import pytz
+import db
+import keyspace
+
+
+redis = db.redis
+
+
+def get_failed_logins(since=None, until=None, count=None):
+    entries = redis.xrange(keyspace.FAILED_LOGINS, *reversed(db.login_range(since, until)),
+                           count=count)
+    return [parse_failed_login(entry) for entry in entries]
+
+
+def parse_failed_login(entry):
+    entry_id, fields = entry
+    return {
+        "id": entry_id,
+        "datetime": datetime.fromtimestamp(int(entry_id.split("-")[0]) // 1000, tz=pytz.utc),
+        "username": fields.get("username"),
+        "ip": fields.get("ip")
+    }
+
+
+def create_group(group, start="$"):
+    try:
+        redis.xgroup_create(keyspace.FAILED_LOGINS, group, id=start, mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def tail_failed_logins(group, consumer, block_ms=5000, count=100):
+    create_group(group)
+
+    # Entries delivered to this consumer before a crash are pending until
+    # acknowledged, so they are replayed before reading new ones.
+    last_id = "0"
+    while True:
+        streams = redis.xreadgroup(group, consumer, {keyspace.FAILED_LOGINS: last_id},
+                                   count=count, block=block_ms)
+        entries = streams[0][1] if streams else []
+        if last_id == "0" and not entries:
+            last_id = ">"
+            continue
+
+        for entry in entries:
+            yield parse_failed_login(entry)
+        if entries:
+            redis.xack(keyspace.FAILED_LOGINS, group, *(entry_id for entry_id, _ in entries))
@@ -1,34 +1,99 @@
-from yaml import safe_load
+from os import getenv
+from datetime import datetime
+import base64
+import hashlib
+import hmac
 import secrets
+import pytz
 import db
+import config
+import keyspace
 
 
 redis = db.redis
-config = safe_load(open("config.yaml"))
+secret = (getenv("SESSION_SECRET") or getenv("FLASH_SECRET") or "").encode()
+
+
+def signed_mode():
+    return config.settings.session_mode == "signed"
+
+
+def now_ms():
+    return int(datetime.now(pytz.utc).timestamp() * 1000)
+
+
+def sign(username, issued):
+    payload = f"{username}.{issued}"
+    digest = hmac.new(secret, payload.encode(), hashlib.sha256).digest()
+    signature = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+    return f"{payload}.{signature}"
+
+
+def verify(token):
+    payload, _, signature = token.rpartition(".")
+    username, _, issued = payload.partition(".")
+    if not (username and issued.isdigit()):
+        return None, 0
+
+    if not hmac.compare_digest(sign(username, issued), token):
+        return None, 0
+    return username, int(issued)
+
+
+def get_signed(token):
+    username, issued = verify_fresh(token)
+    if not username:
+        return {}
+    return signed_session(username, issued, redis.zscore("revoked-sessions", username))
+
+
+def verify_fresh(token):
+    username, issued = verify(token)
+    if not username or now_ms() - issued > config.settings.session_expire_seconds * 1000:
+        return None, 0
+    return username, issued
+
+
+def signed_session(username, issued, revoked):
+    if revoked is not None and issued <= revoked:
+        return {}
+
+    now = now_ms()
+    expire_ms = config.settings.session_expire_seconds * 1000
+    session = {"username": username}
+    if now - issued > expire_ms / 2:
+        session["renewed_id"] = sign(username, now)
+    return session
 
 
 def get(id_):
+    if signed_mode():
+        return get_signed(id_)
+
     session = redis.hgetall(f"session:{id_}")
     username = session.get("username")
     if username:
-        set_expiration(username, config["session_expire_seconds"])
+        set_expiration(username, config.settings.session_expire_seconds)
     return session
 
 
 def save(username, key="", value=""):
-    user_session_key = f"user:{username}:session"
+    if signed_mode():
+        return sign(username, now_ms())
+
+    user_session_key = keyspace.user(username, "session")
 
     if not redis.hget(user_session_key, "id"):
-        id_ = secrets.token_urlsafe(config["session_token_bytes"])
+        id_ = secrets.token_urlsafe(config.settings.session_token_bytes)
         while(redis.exists(f"session:{id_}")):
-            id_ = secrets.token_urlsafe(config["session_token_bytes"])
+            id_ = secrets.token_urlsafe(config.settings.session_token_bytes)
 
         redis.hset(user_session_key, "id", id_)
         redis.hset(f"session:{id_}", "username", username)
     else:
         id_ = redis.hget(user_session_key, "id")
 
-    set_expiration(username, config["session_expire_seconds"])
+    set_expiration(username, config.settings.session_expire_seconds)
 
     if key and key != username:
         redis.hset(f"session:{id_}", key, value)
@@ -36,12 +101,24 @@ def save(username, key="", value=""):
     return id_
 
 
+def queue_revocation(pipe, username):
+    now = now_ms()
+    expire_ms = config.settings.session_expire_seconds * 1000
+    pipe.zadd("revoked-sessions", {username: now})
+    pipe.zremrangebyscore("revoked-sessions", "-inf", now - expire_ms)
+
+
 def set_expiration(username, seconds):
-    session_key = f"user:{username}:session"
+    session_key = keyspace.user(username, "session")
     if redis.exists(session_key):
         redis.expire("session:" + redis.hget(session_key, "id"), seconds)
         redis.expire(session_key, seconds)
 
 
 def clear(username):
-    set_expiration(username, 0)
+    if signed_mode():
+        pipe = redis.pipeline(transaction=False)
+        queue_revocation(pipe, username)
+        pipe.execute()
+    else:
+        set_expiration(username, 0)
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+
+# The app modules open lua/ and templates/ relative to web/ and create their
+# Redis clients at import time, so fakeredis has to be in place first.
+WEB = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WEB)
+sys.path.insert(0, WEB)
+os.environ.pop("REDIS_URL", None)
+os.environ.setdefault("FLASH_SECRET", "tests")
+
+import fakeredis  # noqa: E402
+import redis  # noqa: E402
+import redis.asyncio  # noqa: E402
+
+redis.Redis = fakeredis.FakeRedis
+redis.asyncio.Redis = fakeredis.FakeAsyncRedis
+
+import pytest  # noqa: E402
+import config  # noqa: E402
+import db  # noqa: E402
+
+db.set_hash_executor(ThreadPoolExecutor(2))
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(config, "settings", config.settings._replace(bcrypt_rounds=4))
+    db.redis.flushall()
+
+    def override(**values):
+        monkeypatch.setattr(config, "settings", config.settings._replace(**values))
+    return override
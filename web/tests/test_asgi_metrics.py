@@ -0,0 +1,33 @@
+import asyncio
+import asgi
+import metrics
+
+
+def get(path):
+    async def request():
+        response = await asgi.app.test_client().get(path)
+        return response.status_code, await response.get_data(as_text=True)
+    return asyncio.run(request())
+
+
+def test_metrics_count_async_redis_commands():
+    assert get("/public-notes")[0] == 200
+
+    status, body = get("/metrics")
+    assert status == 200
+    assert 'requests_total{endpoint="public_notes",status="200"} 1' in body
+    assert 'redis_commands_total{command="EVALSHA",endpoint="public_notes"}' in body
+
+
+def test_request_counts_stay_separate_between_tasks():
+    async def count(commands):
+        metrics.start_request()
+        for _ in range(commands):
+            await asyncio.sleep(0)
+            metrics.record_round_trip(["GET"], 0)
+        return metrics.finish_request("task", 200)["round_trips"]
+
+    async def run():
+        return await asyncio.gather(count(1), count(3))
+
+    assert asyncio.run(run()) == [1, 3]
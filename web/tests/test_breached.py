@@ -0,0 +1,73 @@
+import pytest
+import breached
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / "passwords.txt"
+    path.write_text("".join(f"haslo{i}\n" for i in range(1000)) + "\n")
+    return path
+
+
+def build(tmp_path, corpus, **options):
+    path = tmp_path / "passwords.bloom"
+    result = breached.build(str(corpus), str(path), **options)
+    return breached.BloomFilter(str(path)), result
+
+
+def test_every_listed_password_is_found(tmp_path, corpus):
+    bloom, result = build(tmp_path, corpus, error_rate=0.001)
+
+    assert result["entries"] == 1000
+    assert all(f"haslo{i}" in bloom for i in range(1000))
+
+
+def test_false_positive_rate_stays_near_the_target(tmp_path, corpus):
+    bloom, _ = build(tmp_path, corpus, error_rate=0.01)
+
+    false_positives = sum(f"inne{i}" in bloom for i in range(10000))
+
+    assert false_positives < 300
+
+
+def test_sha1_corpus_matches_plain_passwords(tmp_path):
+    import hashlib
+    corpus = tmp_path / "sha1.txt"
+    corpus.write_text("".join(f"{hashlib.sha1(p.encode()).hexdigest().upper()}:42\n"
+                              for p in ["password", "123456"]))
+
+    bloom, _ = build(tmp_path, corpus, mode=breached.SHA1)
+
+    assert "password" in bloom and "123456" in bloom
+    assert "correct horse battery staple" not in bloom
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"NAKBLOOM",
+    b"NAKBLOOM\x00",
+    b"x" * 64,
+    breached.HEADER.pack(b"OTHERMAG", 0, 64, 3) + bytes(8),
+    breached.HEADER.pack(breached.MAGIC, 0, 1024, 3) + bytes(8),
+    breached.HEADER.pack(breached.MAGIC, 0, 64, 3) + bytes(16),
+    breached.HEADER.pack(breached.MAGIC, 0, 0, 3),
+    breached.HEADER.pack(breached.MAGIC, 0, 60, 3) + bytes(8),
+    breached.HEADER.pack(breached.MAGIC, 0, 64, 0) + bytes(8),
+    breached.HEADER.pack(breached.MAGIC, 7, 64, 3) + bytes(8),
+])
+def test_invalid_files_are_rejected(tmp_path, data):
+    path = tmp_path / "bad.bloom"
+    path.write_bytes(data)
+
+    with pytest.raises(ValueError, match="bad.bloom"):
+        breached.BloomFilter(str(path))
+
+
+def test_unreadable_filter_disables_the_check(tmp_path, settings):
+    path = tmp_path / "bad.bloom"
+    path.write_bytes(b"NAKBLOOM")
+    settings(breached_passwords_filter=str(path))
+    breached.filters.clear()
+
+    assert not breached.is_breached("password")
+    assert breached.filters[str(path)] is None
@@ -0,0 +1,25 @@
+import runpy
+import signal
+import pytest
+import app  # noqa: F401
+import config
+
+pytestmark = pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="no SIGHUP")
+
+
+@pytest.fixture(autouse=True)
+def restore_handler():
+    previous = signal.getsignal(signal.SIGHUP)
+    yield
+    signal.signal(signal.SIGHUP, previous)
+
+
+def test_importing_the_app_leaves_sighup_alone():
+    assert signal.getsignal(signal.SIGHUP) is not config.reload
+
+
+def test_worker_hook_installs_the_reload_handler():
+    hooks = runpy.run_path("gunicorn.conf.py")
+    hooks["post_worker_init"](None)
+
+    assert signal.getsignal(signal.SIGHUP) is config.reload
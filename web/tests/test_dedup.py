@@ -0,0 +1,39 @@
+import pytest
+import db
+import keyspace
+import notes
+
+BODY = "Ta sama treść notatki, zapisana kilka razy. " * 4
+
+
+@pytest.fixture(autouse=True)
+def dedup(settings):
+    settings(note_dedup=True, note_dedup_min_bytes=64)
+    db.create_user("alice", "alice@example.com", "Passw0rd!x")
+
+
+def refs():
+    digest = notes.body_digest(BODY)
+    return int(db.redis.hget(keyspace.blob(digest), "refs") or 0)
+
+
+def test_identical_bodies_share_one_counted_blob():
+    first, second = notes.create_many("alice", [("a", BODY, "", True), ("b", BODY, "", False)])
+
+    assert refs() == 2
+    assert notes.get(first)["content"] == BODY
+
+    notes.delete(first)
+    assert refs() == 1
+    notes.delete(second)
+    assert not db.redis.exists(keyspace.blob(notes.body_digest(BODY)))
+
+
+def test_stale_edit_gives_its_reference_back():
+    note_id = notes.create("alice", "a", "krótka", "", True)
+    note = notes.get(note_id)
+    assert notes.edit(note, "a", BODY)
+    assert refs() == 1
+
+    assert not notes.edit(note, "b", BODY)
+    assert refs() == 1
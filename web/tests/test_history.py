@@ -0,0 +1,62 @@
+import pytest
+import db
+import keyspace
+import notes
+
+
+CASES = [
+    ("", ""),
+    ("", "nowa treść"),
+    ("stara treść", ""),
+    ("ala ma kota", "ala ma psa"),
+    ("pierwsza\ndruga\ntrzecia\n", "pierwsza\nDRUGA\ntrzecia\n"),
+    ("a\nb\nc\nd\n", "d\nc\nb\na\n"),
+    ("wiersz\n" * 50, "wiersz\n" * 20 + "wstawka\n" + "wiersz\n" * 30),
+    ("zażółć gęślą jaźń\n", "zażółć gęślą jaźń\nkoniec bez nowej linii"),
+    ("x\r\ny\r\n", "x\ny\n"),
+]
+
+
+@pytest.mark.parametrize("old, new", CASES)
+def test_patch_rebuilds_the_previous_version(old, new):
+    assert notes.patch(new, notes.diff(new, old)) == old
+
+
+def test_unchanged_text_is_a_single_copy():
+    text = "jeden\ndwa\ntrzy\n"
+
+    assert notes.diff(text, text) == [[0, len(text)]]
+
+
+def test_small_edit_stores_only_the_changed_text():
+    old = "początek\n" + "środek " * 100 + "\nkoniec\n"
+    new = old.replace("koniec", "KONIEC")
+
+    delta = notes.diff(new, old)
+
+    assert [op for op in delta if isinstance(op, str)] == ["koniec"]
+    assert notes.patch(new, delta) == old
+
+
+def test_history_replays_deltas_newest_first():
+    versions = ["v1\n", "v1\nv2\n", "v2\nv3\n"]
+    entries = [{"delta": notes.diff(new, old), "datetime": 0}
+               for old, new in zip(versions, versions[1:])]
+    note = {"title": "t", "content": versions[-1]}
+
+    history = notes.build_history(note, [notes.json.dumps(entry)
+                                         for entry in reversed(entries)])
+
+    assert [version["content"] for version in history] == versions[-2::-1]
+
+
+def test_saving_an_unchanged_note_writes_nothing():
+    db.create_user("alice", "alice@example.com", "Passw0rd!x")
+    note = notes.get(notes.create("alice", "tytuł", "treść", "", True))
+
+    assert notes.edit(note, "tytuł", "treść")
+    assert notes.get(note["id"]).get("version", "0") == note.get("version", "0")
+    assert not db.redis.exists(keyspace.note(note["id"], "history"))
+
+    assert notes.edit(note, "tytuł", "nowa treść")
+    assert db.redis.llen(keyspace.note(note["id"], "history")) == 1
@@ -0,0 +1,93 @@
+from unittest import mock
+import pytest
+import app
+import db
+import limits
+
+
+def check_at(milliseconds, action, **subjects):
+    with mock.patch.object(limits, "time", return_value=milliseconds / 1000):
+        limits.check(action, **subjects)
+
+
+def test_burst_is_allowed_then_rejected_with_retry_after(settings):
+    settings(register_ip_limit=3, register_limit_seconds=60)
+
+    for _ in range(3):
+        check_at(1000000, "register", ip="1.1.1.1")
+    with pytest.raises(limits.RateLimited) as limited:
+        check_at(1000000, "register", ip="1.1.1.1")
+
+    assert limited.value.retry_after == 20
+
+
+def test_requests_are_allowed_again_at_the_emission_interval(settings):
+    settings(register_ip_limit=3, register_limit_seconds=60)
+    for _ in range(3):
+        check_at(1000000, "register", ip="1.1.1.1")
+
+    with pytest.raises(limits.RateLimited) as limited:
+        check_at(1019500, "register", ip="1.1.1.1")
+    assert limited.value.retry_after == 1
+
+    check_at(1020000, "register", ip="1.1.1.1")
+    with pytest.raises(limits.RateLimited):
+        check_at(1020000, "register", ip="1.1.1.1")
+
+
+def test_subjects_are_limited_separately(settings):
+    settings(register_ip_limit=1, register_limit_seconds=60)
+
+    check_at(1000000, "register", ip="1.1.1.1")
+    check_at(1000000, "register", ip="2.2.2.2")
+    with pytest.raises(limits.RateLimited):
+        check_at(1000000, "register", ip="1.1.1.1")
+
+
+def test_rejected_requests_are_not_counted(settings):
+    settings(login_ip_limit=5, login_account_limit=1, login_limit_seconds=60)
+
+    check_at(1000000, "login", ip="1.1.1.1", account="alice")
+    for _ in range(5):
+        with pytest.raises(limits.RateLimited):
+            check_at(1000000, "login", ip="1.1.1.1", account="alice")
+
+    # The IP limit only saw the one request that was allowed.
+    for _ in range(4):
+        check_at(1000000, "login", ip="1.1.1.1", account=None)
+
+
+def test_zero_disables_a_limit(settings):
+    settings(register_ip_limit=0)
+
+    for _ in range(100):
+        limits.check("register", ip="1.1.1.1")
+    assert not db.redis.keys("rate-limit:*")
+
+
+def test_state_expires_with_the_period(settings):
+    settings(register_ip_limit=2, register_limit_seconds=60)
+
+    check_at(1000000, "register", ip="1.1.1.1")
+
+    assert 0 < db.redis.pttl("rate-limit:register:ip:1.1.1.1") <= 30000
+
+
+def test_forwarded_for_header_does_not_change_the_client_address():
+    with app.app.test_request_context(headers={"X-Forwarded-For": "6.6.6.6"},
+                                      environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        assert app.utils.get_ip(app.request) == "10.0.0.1"
+
+
+def test_reset_form_is_limited_before_the_password_is_hashed(settings):
+    settings(reset_ip_limit=0, reset_account_limit=2)
+    client = app.app.test_client()
+    password = "Zupelnie-Nowe-Haslo-2024!"
+    form = {"email": "alice@example.com", "password1": password, "password2": password}
+
+    with mock.patch.object(db, "reset_password", return_value=False) as reset:
+        statuses = [client.post("/reset-password/token", data=form).status_code
+                    for _ in range(3)]
+
+    assert statuses == [302, 302, 429]
+    assert reset.call_count == 2
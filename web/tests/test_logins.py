@@ -0,0 +1,57 @@
+from unittest import mock
+import pytest
+import app
+import db
+import keyspace
+
+
+@pytest.fixture
+def client():
+    db.create_user("alice", "alice@example.com", "Passw0rd!x")
+    return app.app.test_client()
+
+
+def login(client, username, password):
+    return client.post("/login", data={"username": username, "password": password})
+
+
+def failed_logins():
+    return [fields["username"] for _, fields in db.redis.xrange(keyspace.FAILED_LOGINS)]
+
+
+def test_failures_against_unknown_accounts_reach_the_feed(client):
+    login(client, "nobody", "guess")
+    login(client, "alice", "guess")
+
+    assert failed_logins() == ["nobody", "alice"]
+    assert not db.redis.exists(keyspace.user("nobody", "logins"))
+
+
+def test_attempt_is_recorded_before_the_password_is_checked(client):
+    delay, attempt_id, hashed = db.start_login_attempt("alice", "1.1.1.1")
+
+    assert delay == 0 and hashed
+    assert [attempt["success"] for attempt in db.get_login_attempts("alice")] == [False]
+
+    db.finish_login_attempt("alice", attempt_id, True, "1.1.1.1")
+    assert [attempt["success"] for attempt in db.get_login_attempts("alice")] == [True]
+    assert failed_logins() == []
+
+
+def test_repeated_failures_are_throttled(client):
+    for _ in range(3):
+        login(client, "alice", "guess")
+
+    delay, attempt_id, _ = db.start_login_attempt("alice", "1.1.1.1")
+
+    assert delay > 0 and attempt_id is None
+    assert len(db.get_login_attempts("alice")) == 3
+
+
+def test_busy_hashing_does_not_count_as_a_failure(client):
+    with mock.patch.object(db, "check_secret", side_effect=db.HashingBusy()):
+        response = login(client, "alice", "Passw0rd!x")
+
+    assert response.status_code == 503
+    assert db.get_login_attempts("alice") == []
+    assert failed_logins() == []
@@ -0,0 +1,75 @@
+import app
+import cache
+import db
+import notes
+
+
+redis = db.redis
+
+
+def read_all(key, limit):
+    ids, cursor = notes.get_page_ids(key, limit=limit)
+    pages = [ids]
+    while cursor:
+        ids, cursor = notes.get_page_ids(key, cursor, limit)
+        pages.append(ids)
+    return pages
+
+
+def test_pages_split_ties_within_one_second():
+    redis.zadd("timeline", {note_id: 100 for note_id in "abcde"})
+    redis.zadd("timeline", {"f": 200, "g": 50})
+
+    pages = read_all("timeline", 2)
+
+    assert pages == [["f", "e"], ["d", "c"], ["b", "a"], ["g"]]
+
+
+def test_cursor_points_past_its_own_note():
+    redis.zadd("timeline", {"a": 100, "b": 100, "c": 90})
+
+    ids, cursor = notes.get_page_ids("timeline", limit=1)
+
+    assert (ids, cursor) == (["b"], "100:b")
+    assert notes.get_page_ids("timeline", cursor, 5) == (["a", "c"], None)
+
+
+def test_garbage_cursors_start_from_the_first_page():
+    redis.zadd("timeline", {"a": 100, "b": 90})
+
+    for cursor in ["junk", "100", ":a", "x:a", "-5:a", ""]:
+        assert notes.parse_cursor(cursor) == ("", "")
+        assert notes.normalize_cursor(cursor) == ""
+        assert notes.get_page_ids("timeline", cursor, 5) == (["a", "b"], None)
+    assert notes.normalize_cursor("100:a") == "100:a"
+
+
+def test_expired_ids_are_skipped_and_the_page_filled():
+    redis.zadd("timeline", {f"n{i}": 100 - i for i in range(10)})
+    redis.zadd("expiring-notes", {"n0": 1, "n1": 1, "n3": 1, "n4": 10 ** 12})
+
+    pages = read_all("timeline", 3)
+
+    assert pages == [["n2", "n4", "n5"], ["n6", "n7", "n8"], ["n9"]]
+
+
+def test_merged_pages_drop_duplicates():
+    redis.zadd("direct", {"a": 100, "b": 90})
+    redis.zadd("group", {"a": 100, "c": 80})
+
+    assert notes.get_merged_page_ids(["direct", "group"], limit=2) == (["a", "b"], "90:b")
+    assert notes.get_merged_page_ids(["direct", "group"], "90:b", 2) == (["c"], None)
+
+
+def test_cached_first_page_expires_with_its_first_note(settings):
+    settings(page_cache_seconds=60)
+    db.create_user("alice", "alice@example.com", "Passw0rd!x")
+    notes.create("alice", "later", "treść", "", True, expires=3600)
+    assert notes.public_cache_seconds() == 60
+
+    notes.create("alice", "soon", "treść", "", True, expires=5)
+    assert notes.public_cache_seconds() in (4, 5)
+
+    client = app.app.test_client()
+    client.get("/public-notes").get_data()
+    assert 0 < redis.ttl(f"cache:public-notes:{cache.get_version('public-notes')[0]}:") <= 5
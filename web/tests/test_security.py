@@ -0,0 +1,38 @@
+import pytest
+import app
+import db
+import keyspace
+import security
+
+
+@pytest.fixture
+def client():
+    db.create_user("alice", "alice@example.com", "Passw0rd!x")
+    security.create_group("watchers")
+    return app.app.test_client()
+
+
+def login(client, username, password):
+    return client.post("/login", data={"username": username, "password": password})
+
+
+def test_failure_against_unknown_account_reaches_the_group(client):
+    login(client, "nobody", "guess")
+
+    failure = next(security.tail_failed_logins("watchers", "w1", block_ms=10))
+    assert failure["username"] == "nobody"
+    assert failure["ip"]
+
+
+def test_delivered_entries_are_replayed_until_acknowledged(client):
+    login(client, "nobody", "guess")
+    login(client, "alice", "guess")
+
+    watcher = security.tail_failed_logins("watchers", "w1", block_ms=10, count=1)
+    assert next(watcher)["username"] == "nobody"
+
+    # A restarted consumer gets back the entry that was delivered but not
+    # yet acknowledged, then carries on with new ones.
+    restarted = security.tail_failed_logins("watchers", "w1", block_ms=10, count=1)
+    assert [next(restarted)["username"], next(restarted)["username"]] == ["nobody", "alice"]
+    assert db.redis.xpending(keyspace.FAILED_LOGINS, "watchers")["pending"] == 1
@@ -0,0 +1,262 @@
+from datetime import datetime
+import json
+import os
+import pytz
+import db
+import notes
+import groups
+import utils
+import keyspace
+
+
+redis = db.redis
+
+FORMAT_VERSION = 3
+PHASES = ["users", "notes"]
+
+
+def export(path, batch_size=500, resume=False):
+    progress = load_progress(path) if resume else None
+    if progress is None:
+        progress = {"phase": "users", "position": [0, 0], "offset": 0,
+                    "counts": {phase: 0 for phase in PHASES}}
+        with open(path, "wb") as file:
+            write_line(file, {"type": "header", "version": FORMAT_VERSION,
+                              "exported": int(datetime.now(pytz.utc).timestamp())})
+            progress["offset"] = file.tell()
+        save_progress(path, progress)
+
+    with open(path, "r+b") as file:
+        file.seek(progress["offset"])
+        file.truncate()
+
+        for phase in PHASES[PHASES.index(progress["phase"]):]:
+            progress["phase"] = phase
+            pages = export_users if phase == "users" else export_notes
+            for records, position in pages(batch_size, progress["position"]):
+                for record in records:
+                    write_line(file, record)
+                file.flush()
+                os.fsync(file.fileno())
+
+                progress["position"] = position
+                progress["offset"] = file.tell()
+                progress["counts"][phase] += len(records)
+                save_progress(path, progress)
+            progress["position"] = [0, 0]
+
+    os.remove(progress_path(path))
+    return progress["counts"]
+
+
+def export_users(batch_size, position):
+    for usernames, position in resume_scan(
+            keyspace.shards("users"), position,
+            lambda key, cursor: redis.sscan(key, cursor, count=batch_size)):
+        pipe = redis.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hgetall(keyspace.user(username, "profile"))
+            pipe.xrange(keyspace.user(username, "logins"))
+            pipe.smembers(keyspace.user(username, "groups"))
+        results = pipe.execute() if usernames else []
+
+        owned = [(username, name) for username, names in zip(usernames, results[2::3])
+                 for name in sorted(names)]
+        for username, name in owned:
+            pipe.smembers(groups.members_key(username, name))
+        members = dict(zip(owned, pipe.execute() if owned else []))
+
+        records = [{"type": "user", "username": username, "profile": profile,
+                    "login_attempts": [{"id": entry_id, **fields} for entry_id, fields in attempts],
+                    "groups": {name: sorted(members[username, name]) for name in sorted(names)}}
+                   for username, profile, attempts, names
+                   in zip(usernames, results[0::3], results[1::3], results[2::3]) if profile]
+        yield records, position
+
+
+def export_notes(batch_size, position):
+    for keys, position in resume_scan(
+            scan_nodes(), position,
+            lambda node, cursor: scan_node(node, cursor, "note:*:content", batch_size)):
+        note_ids = [keyspace.note_id(key) for key in keys]
+        pipe = redis.pipeline(transaction=False)
+        notes.queue_reads(pipe, note_ids)
+        results = pipe.execute() if note_ids else []
+        notes.resolve_blobs(results[0::2])
+
+        records = []
+        for note_id, note, readers in zip(note_ids, results[0::2], results[1::2]):
+            if note:
+                records.append({
+                    "type": "note", "id": note_id, "author": note.get("author"),
+                    "title": note.get("title"), "content": notes.decode_content(note),
+                    "datetime": int(float(note.get("datetime"))),
+                    "public": note.get("public") == "1", "readers": sorted(readers),
+                    "groups": [notes.group_name(group_id)
+                               for group_id in note.get("groups", "").split()],
+                    "expires": int(float(note["expires"])) if note.get("expires") else None})
+        yield records, position
+
+
+def import_(path, batch_size=500, resume=False):
+    progress = load_progress(path, "import") if resume else None
+    progress = progress or {"offset": 0, "counts": {phase: 0 for phase in PHASES}}
+
+    with open(path, "rb") as file:
+        file.seek(progress["offset"])
+        batch = []
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            record = json.loads(line) if line.strip() else None
+            if record and record.get("type") == "header":
+                if record.get("version") not in (1, 2, FORMAT_VERSION):
+                    raise ValueError(f"Unsupported export version: {record.get('version')}")
+                continue
+
+            if batch and (not line or len(batch) >= batch_size
+                          or record and record.get("type") != batch[0].get("type")):
+                import_batch(batch)
+                progress["counts"][batch[0]["type"] + "s"] += len(batch)
+                progress["offset"] = offset
+                save_progress(path, progress, "import")
+                batch = []
+
+            if not line:
+                break
+            if record:
+                batch.append(record)
+
+    os.remove(progress_path(path, "import"))
+    return progress["counts"]
+
+
+def import_batch(records):
+    if records[0]["type"] == "user":
+        import_users(records)
+    elif records[0]["type"] == "note":
+        import_notes(records)
+
+
+def import_users(records):
+    pipe = redis.pipeline(transaction=False)
+    for record in records:
+        username, profile = record["username"], record["profile"]
+        attempts_key = keyspace.user(username, "logins")
+        pipe.hset(keyspace.user(username, "profile"), mapping=profile)
+        if profile.get("email"):
+            pipe.hsetnx("emails", profile["email"], username)
+        if profile.get("api_token"):
+            pipe.hset("api-tokens", profile["api_token"], username)
+        pipe.sadd(keyspace.shard_for("users", username), username)
+        pipe.delete(attempts_key)
+        for attempt in login_attempts(record.get("login_attempts", [])):
+            entry_id = attempt.pop("id")
+            pipe.xadd(attempts_key, attempt, id=entry_id)
+    pipe.execute()
+
+    # Members may come later in the file, so groups are stored as exported.
+    for record in records:
+        for name in record.get("groups", {}):
+            pipe.smembers(groups.members_key(record["username"], name))
+    current = iter(pipe.execute())
+    for record in records:
+        for name, members in record.get("groups", {}).items():
+            groups.queue_save(pipe, record["username"], name, next(current), members)
+    pipe.execute()
+
+
+def login_attempts(attempts):
+    if attempts and isinstance(attempts[0], str):
+        return [{"id": entry_id, **fields}
+                for entry_id, fields in db.legacy_login_entries(attempts)]
+    return attempts
+
+
+def import_notes(records):
+    readers = sorted({user for record in records for user in record.get("readers", [])})
+    taken = dict(zip(readers, db.usernames_taken(readers))) if keyspace.cluster else {}
+
+    blobs = []
+    pipe = notes.body_pipeline()
+    for record in records:
+        note_id, author, title = record["id"], record["author"], record["title"]
+        timestamp, public = record["datetime"], record["public"]
+        tokens = utils.tokenize(f"{title} {record['content']}")
+        content, encoding = notes.store_body(record["content"], pipe)
+        if encoding == notes.BLOB:
+            blobs.append((len(pipe), content))
+        note_readers = [] if public else record.get("readers", [])
+        note_groups = [] if public else record.get("groups", [])
+        expires = record.get("expires") or ""
+
+        # Notes that already exist are left untouched, so an import can be
+        # repeated or resumed from any batch.
+        if keyspace.cluster:
+            note_readers = notes.linked_readers(
+                author, note_readers, [taken.get(user) for user in note_readers])
+            note_groups = [keyspace.group_id(author, name) for name in note_groups]
+            notes.create_content_script(
+                keys=notes.note_keys(note_id), client=pipe,
+                args=notes.content_args(author, title, content, encoding, timestamp, public,
+                                        expires, tokens, note_readers, note_groups))
+            notes.queue_links(pipe, note_id, author, timestamp, public, expires, tokens,
+                              note_readers, note_groups)
+        else:
+            notes.create_script(
+                keys=notes.create_keys(note_id, author), client=pipe,
+                args=notes.create_args(note_id, author, title, content, encoding, timestamp,
+                                       public, expires, tokens, note_readers, note_groups))
+    results = pipe.execute()
+
+    # Give back the blob reference taken for notes that were already there.
+    for index, digest in blobs:
+        if not results[index]:
+            notes.release_blob_script(keys=[keyspace.blob(digest)], client=pipe)
+    pipe.execute()
+
+
+def resume_scan(sources, position, fetch):
+    index, cursor = position
+    while index < len(sources):
+        cursor, items = fetch(sources[index], cursor)
+        position = [index, cursor] if cursor else [index + 1, 0]
+        yield items, position
+        index, cursor = position
+
+
+def scan_nodes():
+    if keyspace.cluster:
+        return sorted(redis.get_primaries(), key=lambda node: node.name)
+    return [None]
+
+
+def scan_node(node, cursor, match, count):
+    if node is None:
+        return redis.scan(cursor, match=match, count=count)
+    cursors, keys = redis.scan(cursor, match=match, count=count, target_nodes=node)
+    return cursors[node.name], keys
+
+
+def write_line(file, record):
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+    file.write(line.encode())
+
+
+def progress_path(path, kind="export"):
+    return f"{path}.{kind}-progress"
+
+
+def load_progress(path, kind="export"):
+    try:
+        with open(progress_path(path, kind)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_progress(path, progress, kind="export"):
+    tmp_path = progress_path(path, kind) + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(progress, file)
+    os.replace(tmp_path, progress_path(path, kind))
@@ -1,12 +1,20 @@
 from flask import request
-from yaml import safe_load
 import string
+import re
 import math
 import pytz
 import sys
+from os import getenv
+import config
+import breached
 
 
-config = safe_load(open("config.yaml"))
+NOTE_EXPIRY = {
+    3600: "godzinie",
+    86400: "dniu",
+    604800: "tygodniu",
+    2592000: "30 dniach"
+}
 
 
 def password_bits(password):
@@ -51,11 +59,13 @@ def check_password(password1, password2):
         return errors
 
     try:
-        BITS_REQUIRED = config["min_password_bits"]
+        BITS_REQUIRED = config.settings.min_password_bits
         bits = round(password_bits(password1))
         if bits < BITS_REQUIRED:
             errors.append(
                 f"Hasło jest zbyt słabe ({bits} bitów, wymagane minimum {BITS_REQUIRED} bitów).")
+        elif breached.is_breached(password1):
+            errors.append("To hasło znajduje się w bazie haseł, które wyciekły. Wybierz inne.")
     except ValueError:
         errors.append("Nieprawidłowy znak w haśle. Dozwolone znaki to: \
             małe i duże litery, cyfry, znaki specjalne: \
@@ -64,36 +74,94 @@ def check_password(password1, password2):
     return errors
 
 
+def check_login(username, password):
+    errors = []
+
+    if not username:
+        errors.append("Nazwa użytkownika nie może być pusta.")
+
+    if not password:
+        errors.append("Hasło nie może być puste.")
+
+    if len(errors) > 0:
+        return errors
+
+    if len(username) > 50 or len(password) > 50 or not username.isalpha():
+        errors.append("Nieprawidłowa nazwa użytkownika lub hasło.")
+    return errors
+
+
+def check_registration(username, email):
+    errors = []
+
+    if not (username and 3 <= len(username) <= 20 and username.isalpha()):
+        errors.append("Nieprawidłowa nazwa użytkownika.")
+
+    if not (email and 3 <= len(email) <= 50):
+        errors.append("Nieprawidłowy adres email.")
+    return errors
+
+
+def check_note(title, content, readers):
+    errors = []
+
+    max_length = config.settings.max_note_length
+    max_title_length = config.settings.max_note_title_length
+    max_lines = config.settings.max_note_lines
+    max_readers_length = config.settings.max_note_readers_length
+
+    if len(content) > max_length:
+        errors.append(
+            f"Długość notatki nie może przekraczać {max_length} znaków.")
+
+    if len(title) > max_title_length:
+        errors.append(
+            f"Długość tytułu nie może przekraczać {max_title_length} znaków.")
+
+    if content.count("\n") > max_lines:
+        errors.append(f"Notatka nie może mieć więcej niż {max_lines} linii")
+
+    if len(readers) > max_readers_length:
+        errors.append("Nie można udostępnić notatki aż tylu użytkownikom.")
+    return errors
+
+
+def check_expiry(expires):
+    if expires and not (expires.isdigit() and int(expires) in NOTE_EXPIRY):
+        return ["Nieprawidłowy czas wygaśnięcia notatki."]
+    return []
+
+
+def check_group(name, members):
+    errors = []
+
+    max_members = config.settings.max_group_members
+
+    if not (name and 1 <= len(name) <= 20 and name.isalpha()):
+        errors.append("Nieprawidłowa nazwa grupy.")
+
+    if len(members) > max_members:
+        errors.append(f"Grupa nie może mieć więcej niż {max_members} członków.")
+    return errors
+
+
+def tokenize(text):
+    tokens = re.findall(r"\w+", text.lower())
+    return list(dict.fromkeys(
+        token for token in tokens if 2 <= len(token) <= 40))
+
+
+# X-Forwarded-For is only honoured for the trusted_proxies hops that app.py
+# and asgi.py strip off, so clients cannot pick their own address.
 def get_ip(request):
-    if not request.environ.get("HTTP_X_FORWARDED_FOR"):
-        return request.environ["REMOTE_ADDR"]
-    else:
-        return request.environ["HTTP_X_FORWARDED_FOR"]
+    return request.remote_addr
 
 
 def check_config():
-    config = safe_load(open("config.yaml"))
-    keys = [
-        "login_attempts_history_length",
-        "login_attempts_check_minutes",
-        "next_login_seconds_per_attempt",
-        "password_reset_token_bytes",
-        "min_password_bits",
-        "bcrypt_rounds",
-
-        "session_token_bytes",
-        "session_expire_seconds",
-
-        "max_note_lines",
-        "max_note_length",
-        "max_note_title_length",
-        "max_note_readers_length"
-    ]
-
-    for key in keys:
-        if config.get(key) == None:
-            print("No argument in config.yaml: " + key + ".", flush=True)
-            sys.exit(4)
+    if config.settings.session_mode == "signed" and not (
+            getenv("SESSION_SECRET") or getenv("FLASH_SECRET")):
+        print("No SESSION_SECRET environment variable for signed sessions.", flush=True)
+        sys.exit(4)
     return True
 
 